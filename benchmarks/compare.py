@@ -0,0 +1,72 @@
+"""
+Compares two benchmark reports, ex. of the previous and the current release, workload by workload.
+Exits with 1 if the throughput dropped or the p99 latency rose by more than the threshold
+
+    python -m benchmarks.compare baseline.json current.json --threshold 10
+"""
+import argparse
+import json
+import sys
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Compare two CoreCache benchmark reports")
+    parser.add_argument("baseline", help="Report of the reference run")
+    parser.add_argument("current", help="Report of the run under test")
+    parser.add_argument("--threshold", type=float, default=10, help="Change in percent counted as a regression")
+    return parser.parse_args(argv)
+
+
+def change(baseline: float, current: float) -> float:
+    """
+    Change from baseline to current in percent
+    """
+    if not baseline:
+        return 0.0
+    return (current - baseline) / baseline * 100
+
+
+def compare(baseline: dict, current: dict, threshold: float) -> list:
+    """
+    One row per workload present in both reports, regression is set if throughput dropped or p99
+    rose by more than threshold percent
+    """
+    baseline_results = {result["workload"]: result for result in baseline["results"]}
+    rows = []
+    for result in current["results"]:
+        reference = baseline_results.get(result["workload"])
+        if reference is None:
+            continue
+        throughput_change = change(reference["ops_per_sec"], result["ops_per_sec"])
+        p99_change = change(reference["p99_ms"], result["p99_ms"])
+        rows.append(
+            {
+                "workload": result["workload"],
+                "ops_per_sec": [reference["ops_per_sec"], result["ops_per_sec"]],
+                "ops_per_sec_change": round(throughput_change, 2),
+                "p99_ms": [reference["p99_ms"], result["p99_ms"]],
+                "p99_ms_change": round(p99_change, 2),
+                "regression": throughput_change < -threshold or p99_change > threshold,
+            }
+        )
+    return rows
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    with open(args.baseline) as fp_baseline, open(args.current) as fp_current:
+        baseline, current = json.load(fp_baseline), json.load(fp_current)
+    if baseline["benchmark"] != current["benchmark"]:
+        sys.exit(f"Cannot compare a {baseline['benchmark']} report with a {current['benchmark']} report")
+    rows = compare(baseline, current, args.threshold)
+    json.dump(
+        {"baseline": baseline["commit"], "current": current["commit"], "threshold": args.threshold, "workloads": rows},
+        sys.stdout,
+        indent=2,
+    )
+    sys.stdout.write("\n")
+    sys.exit(1 if any(row["regression"] for row in rows) else 0)
+
+
+if __name__ == "__main__":
+    main()
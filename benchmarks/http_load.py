@@ -0,0 +1,184 @@
+"""
+End to end load generator for the HTTP API of main.py. By default it starts a single node with a
+fake ZooKeeper, see benchmarks.local_node, --target points it at a running leader instead
+
+    python -m benchmarks.http_load --keys 10000 --concurrency 32 --output http.json
+"""
+from loguru import logger
+from benchmarks.report import build_report, summarize, write_report
+from collections import Counter
+import argparse
+import asyncio
+import httpx
+import random
+import socket
+import string
+import subprocess
+import sys
+import tempfile
+import time
+
+WORKLOADS = ["write", "read", "missing", "mixed"]
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="CoreCache HTTP load generator")
+    parser.add_argument("--target", default=None, help="host:port of a running leader, a local node is started by default")
+    parser.add_argument("--keys", type=int, default=10000, help="Number of keys written, and read by the read workloads")
+    parser.add_argument("--value-size", type=int, default=128, help="Size of every value in bytes")
+    parser.add_argument("--ops", type=int, default=None, help="Requests of the read, missing and mixed workloads, defaults to --keys")
+    parser.add_argument("--read-ratio", type=float, default=0.5, help="Share of reads in the mixed workload")
+    parser.add_argument("--concurrency", type=int, default=32, help="Requests in flight")
+    parser.add_argument("--workloads", default=",".join(WORKLOADS), help=f"Comma separated, out of {','.join(WORKLOADS)}")
+    parser.add_argument("--seed", type=int, default=42, help="Seed of the keys and of the requests")
+    parser.add_argument("--timeout-ms", type=int, default=10000, help="Timeout of every request")
+    parser.add_argument("--output", default=None, help="File the JSON report is written to, stdout by default")
+    return parser.parse_args(argv)
+
+
+def make_key(number: int) -> str:
+    return f"key{number:010d}"
+
+
+def free_port() -> int:
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        return probe.getsockname()[1]
+
+
+def start_local_node(data_dir: str):
+    """
+    Starts benchmarks.local_node in a process of its own, so the load generator does not compete
+    with the server for the GIL. Returns the process and its host:port once it serves requests
+    """
+    port = free_port()
+    log_file = open(f"{data_dir}/node.log", "w")
+    process = subprocess.Popen(
+        [sys.executable, "-m", "benchmarks.local_node", "--port", str(port), "--data-dir", f"{data_dir}/data"],
+        stdout=log_file,
+        stderr=subprocess.STDOUT,
+    )
+    host_port = f"127.0.0.1:{port}"
+    for _ in range(300):
+        if process.poll() is not None:
+            raise RuntimeError(f"The local node exited with {process.returncode}, see {log_file.name}")
+        try:
+            if httpx.get(f"http://{host_port}/ring").json()["nodes"]:
+                return process, host_port
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.1)
+    process.terminate()
+    raise RuntimeError(f"The local node did not start, see {log_file.name}")
+
+
+class HttpLoad:
+    """
+    Sends the requests of a workload with at most concurrency of them in flight and records the
+    latency of every one, including the failed ones
+    """
+
+    def __init__(self, args, host_port: str):
+        self.args = args
+        self.random = random.Random(args.seed)
+        self.value = "".join(self.random.choices(string.ascii_letters, k=args.value_size))
+        self.http = httpx.AsyncClient(
+            base_url=f"http://{host_port}",
+            timeout=args.timeout_ms / 1000,
+            limits=httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency),
+        )
+
+    def add(self, key: str):
+        return self.http.post("/add/", json={"key": key, "value": self.value})
+
+    def get(self, key: str):
+        return self.http.get("/get/", params={"key": key})
+
+    async def run_requests(self, workload: str, requests: list, expected: set) -> dict:
+        """
+        requests: (send, key) pairs, a status outside of expected is counted as an error
+        """
+        latencies, statuses = [], Counter()
+        pending = iter(requests)
+
+        async def worker():
+            for send, key in pending:
+                start_time = time.perf_counter()
+                try:
+                    status = (await send(key)).status_code
+                except httpx.HTTPError as e:
+                    status = type(e).__name__
+                latencies.append(time.perf_counter() - start_time)
+                statuses[status] += 1
+
+        start_time = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(self.args.concurrency)))
+        elapsed = time.perf_counter() - start_time
+        errors = sum(count for status, count in statuses.items() if status not in expected)
+        return summarize(
+            workload, latencies, elapsed,
+            concurrency=self.args.concurrency,
+            errors=errors,
+            statuses={str(status): count for status, count in statuses.items()},
+        )
+
+    def random_keys(self, suffix: str = "") -> list:
+        return [make_key(self.random.randrange(self.args.keys)) + suffix for _ in range(self.args.ops or self.args.keys)]
+
+    async def write(self) -> dict:
+        numbers = list(range(self.args.keys))
+        self.random.shuffle(numbers)
+        return await self.run_requests("write", [(self.add, make_key(number)) for number in numbers], {200})
+
+    async def read(self) -> dict:
+        return await self.run_requests("read", [(self.get, key) for key in self.random_keys()], {200})
+
+    async def missing(self) -> dict:
+        return await self.run_requests("missing", [(self.get, key) for key in self.random_keys("-missing")], {404})
+
+    async def mixed(self) -> dict:
+        requests = [
+            (self.get if self.random.random() < self.args.read_ratio else self.add, key)
+            for key in self.random_keys()
+        ]
+        result = await self.run_requests("mixed", requests, {200})
+        result["read_ratio"] = self.args.read_ratio
+        return result
+
+    async def run(self, workloads: list) -> list:
+        try:
+            # The read workloads need the keys, they are written even if write is not reported
+            results = [await self.write()]
+            if "write" not in workloads:
+                results = []
+            for workload in ["read", "missing", "mixed"]:
+                if workload in workloads:
+                    results.append(await getattr(self, workload)())
+            return results
+        finally:
+            await self.http.aclose()
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    workloads = args.workloads.split(",")
+    unknown = set(workloads) - set(WORKLOADS)
+    if unknown:
+        sys.exit(f"Unknown workloads {sorted(unknown)}, pick from {WORKLOADS}")
+    process, host_port, data_dir = None, args.target, None
+    if host_port is None:
+        data_dir = tempfile.mkdtemp(prefix="corecache-benchmark-")
+        process, host_port = start_local_node(data_dir)
+        logger.info("Started a local node on {}, logging to {}/node.log", host_port, data_dir)
+    try:
+        results = asyncio.run(HttpLoad(args, host_port).run(workloads))
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+    config = dict(vars(args), target=host_port, local_node=process is not None, data_dir=data_dir)
+    write_report(build_report("http", config, results), args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+"""
+Runs a single CoreCache node against an in-process fake of ZooKeeper, so main.py can be load
+tested without a ZooKeeper ensemble. The node is the only member of the cluster and its leader
+
+    python -m benchmarks.local_node --port 8000 --data-dir /tmp/corecache-benchmark
+"""
+from config import settings
+from kazoo.exceptions import NodeExistsError, NoNodeError
+from kazoo.handlers.threading import SequentialThreadingHandler
+from kazoo.protocol.states import EventType, KeeperState, WatchedEvent
+from utils.log_config import configure_logging
+import argparse
+import os
+import tempfile
+import threading
+
+
+class FakeZooKeeper:
+    """
+    The part of KazooClient the server uses, backed by a dict: znodes with data, sequential
+    ephemeral nodes and one shot children watches, enough for kazoo's ChildrenWatch
+    """
+
+    def __init__(self, hosts=None, **kwargs):
+        self.handler = SequentialThreadingHandler()
+        self._znodes = {"/": b""}
+        self._sequence = 0
+        self._children_watches = {}
+        self._lock = threading.RLock()
+
+    def start(self, timeout=None):
+        pass
+
+    def stop(self):
+        pass
+
+    def add_listener(self, listener):
+        pass
+
+    def remove_listener(self, listener):
+        pass
+
+    def retry(self, func, *args, **kwargs):
+        return func(*args, **kwargs)
+
+    def ensure_path(self, path):
+        with self._lock:
+            parts = path.strip("/").split("/")
+            for depth in range(1, len(parts) + 1):
+                self._znodes.setdefault("/" + "/".join(parts[:depth]), b"")
+        return True
+
+    def create(self, path, value=b"", ephemeral=False, sequence=False, **kwargs):
+        with self._lock:
+            if sequence:
+                path = f"{path}{self._sequence:010d}"
+                self._sequence += 1
+            if path in self._znodes:
+                raise NodeExistsError(path)
+            self._znodes[path] = value
+        self._children_changed(path.rsplit("/", 1)[0] or "/")
+        return path
+
+    def get(self, path, watch=None):
+        with self._lock:
+            if path not in self._znodes:
+                raise NoNodeError(path)
+            return self._znodes[path], None
+
+    def get_children(self, path, watch=None, **kwargs):
+        with self._lock:
+            if path not in self._znodes:
+                raise NoNodeError(path)
+            if watch is not None:
+                self._children_watches.setdefault(path, []).append(watch)
+            prefix = path.rstrip("/") + "/"
+            return sorted(
+                znode[len(prefix):] for znode in self._znodes if znode.startswith(prefix) and "/" not in znode[len(prefix):]
+            )
+
+    def delete(self, path, **kwargs):
+        with self._lock:
+            if self._znodes.pop(path, None) is None:
+                raise NoNodeError(path)
+        self._children_changed(path.rsplit("/", 1)[0] or "/")
+
+    def _children_changed(self, path):
+        # ZooKeeper watches fire once, ChildrenWatch sets a new one from its callback
+        with self._lock:
+            watches = self._children_watches.pop(path, [])
+        for watch in watches:
+            watch(WatchedEvent(EventType.CHILD, KeeperState.CONNECTED, path))
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Single CoreCache node with a fake ZooKeeper")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--data-dir", default=None, help="Empty data directory, a temporary one by default")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    data_dir = args.data_dir or tempfile.mkdtemp(prefix="corecache-benchmark-")
+    os.makedirs(data_dir, exist_ok=True)
+    settings.set("dataDirectory", data_dir)
+    configure_logging()
+
+    # The server reads its settings at import, it is imported once the settings are set
+    import main as core_cache
+    import server.server
+    import uvicorn
+
+    server.server.KazooClient = FakeZooKeeper
+    core_cache.server_instance = server.server.Server(
+        zk_host="fake", zk_port=0, private_ip=args.host, port=args.port
+    )
+    core_cache.server_instance.start()
+    uvicorn.run(core_cache.app, host=args.host, port=args.port, access_log=False, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
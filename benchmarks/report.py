@@ -0,0 +1,70 @@
+import json
+import math
+import platform
+import subprocess
+import sys
+import time
+
+
+def percentile(sorted_values: list, percent: float) -> float:
+    """
+    Nearest rank percentile of values sorted in ascending order
+    """
+    if not sorted_values:
+        return 0.0
+    rank = max(math.ceil(percent / 100 * len(sorted_values)), 1)
+    return sorted_values[rank - 1]
+
+
+def summarize(workload: str, latencies: list, elapsed: float, **extra) -> dict:
+    """
+    Throughput and latency percentiles of one workload, latencies and elapsed in seconds
+    """
+    latencies = sorted(latencies)
+    return {
+        "workload": workload,
+        "ops": len(latencies),
+        "seconds": round(elapsed, 6),
+        "ops_per_sec": round(len(latencies) / elapsed, 2) if elapsed else 0.0,
+        "p50_ms": round(percentile(latencies, 50) * 1000, 4),
+        "p95_ms": round(percentile(latencies, 95) * 1000, 4),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 4),
+        "max_ms": round(latencies[-1] * 1000, 4) if latencies else 0.0,
+        **extra,
+    }
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def build_report(benchmark: str, config: dict, results: list) -> dict:
+    """
+    The machine readable output of a benchmark run, compared across releases by benchmarks.compare
+    """
+    return {
+        "benchmark": benchmark,
+        "commit": git_commit(),
+        "timestamp": int(time.time()),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "config": config,
+        "results": results,
+    }
+
+
+def write_report(report: dict, output: str = None):
+    """
+    Writes the report to output, or to stdout when output is None
+    """
+    if output is None:
+        json.dump(report, sys.stdout, indent=2)
+        sys.stdout.write("\n")
+    else:
+        with open(output, "w") as fp_output:
+            json.dump(report, fp_output, indent=2)
@@ -0,0 +1,189 @@
+"""
+Drives the storage engine directly, MemTable, SSTable and Compaction, without ZooKeeper or HTTP.
+Every run starts from an empty data directory and prints a JSON report, see benchmarks.report
+
+    python -m benchmarks.storage --keys 100000 --value-size 128 --output storage.json
+"""
+from config import settings
+from loguru import logger
+from exception.exceptions import NoDataFoundException
+from utils.model import Data
+from benchmarks.report import build_report, summarize, write_report
+import argparse
+import os
+import random
+import string
+import sys
+import tempfile
+import time
+
+WORKLOADS = ["write", "read", "missing", "mixed", "compaction"]
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="CoreCache storage engine benchmark")
+    parser.add_argument("--keys", type=int, default=100000, help="Number of keys written, and read by the read workloads")
+    parser.add_argument("--value-size", type=int, default=128, help="Size of every value in bytes")
+    parser.add_argument("--memtable-keys", type=int, default=10000, help="Keys per MemTable, a full MemTable is flushed to an SSTable")
+    parser.add_argument("--ops", type=int, default=None, help="Operations of the read, missing and mixed workloads, defaults to --keys")
+    parser.add_argument("--read-ratio", type=float, default=0.5, help="Share of reads in the mixed workload")
+    parser.add_argument("--key-order", choices=["random", "sequential"], default="random", help="Order the keys are written in")
+    parser.add_argument("--workloads", default=",".join(WORKLOADS), help=f"Comma separated, out of {','.join(WORKLOADS)}")
+    parser.add_argument("--compaction-strategy", choices=["size_tiered", "leveled"], default=settings.compaction.strategy)
+    parser.add_argument("--index-mode", choices=["sparse", "dense"], default=settings.sstable.indexMode)
+    parser.add_argument("--seed", type=int, default=42, help="Seed of the key order and of the operations")
+    parser.add_argument("--data-dir", default=None, help="Empty data directory, a temporary one by default")
+    parser.add_argument("--output", default=None, help="File the JSON report is written to, stdout by default")
+    return parser.parse_args(argv)
+
+
+def make_key(number: int) -> str:
+    return f"key{number:010d}"
+
+
+class StorageBenchmark:
+    """
+    A MemTable flushed every memtable_keys keys into SSTables, read the way Server.get_data reads:
+    the MemTable first, then the SSTables
+    """
+
+    def __init__(self, args):
+        # The storage engine reads its settings at import, they are imported once the settings are set
+        from compaction.compaction import Compaction, STRATEGIES
+        from lsmt.manifest import manifest
+        from lsmt.mem_table import MemTable
+        from lsmt.sstable import SSTable
+
+        self.args = args
+        self.random = random.Random(args.seed)
+        self.value = "".join(self.random.choices(string.ascii_letters, k=args.value_size))
+        self.mem_table = MemTable()
+        self.sstable = SSTable()
+        self.compaction = Compaction(data_dir=settings.dataDirectory, strategy=STRATEGIES[args.compaction_strategy]())
+        self.manifest = manifest
+        self.flush_latencies = []
+
+    def add(self, key: str):
+        self.mem_table.add(Data(key=key, value=self.value))
+        if self.mem_table.get_length() >= self.args.memtable_keys:
+            self.flush()
+
+    def flush(self):
+        start_time = time.perf_counter()
+        self.mem_table.flush()
+        self.flush_latencies.append(time.perf_counter() - start_time)
+        self.mem_table = type(self.mem_table)()
+
+    def get(self, key: str):
+        try:
+            return self.mem_table.get_data(key)
+        except NoDataFoundException:
+            return self.sstable.get_data(key)
+
+    def get_missing(self, key: str):
+        try:
+            self.get(key)
+        except NoDataFoundException:
+            return None
+        raise AssertionError(f"{key} was never written but was found")
+
+    @staticmethod
+    def timed(operation, args) -> tuple:
+        latencies = []
+        start_time = time.perf_counter()
+        for arg in args:
+            op_start = time.perf_counter()
+            operation(arg)
+            latencies.append(time.perf_counter() - op_start)
+        return latencies, time.perf_counter() - start_time
+
+    def write(self) -> list:
+        numbers = list(range(self.args.keys))
+        if self.args.key_order == "random":
+            self.random.shuffle(numbers)
+        latencies, elapsed = self.timed(self.add, [make_key(number) for number in numbers])
+        flush_latencies, self.flush_latencies = self.flush_latencies, []
+        return [
+            summarize("write", latencies, elapsed, value_size=self.args.value_size),
+            summarize("flush", flush_latencies, sum(flush_latencies), keys_per_flush=self.args.memtable_keys),
+        ]
+
+    def read(self) -> list:
+        keys = [make_key(self.random.randrange(self.args.keys)) for _ in range(self.ops)]
+        return [summarize("read", *self.timed(self.get, keys))]
+
+    def missing(self) -> list:
+        # Sorted between the written keys, the bloom filters have to rule them out
+        keys = [make_key(self.random.randrange(self.args.keys)) + "-missing" for _ in range(self.ops)]
+        return [summarize("missing", *self.timed(self.get_missing, keys))]
+
+    def mixed(self) -> list:
+        operations = [
+            (self.get if self.random.random() < self.args.read_ratio else self.add, make_key(self.random.randrange(self.args.keys)))
+            for _ in range(self.ops)
+        ]
+        latencies, elapsed = self.timed(lambda operation: operation[0](operation[1]), operations)
+        self.flush_latencies = []
+        return [summarize("mixed", latencies, elapsed, read_ratio=self.args.read_ratio)]
+
+    def compact(self) -> list:
+        if self.mem_table.get_length():
+            self.flush()
+        self.flush_latencies = []
+        sstables_before = len(self.manifest.file_ids())
+        latencies, elapsed = [], 0.0
+        while True:
+            start_time = time.perf_counter()
+            if self.compaction.compact() is None:
+                break
+            latencies.append(time.perf_counter() - start_time)
+            elapsed += latencies[-1]
+        result = summarize(
+            "compaction", latencies, elapsed,
+            strategy=self.args.compaction_strategy,
+            sstables_before=sstables_before,
+            sstables_after=len(self.manifest.file_ids()),
+        )
+        # A run compacts many keys, its throughput is in keys
+        result["keys_per_sec"] = round(self.args.keys / elapsed, 2) if elapsed else 0.0
+        return [result]
+
+    @property
+    def ops(self) -> int:
+        return self.args.ops or self.args.keys
+
+    def run(self, workloads: list) -> list:
+        # The read workloads need the keys on disk, they are written even if write is not reported
+        results = self.write()
+        if "write" not in workloads:
+            results = []
+        for workload in ["read", "missing", "mixed"]:
+            if workload in workloads:
+                results += getattr(self, workload)()
+        if "compaction" in workloads:
+            results += self.compact()
+        return results
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    workloads = args.workloads.split(",")
+    unknown = set(workloads) - set(WORKLOADS)
+    if unknown:
+        sys.exit(f"Unknown workloads {sorted(unknown)}, pick from {WORKLOADS}")
+    data_dir = args.data_dir or tempfile.mkdtemp(prefix="corecache-benchmark-")
+    os.makedirs(data_dir, exist_ok=True)
+    settings.set("dataDirectory", data_dir)
+    settings.set("sstable.indexMode", args.index_mode)
+    # Per flush and per compaction INFO logs would end up in the measurements
+    logger.remove()
+    logger.add(sys.stderr, level="WARNING")
+    logger.info("Benchmarking in {}", data_dir)
+
+    results = StorageBenchmark(args).run(workloads)
+    config = dict(vars(args), data_dir=data_dir)
+    write_report(build_report("storage", config, results), args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+from dataclasses import dataclass, field
+from loguru import logger
+from exception.exceptions import NoDataFoundException, StaleRingException, WriteStallException
+from server.cluster_view import ClusterView
+from utils.model import Data
+import httpx
+
+
+@dataclass
+class CoreCacheClient:
+    """
+    Python client that routes every request straight to the node owning the key, skipping the hop
+    through the leader
+    1. The hash ring is fetched from /ring of any known node and cached
+    2. Requests carry the version of the cached ring, a node that does not own the key answers 409
+       and the client fetches the ring again before retrying
+    3. Every response carries X-Ring-Version, a newer version refreshes the ring before the next request
+
+    seed_nodes: host:port of the nodes to fetch the ring from, ex. ["10.0.0.1:8000"]
+    """
+
+    seed_nodes: list
+    max_retries: int = 3
+    timeout_ms: int = 5000
+    pool_size: int = 32
+    http: httpx.Client = None
+    _view: ClusterView = field(default=None, repr=False)
+    _stale: bool = field(default=True, repr=False)
+
+    def __post_init__(self):
+        if self.http is None:
+            self.http = httpx.Client(
+                timeout=self.timeout_ms / 1000,
+                limits=httpx.Limits(max_connections=self.pool_size, max_keepalive_connections=self.pool_size),
+            )
+
+    def refresh_ring(self):
+        """
+        Fetches the ring from the members of the cached ring, then the seed nodes, the first one that answers wins
+        """
+        known_nodes = list(self._view.id_host_map.values()) if self._view is not None else []
+        for host_port in known_nodes + [node for node in self.seed_nodes if node not in known_nodes]:
+            try:
+                response = self.http.get(f"http://{host_port}/ring")
+                response.raise_for_status()
+            except httpx.HTTPError as e:
+                logger.warning("Could not fetch the ring from {}: {}", host_port, e)
+                continue
+            ring = response.json()
+            self._view = ClusterView.build(ring["version"], ring["nodes"])
+            self._stale = False
+            logger.info("Using ring version {} with {} nodes", self._view.version, len(self._view.id_host_map))
+            return self._view
+        raise ConnectionError(f"None of the nodes {known_nodes + self.seed_nodes} returned the ring")
+
+    def request(self, method: str, path: str, key: str, **kwargs):
+        params = dict(kwargs.pop("params", None) or {})
+        for attempt in range(self.max_retries):
+            if self._stale or self._view is None:
+                self.refresh_ring()
+            host_port = self._view.get_data_node(key)
+            params["ring_version"] = self._view.version
+            try:
+                response = self.http.request(method, f"http://{host_port}{path}", params=params, **kwargs)
+            except httpx.TransportError as e:
+                # The owner may have left the cluster
+                logger.warning("Request to {} failed: {}", host_port, e)
+                self._stale = True
+                continue
+            if int(response.headers.get("X-Ring-Version", self._view.version)) > self._view.version:
+                self._stale = True
+            if response.status_code == 409:
+                logger.info("Ring version {} is stale for {}, refreshing it", self._view.version, key)
+                self._stale = True
+                continue
+            if response.status_code == 404:
+                raise NoDataFoundException(f"No data found for: {key}")
+            if response.status_code == 429:
+                raise WriteStallException(response.text)
+            response.raise_for_status()
+            return response.json() if response.content else None
+        raise StaleRingException(f"No owner found for {key} after {self.max_retries} attempts")
+
+    def add(self, key: str, value: str):
+        data = Data(key=key, value=value)
+        return self.request(
+            "POST",
+            "/add/",
+            key,
+            json={"key": data.key, "value": data.value, "timestamp": data.timestamp, "deleted": data.deleted},
+        )
+
+    def get(self, key: str) -> Data:
+        return Data(**self.request("GET", "/get/", key, params={"key": key}))
+
+    def delete(self, key: str):
+        return self.request("POST", "/delete/", key, params={"key": key})
+
+    def close(self):
+        self.http.close()
@@ -1,147 +1,340 @@
-from dataclasses import dataclass
-import glob
+from dataclasses import dataclass, field
 from loguru import logger
-import json
-from collections import defaultdict
-import time
 from config import settings
+from prometheus_client import Gauge
+from typing import Optional
+import math
 import os
+import threading
+from lsmt.index_cache import index_cache, bloom_filter_cache
+from lsmt.bloom_filter import BloomFilter
+from lsmt.manifest import manifest
+from lsmt.sstable_format import SSTableWriter, FOOTER_VERSION, iter_records, read_header, read_record
+from lsmt.sstable import load_dense_index, write_index, record_bytes_written
+from lsmt.mapped_file import mapped_files
+from lsmt.scan import merge_newest
+from exception.exceptions import StaleSnapshotException
+
+compaction_bytes_read = Gauge(
+    "compaction_bytes_read", "Bytes of SSTable data files read by the last compaction", labelnames=["level"]
+)
+compaction_bytes_written = Gauge(
+    "compaction_bytes_written", "Bytes of SSTable data files written by the last compaction", labelnames=["level"]
+)
+
+
+@dataclass
+class CompactionTask:
+    """
+    The SSTables picked by a strategy for one compaction run
+
+    file_ids: SSTables to merge, in read order
+    output_level: Level of the compacted SSTables
+    drop_tombstones: True when no SSTable left out of the run can hold an older copy of its keys
+    max_file_bytes: Size at which the output is split into a new SSTable, None writes a single one
+    """
+
+    file_ids: list
+    output_level: int = 0
+    drop_tombstones: bool = False
+    max_file_bytes: Optional[int] = None
+
+
+def overlaps(sstable: dict, min_key, max_key) -> bool:
+    """
+    Unknown key ranges, of SSTables that predate the manifest metadata, overlap everything
+    """
+    if None in (sstable["min_key"], sstable["max_key"], min_key, max_key):
+        return True
+    return sstable["min_key"] <= max_key and min_key <= sstable["max_key"]
+
+
+@dataclass
+class SizeTieredStrategy:
+    """
+    Merges SSTables of similar size, so every byte is rewritten about once per size tier. Only a run
+    of SSTables adjacent in the read order is picked, the output takes the place of the newest one
+    and an SSTable left in between would be shadowed by older data
+    """
+
+    min_files: int = settings.compaction.numOfFiles
+    max_files: int = settings.compaction.maxFiles
+    bucket_ratio: float = settings.compaction.bucketRatio
+    min_tier_bytes: int = settings.compaction.minTierBytes
+
+    def similar(self, sizes: list) -> bool:
+        # Small SSTables all fall in the first tier
+        sizes = [max(size, self.min_tier_bytes) for size in sizes]
+        return max(sizes) <= min(sizes) * self.bucket_ratio
+
+    def pick(self, sstables: list) -> Optional[CompactionTask]:
+        for start in range(len(sstables)):
+            end = start + 1
+            while (
+                end < len(sstables)
+                and end - start < self.max_files
+                and self.similar([sstable["size"] for sstable in sstables[start:end + 1]])
+            ):
+                end += 1
+            if end - start >= self.min_files:
+                return CompactionTask(
+                    file_ids=[sstable["file_id"] for sstable in sstables[start:end]],
+                    drop_tombstones=end == len(sstables),
+                )
+        return None
+
+
+@dataclass
+class LeveledStrategy:
+    """
+    Level 0 holds the flushed SSTables, every other level is a set of SSTables with disjoint key ranges
+    holding up to level_multiplier times the bytes of the level above it
+    1. Once level 0 has min_files SSTables, its oldest ones are merged with the level 1 SSTables they overlap
+    2. Otherwise the oldest SSTable of the first level over its budget is merged with the SSTables of the
+       next level it overlaps
+    The output is split into SSTables of max_file_bytes, so a run rewrites a bounded key range
+    """
+
+    min_files: int = settings.compaction.numOfFiles
+    max_files: int = settings.compaction.maxFiles
+    level_base_bytes: int = settings.compaction.levelBaseBytes
+    level_multiplier: int = settings.compaction.levelMultiplier
+    max_file_bytes: int = settings.compaction.targetFileBytes
+
+    def max_level_bytes(self, level: int) -> int:
+        return self.level_base_bytes * self.level_multiplier ** (level - 1)
+
+    def task(self, sstables: list, inputs: list, output_level: int) -> CompactionTask:
+        known_keys = [sstable for sstable in inputs if sstable["min_key"] is not None]
+        min_key = min((sstable["min_key"] for sstable in known_keys), default=None)
+        max_key = max((sstable["max_key"] for sstable in known_keys), default=None)
+        if len(known_keys) < len(inputs):
+            min_key = max_key = None
+        inputs = inputs + [
+            sstable for sstable in sstables
+            if sstable["level"] == output_level and overlaps(sstable, min_key, max_key)
+        ]
+        return CompactionTask(
+            file_ids=[sstable["file_id"] for sstable in inputs],
+            output_level=output_level,
+            drop_tombstones=not any(sstable["level"] > output_level for sstable in sstables),
+            max_file_bytes=self.max_file_bytes,
+        )
+
+    def pick(self, sstables: list) -> Optional[CompactionTask]:
+        level_zero = [sstable for sstable in sstables if sstable["level"] == 0]
+        if len(level_zero) >= self.min_files:
+            # The oldest SSTables of level 0, the ones left behind are newer and still shadow the output
+            return self.task(sstables, level_zero[-self.max_files:], 1)
+        levels = sorted({sstable["level"] for sstable in sstables if sstable["level"] > 0})
+        for level in levels:
+            in_level = [sstable for sstable in sstables if sstable["level"] == level]
+            if sum(sstable["size"] for sstable in in_level) > self.max_level_bytes(level):
+                return self.task(sstables, in_level[-1:], level + 1)
+        return None
+
+
+STRATEGIES = {"size_tiered": SizeTieredStrategy, "leveled": LeveledStrategy}
 
 
 @dataclass
 class Compaction:
     """
-    Compaction is triggered by Scheduler and does the following
-    1. Check the number of data files, if the number is greater than thereshold then compacts them
+    Compaction runs on a worker thread of its own, woken up by Scheduler, and does the following
+    1. Ask the compaction strategy, as per compaction.strategy, for a bounded set of SSTables to merge
+       from a snapshot of the manifest
     2. Compaction process
-        a) Read the data files one by one, identify updates and deletes
-        b) Write another set of index and data files
-        c) Rename the existing index and files
+        a) Stream the records of every SSTable in key order and merge them with a heap, holding
+           one record per SSTable in memory
+        b) Keep the newest record of every key, drop deleted keys when it is safe, and write the
+           survivors sequentially to new, key ordered SSTables
+        c) Swap the new SSTables in the manifest and rename the existing index and data files
+    SSTables flushed meanwhile are newer than the snapshot and stay ahead of the output, so flushes
+    never wait for a compaction
     """
 
     max_data_files: int = settings.compaction.numOfFiles
     data_dir: str = settings.dataDirectory
+    strategy: object = field(default_factory=lambda: STRATEGIES[settings.compaction.strategy]())
+    _wakeup: threading.Event = field(default_factory=threading.Event, repr=False, compare=False)
+    _worker: threading.Thread = field(default=None, repr=False, compare=False)
+    # A single compaction at a time, two runs planned on the same snapshot would pick the same SSTables
+    _lock: threading.Lock = field(default_factory=threading.Lock, repr=False, compare=False)
+
+    def __post_init__(self):
+        self.strategy.min_files = self.max_data_files
+
+    def start(self):
+        if self._worker is None:
+            self._worker = threading.Thread(target=self._compact_on_wakeup, name="compaction", daemon=True)
+            self._worker.start()
+
+    def wakeup(self):
+        self._wakeup.set()
+
+    def _compact_on_wakeup(self):
+        while True:
+            self._wakeup.wait()
+            self._wakeup.clear()
+            try:
+                while self.compact() is not None:
+                    pass
+            except Exception:
+                logger.exception("Compaction failed, retrying on the next wakeup")
 
     def can_compact(self) -> bool:
-        index_files = glob.glob(f"{self.data_dir}/*.index")
-        return len(index_files) >= self.max_data_files
+        return self.strategy.pick(manifest.snapshot().sstables) is not None
 
     def compact(self):
-        key_offset_map = dict()
-        file_key_map = defaultdict(set)
-
-        # list of index files
-        index_files = glob.glob(f"{self.data_dir}/*.index")
-        self.prepare_data(
-            index_files=index_files,
-            key_offset_map=key_offset_map,
-            file_key_map=file_key_map,
-        )
-        logger.info("Data is ready to be compacted")
-        self.create_compacted_files(
-            file_key_map=file_key_map,
-            key_offset_map=key_offset_map,
-            index_files=index_files,
-        )
+        """
+        Runs one compaction, returns the ids of the SSTables written or None if there was nothing to compact
+        """
+        with self._lock:
+            snapshot = manifest.snapshot()
+            task = self.strategy.pick(list(snapshot.sstables))
+            if task is None:
+                return None
+            logger.info("Compacting {} into level {}, manifest version {}", task.file_ids, task.output_level, snapshot.version)
+            index_files = [f"{self.data_dir}/{file_id}.index" for file_id in task.file_ids]
+            return self.create_compacted_files(
+                index_files=index_files,
+                drop_tombstones=task.drop_tombstones,
+                output_level=task.output_level,
+                max_file_bytes=task.max_file_bytes,
+            )
 
-    def prepare_data(self, index_files, key_offset_map, file_key_map):
+    def read_sstable(self, index_file):
         """
-        This function iterates through the index files and identify the keys that are
-        eligible for compaction, which includes updates and deletes
-
-        index_files: List of index files
-        deleted_keys: List of deleted keys
-        key_offset_map: Map of keys that needs to be compacted and the corresponding
-            offset in data file
-        file_key_map: Map of data files and the associated keys that needs to be read
+        Yields the records of an SSTable in key order. Files with a sparse index are key ordered and
+        streamed block by block, older files are read in the order of their dense index
         """
-        deleted_keys = set()
+        data_file_name = f"{index_file.split('.')[0]}.data"
+        with open(data_file_name, "rb") as fp_data_file:
+            version, _ = read_header(fp_data_file)
+            if version >= FOOTER_VERSION:
+                for record, _, _ in iter_records(fp_data_file):
+                    yield record
+                return
+            index_data = load_dense_index(index_file)
+            for key in sorted(index_data):
+                yield read_record(fp_data_file, index_data[key]["start"], index_data[key]["end"], version)
+
+    def merge(self, index_files, drop_tombstones: bool):
+        """
+        k-way merge of the SSTables, yields the newest record of every key in key order
+
+        index_files: List of index files, newest first
+        drop_tombstones: Drop deleted keys instead of carrying the delete marker over, only safe when
+            no SSTable older than index_files can still hold the key
+        """
+        for record in merge_newest([self.read_sstable(index_file) for index_file in index_files]):
+            if record.deleted and drop_tombstones:
+                continue
+            yield record
+
+    def estimate_keys(self, index_files) -> int:
+        """
+        Upper bound of the number of keys in the SSTables, to size the bloom filter of the output
+        """
+        capacity = 0
         for index_file in index_files:
-            logger.info("Working on file: {}", index_file)
-            with open(index_file, "r") as f_index_file:
-                index_data = json.load(f_index_file)
-                for key in index_data:
-                    logger.info("Working on key: {}, for file: {}", key, f_index_file)
-                    # Key might have marked as deleted from prev index files
-                    if key in deleted_keys:
-                        continue
-                    # Check for deletes
-                    if bool(index_data[key]["deleted"]):
-                        logger.info(
-                            "Key:{} in file: {} is marked as deleted", key, index_file
-                        )
-                        deleted_keys.add(key)
-                    # Check for updates first
-                    elif key in key_offset_map:
-                        if (
-                            key_offset_map[key]["timestamp"]
-                            < index_data[key]["timestamp"]
-                        ):
-                            logger.info("Updated value for key: {} is available", key)
-                            key_offset_map[key] = index_data[key]
-                    else:
-                        key_offset_map[key] = index_data[key]
-                        file_key_map[f"{index_file.split('.')[0]}.data"].add(key)
-                        logger.info("Added key: {} from file: {}", key, index_file)
-
-        # One more pass to get rid of deleted keys from the file
-        for deleted_key in deleted_keys:
-            if deleted_key in key_offset_map:
-                key_offset_map.pop(deleted_key)
-                logger.info("The key:{} has been removed as it is deleted", deleted_key)
-        logger.info("Total number of keys that will be deleted:{}", len(deleted_keys))
-
-    def create_compacted_files(self, file_key_map, key_offset_map, index_files):
+            bloom_filter = bloom_filter_cache.get(f"{index_file.split('.')[0]}.bloom")
+            if bloom_filter is not None:
+                capacity += bloom_filter.capacity()
+            else:
+                capacity += len(load_dense_index(index_file))
+        return capacity
+
+    def create_compacted_files(
+        self, index_files, drop_tombstones: bool = True, output_level: int = 0, max_file_bytes: int = None
+    ):
         """
-        This function is responsible for reading the keys that are marked for compaction and
-        write data to both index and data file
+        This function is responsible for merging the SSTables and writing the compacted data, index
+        and bloom filter files, then swapping them in for the SSTables they replace
 
-        file_key_map: Map of data files and corresponding keys that needs to read
-        key_offset_map: Map of keys and start and end bytes for their data in the data file
-        index_files: List of index files that needs to be processed
+        index_files: List of index files that needs to be processed, in read order
+        drop_tombstones: Drop deleted keys, see merge
+        output_level: Level of the compacted SSTables in the manifest
+        max_file_bytes: Start a new SSTable once the current one reaches this size, None writes one SSTable
         """
-        # Now iterating through the map and creating a combined SSTable data file
-        file_id = int(time.time())
-        compacted_data_file = f"{self.data_dir}/{file_id}c.data"
-        compacted_index_file = f"{self.data_dir}/{file_id}c.index"
-        c_start_byte = 0
-        c_end_byte = 0
-        compacted_index_data = dict()
-
-        with open(compacted_data_file, "wb") as fp_compacted_data_file:
-            for data_file_name, keys in file_key_map.items():
-                logger.info("Iterating through data file: {}", data_file_name)
-                with open(data_file_name, "rb") as fp_data_file:
-                    for key in keys:
-                        start_offset = fp_data_file.seek(key_offset_map[key]["start"])
-                        end_offset = fp_data_file.seek(key_offset_map[key]["end"])
-                        fp_data_file.seek(start_offset)
-                        data_bytes = fp_data_file.read(end_offset - start_offset)
-                        c_end_byte += len(data_bytes)
-                        fp_compacted_data_file.write(data_bytes)
-                        compacted_index_data[key] = {
+        bytes_read = sum(
+            os.path.getsize(f"{index_file.split('.')[0]}.data") for index_file in index_files
+        )
+        key_estimate = self.estimate_keys(index_files)
+        if max_file_bytes:
+            # Every output holds its share of the keys, with room for uneven splits
+            key_estimate = min(key_estimate, 2 * math.ceil(key_estimate * max_file_bytes / max(bytes_read, 1)))
+
+        file_ids, metadata = [], {}
+        records = self.merge(index_files, drop_tombstones)
+        record = next(records, None)
+        while record is not None:
+            file_id = manifest.next_file_id(compacted=True)
+            compacted_data_file = f"{self.data_dir}/{file_id}.data"
+            compacted_index_file = f"{self.data_dir}/{file_id}.index"
+            compacted_bloom_file = f"{self.data_dir}/{file_id}.bloom"
+            compacted_index_data = dict()
+            bloom_filter = BloomFilter.for_capacity(key_estimate)
+
+            with SSTableWriter(compacted_data_file) as writer:
+                while record is not None and (
+                    not max_file_bytes or writer.num_records == 0 or writer.size < max_file_bytes
+                ):
+                    c_start_byte, c_end_byte = writer.add(record.key, record.value, record.timestamp, record.deleted)
+                    if settings.sstable.indexMode == "dense":
+                        compacted_index_data[record.key] = {
                             "start": c_start_byte,
                             "end": c_end_byte,
-                            "timestamp": key_offset_map[key]["timestamp"],
-                            "deleted": key_offset_map[key]["deleted"],
+                            "timestamp": record.timestamp,
+                            "deleted": record.deleted,
                         }
-                        c_start_byte = c_end_byte
-        # list of data files
-        data_files = file_key_map.keys()
-
-        with open(compacted_index_file, "w") as fp_compacted_index_file:
+                    bloom_filter.add(record.key)
+                    record = next(records, None)
             logger.info("Writing index data to file: {}", compacted_index_file)
-            json.dump(compacted_index_data, fp_compacted_index_file)
-            logger.info(
-                f"Moving {len(data_files)} data files and {len(index_files)} index files to backup"
+            write_index(compacted_index_file, compacted_index_data, writer.sparse_index)
+            bloom_filter.save(compacted_bloom_file)
+            bloom_filter_cache.put(compacted_bloom_file, bloom_filter)
+            file_ids.append(file_id)
+            metadata[file_id] = writer.metadata(output_level)
+
+        # The compacted SSTables are complete, swap them in for the retired ones before moving them
+        try:
+            manifest.replace(
+                [os.path.basename(index_file).split(".")[0] for index_file in index_files], file_ids, metadata
             )
-            for index_file, data_file in index_files, data_files:
-                logger.info(f"Renaming {index_file} and {data_file}")
-                os.rename(index_file, f"{index_file}.backup")
-                os.rename(data_file, f"{data_file}.backup")
+        except StaleSnapshotException:
+            self.retire([f"{self.data_dir}/{file_id}.index" for file_id in file_ids])
+            raise
+        self.retire(index_files)
 
+        bytes_written = sum(sstable["size"] for sstable in metadata.values())
+        compaction_bytes_read.labels(level=output_level).set(bytes_read)
+        compaction_bytes_written.labels(level=output_level).set(bytes_written)
+        record_bytes_written("compaction", bytes_written)
         logger.info(
-            "Compaction Summary -> # of files compacted: {}, # of keys written: {}",
-            len(file_key_map),
-            len(compacted_index_data),
+            "Compaction Summary -> # of files compacted: {}, # of files written: {}, bytes read: {}, bytes written: {}",
+            len(index_files),
+            len(file_ids),
+            bytes_read,
+            bytes_written,
         )
+        return file_ids
+
+    def retire(self, index_files):
+        logger.info(f"Moving {len(index_files)} index and data files to backup")
+        for index_file in index_files:
+            data_file = f"{index_file.split('.')[0]}.data"
+            bloom_file = f"{index_file.split('.')[0]}.bloom"
+            logger.debug("Renaming {} and {}", index_file, data_file)
+            try:
+                os.rename(index_file, f"{index_file}.backup")
+            except FileNotFoundError:
+                # SSTables written in the sparse index mode have no index file
+                pass
+            os.rename(data_file, f"{data_file}.backup")
+            mapped_files.retire(data_file)
+            index_cache.invalidate(index_file)
+            bloom_filter_cache.invalidate(bloom_file)
+            # Bloom filters are rebuilt from the data, no need to back them up
+            if os.path.exists(bloom_file):
+                os.remove(bloom_file)
@@ -8,4 +8,31 @@ class UnauthorizedRequestException(Exception):
     """
     The exception to be thrown when a request hits the follower directly
     """
-    pass
\ No newline at end of file
+    pass
+
+class StaleSnapshotException(Exception):
+    """
+    The exception to be thrown when compaction swaps out SSTables that are no longer in the manifest
+    """
+    pass
+
+
+class WriteStallException(Exception):
+    """
+    The exception to be thrown when writes are rejected because too many MemTables are waiting to be flushed
+    """
+    pass
+
+
+class StaleRingException(Exception):
+    """
+    The exception to be thrown when a request is routed with a hash ring the data node no longer agrees with
+    """
+    pass
+
+
+class QuorumException(Exception):
+    """
+    The exception to be thrown when fewer replicas than the read or write quorum answered a request
+    """
+    pass
@@ -0,0 +1,99 @@
+from dataclasses import dataclass, field
+from loguru import logger
+from config import settings
+import hashlib
+import math
+import os
+import struct
+
+# num_bits, num_hashes
+HEADER = struct.Struct(">II")
+
+
+@dataclass
+class BloomFilter:
+    """
+    Bloom filter written next to every SSTable (<file>.bloom), it answers "definitely not present"
+    for keys that were never written to the SSTable so reads can skip its index and data file
+    """
+
+    num_bits: int
+    num_hashes: int
+    bits: bytearray = field(default=None, repr=False)
+
+    def __post_init__(self):
+        if self.bits is None:
+            self.bits = bytearray((self.num_bits + 7) // 8)
+
+    @classmethod
+    def for_capacity(cls, capacity: int, false_positive_rate: float = settings.bloomFilter.falsePositiveRate):
+        """
+        Sizes the filter for capacity keys at the requested false positive rate
+        """
+        capacity = max(capacity, 1)
+        num_bits = max(8, int(math.ceil(-capacity * math.log(false_positive_rate) / (math.log(2) ** 2))))
+        num_hashes = max(1, int(round(num_bits / capacity * math.log(2))))
+        return cls(num_bits=num_bits, num_hashes=num_hashes)
+
+    def capacity(self, false_positive_rate: float = settings.bloomFilter.falsePositiveRate) -> int:
+        """
+        Number of keys the filter was sized for, the inverse of for_capacity
+        """
+        return int(math.ceil(self.num_bits * (math.log(2) ** 2) / -math.log(false_positive_rate)))
+
+    def _positions(self, key: str):
+        # Double hashing, derive all the positions from the two halves of one digest
+        digest = hashlib.md5(key.encode()).digest()
+        h1, h2 = struct.unpack(">QQ", digest)
+        for i in range(self.num_hashes):
+            yield (h1 + i * h2) % self.num_bits
+
+    def add(self, key: str):
+        for position in self._positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def might_contain(self, key: str) -> bool:
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(key))
+
+    def to_bytes(self) -> bytes:
+        return HEADER.pack(self.num_bits, self.num_hashes) + bytes(self.bits)
+
+    @classmethod
+    def from_bytes(cls, data: bytes):
+        """
+        Raises ValueError for a truncated or corrupt filter
+        """
+        if len(data) < HEADER.size:
+            raise ValueError(f"Bloom filter of {len(data)} bytes is shorter than its header")
+        num_bits, num_hashes = HEADER.unpack_from(data)
+        bits = bytearray(data[HEADER.size :])
+        if num_bits == 0 or num_hashes == 0 or len(bits) != (num_bits + 7) // 8:
+            raise ValueError(f"Bloom filter of {num_bits} bits holds {len(bits)} bytes")
+        return cls(num_bits=num_bits, num_hashes=num_hashes, bits=bits)
+
+    def save(self, bloom_file):
+        """
+        Written then renamed like the MANIFEST, the filter is durable once its SSTable is registered
+        """
+        tmp_file = f"{bloom_file}.tmp"
+        with open(tmp_file, "wb") as fp_bloom_file:
+            fp_bloom_file.write(self.to_bytes())
+            fp_bloom_file.flush()
+            os.fsync(fp_bloom_file.fileno())
+        os.replace(tmp_file, bloom_file)
+
+    @classmethod
+    def load(cls, bloom_file):
+        """
+        Returns None for SSTables written before bloom filters existed and for corrupt filters,
+        they are always searched
+        """
+        if not os.path.exists(bloom_file):
+            logger.debug("No bloom filter found at {}", bloom_file)
+            return None
+        with open(bloom_file, "rb") as fp_bloom_file:
+            try:
+                return cls.from_bytes(fp_bloom_file.read())
+            except ValueError as e:
+                logger.warning("Ignoring the bloom filter at {}: {}", bloom_file, e)
+                return None
@@ -0,0 +1,75 @@
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from loguru import logger
+from config import settings
+from lsmt.bloom_filter import BloomFilter
+from lsmt.mapped_file import mapped_files
+from lsmt.sstable_format import load_sparse_index
+from typing import Callable
+import json
+import threading
+
+
+def load_index(index_file):
+    """
+    Loads the dense index file of an SSTable, SSTables written in the sparse index mode have no
+    index file and their sparse index is read from the footer of the data file instead
+    """
+    try:
+        with open(index_file, "r") as fp_index_file:
+            return json.load(fp_index_file)
+    except FileNotFoundError:
+        with mapped_files.acquire(str(index_file).split(".")[0] + ".data") as (_, buffer):
+            return load_sparse_index(buffer)
+
+
+@dataclass
+class IndexCache:
+    """
+    Bounded in-memory cache of SSTable indexes, dense or sparse, keyed by index file name.
+    1. Indexes are loaded once, when a MemTable is flushed, a compaction completes or the node starts
+    2. Once more than max_entries indexes are resident, the least recently used one is evicted
+    3. Compaction invalidates the indexes of the files it retires
+    The same structure keeps the bloom filters resident, using a different loader
+    """
+
+    max_entries: int = settings.sstable.indexCacheSize
+    loader: Callable = load_index
+    _indexes: OrderedDict = field(default_factory=OrderedDict)
+    _lock: threading.Lock = field(default_factory=threading.Lock)
+
+    def get(self, index_file) -> dict:
+        """
+        Returns the index for index_file, reading it from disk only if it is not resident
+        """
+        with self._lock:
+            if index_file in self._indexes:
+                self._indexes.move_to_end(index_file)
+                return self._indexes[index_file]
+        logger.debug("{} is not cached, loading it from disk", index_file)
+        index_data = self.loader(index_file)
+        self.put(index_file, index_data)
+        return index_data
+
+    def put(self, index_file, index_data: dict):
+        with self._lock:
+            self._indexes[index_file] = index_data
+            self._indexes.move_to_end(index_file)
+            while len(self._indexes) > self.max_entries:
+                evicted, _ = self._indexes.popitem(last=False)
+                logger.debug("Evicted index for {} from the cache", evicted)
+
+    def invalidate(self, index_file):
+        with self._lock:
+            self._indexes.pop(index_file, None)
+
+    def __contains__(self, index_file) -> bool:
+        return index_file in self._indexes
+
+    def __len__(self) -> int:
+        return len(self._indexes)
+
+
+# Shared by the flush, compaction and read paths of this node
+index_cache = IndexCache()
+bloom_filter_cache = IndexCache(max_entries=settings.bloomFilter.cacheSize, loader=BloomFilter.load)
@@ -0,0 +1,197 @@
+from dataclasses import dataclass, field
+from loguru import logger
+from config import settings
+from exception.exceptions import StaleSnapshotException
+import glob
+import json
+import os
+import re
+import threading
+
+MANIFEST_FILE = "MANIFEST"
+
+
+def file_id_sort_key(file_id: str):
+    """
+    Orders file ids by generation, compacted outputs (*c) of the same generation sort after
+    """
+    generation, compacted = re.match(r"(\d+)(c?)$", file_id).groups()
+    return int(generation), compacted == "c"
+
+
+@dataclass(frozen=True)
+class ManifestSnapshot:
+    """
+    The live SSTables at one version of the manifest, in read order. Compaction plans against a
+    snapshot while flushes keep adding SSTables, reads retry on a newer one if compaction retired
+    an SSTable under them
+    """
+
+    version: int
+    data_dir: str
+    sstables: tuple
+
+    def file_ids(self) -> list:
+        return [sstable["file_id"] for sstable in self.sstables]
+
+    def index_files(self) -> list:
+        return [f"{self.data_dir}/{file_id}.index" for file_id in self.file_ids()]
+
+
+@dataclass
+class Manifest:
+    """
+    Ordered list of the live SSTables of this node, newest first, persisted as MANIFEST in the
+    data directory. It is the only source of truth for the read path and compaction:
+    1. A MemTable flush allocates the next generation and registers its SSTable at the head
+    2. Compaction replaces the SSTables it retired with its output, at the position of the
+       newest retired SSTable, so everything flushed after them still shadows the output
+    3. Data directories that predate the MANIFEST are ordered by the numeric prefix of the file names
+    Every SSTable also carries its level, key range and size for the compaction strategies. Reads
+    walk the levels in order, level 0 newest first, since compaction only moves data downwards
+    """
+
+    data_dir: str = settings.dataDirectory
+    _file_ids: list = field(default_factory=list)
+    _metadata: dict = field(default_factory=dict)
+    _next_generation: int = 0
+    # Bumped on every change, tells readers their snapshot is outdated
+    version: int = 0
+    _loaded: bool = False
+    _lock: threading.RLock = field(default_factory=threading.RLock)
+
+    @property
+    def manifest_file(self) -> str:
+        return f"{self.data_dir}/{MANIFEST_FILE}"
+
+    def load(self):
+        with self._lock:
+            if os.path.exists(self.manifest_file):
+                with open(self.manifest_file, "r") as fp_manifest_file:
+                    manifest_data = json.load(fp_manifest_file)
+                self._file_ids = manifest_data["sstables"]
+                # Manifests written before the compaction strategies have no metadata
+                self._metadata = manifest_data.get("metadata", {})
+                self._next_generation = manifest_data["next_generation"]
+            else:
+                file_ids = [
+                    os.path.basename(index_file).split(".")[0]
+                    for index_file in glob.glob(f"{self.data_dir}/*.index")
+                ]
+                file_ids = [file_id for file_id in file_ids if re.match(r"\d+c?$", file_id)]
+                self._file_ids = sorted(file_ids, key=file_id_sort_key, reverse=True)
+                self._next_generation = (
+                    max(file_id_sort_key(file_id)[0] for file_id in self._file_ids) + 1
+                    if self._file_ids
+                    else 0
+                )
+                logger.info("No manifest found, recovered {} SSTables from {}", len(self._file_ids), self.data_dir)
+            self._loaded = True
+            self.version += 1
+
+    def _ensure_loaded(self):
+        if not self._loaded:
+            self.load()
+
+    def _persist(self):
+        # Write then rename, a crash never leaves a half written manifest behind
+        tmp_file = f"{self.manifest_file}.tmp"
+        with open(tmp_file, "w") as fp_manifest_file:
+            json.dump(
+                {"next_generation": self._next_generation, "sstables": self._file_ids, "metadata": self._metadata},
+                fp_manifest_file,
+            )
+            fp_manifest_file.flush()
+            os.fsync(fp_manifest_file.fileno())
+        os.replace(tmp_file, self.manifest_file)
+
+    def next_file_id(self, compacted: bool = False) -> str:
+        with self._lock:
+            self._ensure_loaded()
+            file_id = f"{self._next_generation:010d}{'c' if compacted else ''}"
+            self._next_generation += 1
+            return file_id
+
+    def add(self, file_id: str, metadata: dict = None):
+        """
+        metadata: level, min_key, max_key and size of the SSTable, a flush always lands in level 0
+        """
+        with self._lock:
+            self._ensure_loaded()
+            self._file_ids.insert(0, file_id)
+            self._metadata[file_id] = metadata or {"level": 0}
+            self._persist()
+            self.version += 1
+            logger.info("Registered SSTable {} in the manifest", file_id)
+
+    def replace(self, retired_file_ids: list, file_ids: list, metadata: dict = None):
+        """
+        Swaps the output of a compaction in for the SSTables it retired, file_ids may be empty when
+        every record of the inputs was a dropped tombstone. The swap is atomic, raises
+        StaleSnapshotException without changing anything if a retired SSTable is no longer live
+
+        metadata: Metadata of the new SSTables keyed by file id
+        """
+        with self._lock:
+            self._ensure_loaded()
+            missing = [retired for retired in retired_file_ids if retired not in self._file_ids]
+            if missing:
+                raise StaleSnapshotException(f"SSTables {missing} are no longer in the manifest")
+            positions = [self._file_ids.index(retired) for retired in retired_file_ids if retired in self._file_ids]
+            position = min(positions) if positions else len(self._file_ids)
+            self._file_ids = [file for file in self._file_ids if file not in retired_file_ids]
+            position = min(position, len(self._file_ids))
+            self._file_ids[position:position] = file_ids
+            for retired in retired_file_ids:
+                self._metadata.pop(retired, None)
+            for file_id in file_ids:
+                self._metadata[file_id] = (metadata or {}).get(file_id, {"level": 0})
+            self._persist()
+            self.version += 1
+            logger.info("Replaced SSTables {} with {} in the manifest", retired_file_ids, file_ids)
+
+    def snapshot(self) -> ManifestSnapshot:
+        with self._lock:
+            return ManifestSnapshot(version=self.version, data_dir=self.data_dir, sstables=tuple(self.sstables()))
+
+    def sstables(self) -> list:
+        """
+        Snapshot of the live SSTables in read order, each a dict of file_id, level, min_key, max_key
+        and size. Unknown key ranges are None and mean the SSTable may hold any key
+        """
+        with self._lock:
+            self._ensure_loaded()
+            sstables = []
+            for file_id in self._file_ids:
+                metadata = self._metadata.get(file_id, {})
+                size = metadata.get("size")
+                if size is None:
+                    try:
+                        size = os.path.getsize(f"{self.data_dir}/{file_id}.data")
+                    except OSError:
+                        size = 0
+                sstables.append({
+                    "file_id": file_id,
+                    "level": metadata.get("level", 0),
+                    "min_key": metadata.get("min_key"),
+                    "max_key": metadata.get("max_key"),
+                    "size": size,
+                })
+            # Stable sort, level 0 keeps its newest first order
+            return sorted(sstables, key=lambda sstable: sstable["level"])
+
+    def file_ids(self) -> list:
+        """
+        Snapshot of the live SSTable ids in read order, level by level and newest first in level 0
+        """
+        with self._lock:
+            self._ensure_loaded()
+            levels = {file_id: self._metadata.get(file_id, {}).get("level", 0) for file_id in self._file_ids}
+            return sorted(self._file_ids, key=lambda file_id: levels[file_id])
+
+    def index_files(self) -> list:
+        return [f"{self.data_dir}/{file_id}.index" for file_id in self.file_ids()]
+
+
+# Shared by the flush, compaction and read paths of this node
+manifest = Manifest()
@@ -0,0 +1,92 @@
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from loguru import logger
+from lsmt.sstable_format import parse_header
+import mmap
+import os
+import threading
+
+
+@dataclass
+class MappedDataFile:
+    """
+    A data file opened once and memory mapped, reads slice the map instead of seeking and copying.
+    A retired file is unmapped once its last reader is done with it
+    """
+
+    data_file: str
+    version: int = 0
+    _file: object = field(default=None, repr=False)
+    _map: object = field(default=None, repr=False)
+    _readers: int = 0
+    _retired: bool = False
+
+    @classmethod
+    def open(cls, data_file):
+        fp_data_file = open(data_file, "rb")
+        # Empty files can not be mapped, they have nothing to read anyway
+        if os.fstat(fp_data_file.fileno()).st_size == 0:
+            return cls(data_file=data_file, _file=fp_data_file, _map=b"")
+        data_map = mmap.mmap(fp_data_file.fileno(), 0, access=mmap.ACCESS_READ)
+        version, _ = parse_header(data_map)
+        logger.info("Memory mapped {}", data_file)
+        return cls(data_file=data_file, version=version, _file=fp_data_file, _map=data_map)
+
+    def close(self):
+        try:
+            if isinstance(self._map, mmap.mmap):
+                self._map.close()
+        except BufferError:
+            # A slice of the map is still referenced, the map goes away with the last slice
+            logger.warning("{} is still referenced, leaving the unmap to the garbage collector", self.data_file)
+        self._file.close()
+        logger.info("Closed {}", self.data_file)
+
+
+@dataclass
+class MappedFileRegistry:
+    """
+    The memory mapped data files of this node, keyed by data file name. Files are mapped on their
+    first read and unmapped when compaction retires them
+    """
+
+    _files: dict = field(default_factory=dict)
+    _lock: threading.Lock = field(default_factory=threading.Lock)
+
+    @contextmanager
+    def acquire(self, data_file):
+        """
+        Yields the mapped file and a memoryview over it, valid until the block exits
+        """
+        with self._lock:
+            mapped = self._files.get(data_file)
+            if mapped is None:
+                mapped = self._files[data_file] = MappedDataFile.open(data_file)
+            mapped._readers += 1
+        view = memoryview(mapped._map)
+        try:
+            yield mapped, view
+        finally:
+            view.release()
+            with self._lock:
+                mapped._readers -= 1
+                close = mapped._retired and mapped._readers == 0
+            if close:
+                mapped.close()
+
+    def retire(self, data_file):
+        with self._lock:
+            mapped = self._files.pop(data_file, None)
+            if mapped is None:
+                return
+            mapped._retired = True
+            close = mapped._readers == 0
+        if close:
+            mapped.close()
+
+    def __contains__(self, data_file) -> bool:
+        return data_file in self._files
+
+
+# Shared by the read path and compaction of this node
+mapped_files = MappedFileRegistry()
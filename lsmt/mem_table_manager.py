@@ -0,0 +1,234 @@
+from dataclasses import dataclass, field
+from loguru import logger
+from config import settings
+from lsmt.mem_table import MemTable, write_sstable
+from lsmt.wal import WriteAheadLog
+from utils.model import Data
+from exception.exceptions import NoDataFoundException, WriteStallException
+from prometheus_client import Counter
+from typing import Callable, Optional
+import threading
+import time
+
+# delayed: the write waited for a flush to make room, rejected: it gave up after memTable.stallTimeoutMs
+write_stalls = Counter("write_stalls", "Writes held back by pending MemTable flushes", labelnames=["result"])
+
+
+@dataclass
+class MemTableManager:
+    """
+    Owns the active MemTable and the immutable ones waiting to be flushed
+    1. Writes always go to the active MemTable
+    2. A flush atomically swaps the active MemTable for an empty one, the frozen MemTable
+       is written to an SSTable while writes keep landing in the new active one
+    3. Reads check the active MemTable, then the immutable ones newest first, a frozen
+       MemTable stays readable until its SSTable is registered in the manifest
+    4. Every write is appended to the WAL before it is applied, the WAL segments of a frozen
+       MemTable are removed once its SSTable is durable
+    5. A write that takes the active MemTable past memTable.maxBytes swaps it and wakes the flush
+       worker, writes stall while memTable.maxImmutable MemTables are waiting to be flushed
+    6. Data streamed in from other nodes is written straight to SSTables unless a MemTable holds
+       the key, see ingest
+    7. key_count follows the keys written without reading anything: a write counts when the key has
+       no live data in the active MemTable, a delete when it has. It is approximate, the SSTables
+       are not looked at, a key flushed then written again counts twice and a delete of a key that
+       is only in the SSTables does not count
+    """
+
+    active: MemTable = field(default_factory=MemTable)
+    immutables: list = field(default_factory=list)
+    wal: WriteAheadLog = field(default_factory=WriteAheadLog)
+    max_immutables: int = settings.memTable.maxImmutable
+    stall_timeout_ms: int = settings.memTable.stallTimeoutMs
+    key_count: int = 0
+    # Called after every flush, the Scheduler hooks compaction in here
+    on_flush: Optional[Callable] = None
+    _lock: threading.Lock = field(default_factory=threading.Lock, repr=False, compare=False)
+    _flush_lock: threading.RLock = field(default_factory=threading.RLock, repr=False, compare=False)
+    # Notified whenever a flush removes an immutable MemTable, stalled writers wait on it
+    _flushed: threading.Condition = field(default=None, repr=False, compare=False)
+    _flush_wakeup: threading.Event = field(default_factory=threading.Event, repr=False, compare=False)
+    _flusher: threading.Thread = field(default=None, repr=False, compare=False)
+
+    def __post_init__(self):
+        self._flushed = threading.Condition(self._lock)
+
+    def start(self):
+        """
+        Starts the flush worker, until then the MemTables are only flushed by explicit flush calls
+        """
+        if self._flusher is None:
+            self._flusher = threading.Thread(target=self._flush_on_wakeup, name="memtable-flush", daemon=True)
+            self._flusher.start()
+
+    def _flush_on_wakeup(self):
+        while True:
+            self._flush_wakeup.wait()
+            self._flush_wakeup.clear()
+            try:
+                self.flush_immutables()
+            except Exception:
+                logger.exception("MemTable flush failed, retrying on the next wakeup")
+
+    def add(self, data: Data):
+        # The WAL append and the MemTable update happen under the lock so a swap never separates them,
+        # waiting for the fsync happens outside of it so concurrent writers share a group commit
+        with self._lock:
+            self._wait_for_room()
+            sequence = self.wal.append(data)
+            self._track_wal_segment()
+            self._apply(data)
+            swapped = self.active.over_budget()
+            if swapped:
+                self._swap()
+        if swapped:
+            self._flush_wakeup.set()
+        self.wal.sync(sequence)
+        return data
+
+    def add_batch(self, batch: list):
+        """
+        Applies the records in one step, one WAL write and one sync for the whole batch
+        """
+        with self._lock:
+            self._wait_for_room()
+            sequence = self.wal.append_batch(batch)
+            self._track_wal_segment()
+            for data in batch:
+                self._apply(data)
+            swapped = self.active.over_budget()
+            if swapped:
+                self._swap()
+        if swapped:
+            self._flush_wakeup.set()
+        self.wal.sync(sequence)
+        return batch
+
+    def ingest(self, batch: list, is_newer: Callable) -> list:
+        """
+        Writes the data of the batch that is_newer than the version of this node to an SSTable of its
+        own, skipping the WAL and the MemTables, and returns it. Flushes wait meanwhile, no newer write
+        gets flushed between the check and the SSTable becoming the newest one.
+        The MemTables are read before any SSTable, an older version they hold would shadow the SSTable,
+        the keys they hold go through add_batch instead
+        """
+        with self._flush_lock:
+            newer = {data.key: data for data in batch if is_newer(data)}
+            in_memory = [newer.pop(key) for key in list(newer) if self._in_mem_tables(key)]
+            if newer:
+                write_sstable(((key, newer[key]) for key in sorted(newer)), len(newer), "ingest")
+                with self._lock:
+                    self.key_count += sum(not data.deleted for data in newer.values())
+        # Outside of the flush lock, a stalled write waits for the flush worker which takes it
+        if in_memory:
+            self.add_batch(in_memory)
+        return list(newer.values()) + in_memory
+
+    def _in_mem_tables(self, key) -> bool:
+        try:
+            self.get_data(key)
+            return True
+        except NoDataFoundException:
+            return False
+
+    def _apply(self, data: Data):
+        """
+        Adds the data to the active MemTable and counts the change of its live keys, called with the lock held
+        """
+        live_keys = self.active.live_keys
+        self.active.add(data)
+        self.key_count += self.active.live_keys - live_keys
+
+    def _wait_for_room(self):
+        """
+        Holds the write back while too many MemTables are waiting to be flushed, called with the lock held
+        """
+        if len(self.immutables) < self.max_immutables:
+            return
+        self._flush_wakeup.set()
+        deadline = time.monotonic() + self.stall_timeout_ms / 1000
+        while len(self.immutables) >= self.max_immutables:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                write_stalls.labels(result="rejected").inc()
+                raise WriteStallException(f"{len(self.immutables)} MemTables are waiting to be flushed")
+            self._flushed.wait(remaining)
+        write_stalls.labels(result="delayed").inc()
+
+    def _track_wal_segment(self):
+        if self.wal.segment_id is not None and self.wal.segment_id not in self.active.wal_segments:
+            self.active.wal_segments.append(self.wal.segment_id)
+
+    def recover(self):
+        """
+        Replays the WAL segments left behind by the previous run into the active MemTable
+        """
+        with self._lock:
+            for segment_id, records in self.wal.replay():
+                for data in records:
+                    self._apply(data)
+                self.active.wal_segments.append(segment_id)
+                logger.info("Replayed {} records from WAL segment {}", len(records), segment_id)
+
+    def get_data(self, key):
+        with self._lock:
+            mem_tables = [self.active] + self.immutables
+        for mem_table in mem_tables:
+            try:
+                return mem_table.get_data(key)
+            except NoDataFoundException:
+                continue
+        raise NoDataFoundException(f"No data found for: {key}")
+
+    def scan(self, start=None, end=None) -> list:
+        """
+        Iterators over the data with start <= key < end of every MemTable, newest first, each in key order.
+        The MemTables are taken before the SSTables are opened, a MemTable flushed meanwhile is then in both
+        """
+        with self._lock:
+            mem_tables = [self.active] + self.immutables
+        return [mem_table.get_range(start, end) for mem_table in mem_tables]
+
+    def get_length(self):
+        return self.active.get_length()
+
+    def can_flush(self) -> bool:
+        return self.active.can_flush()
+
+    def swap(self):
+        """
+        Freezes the active MemTable and replaces it with an empty one
+        """
+        with self._lock:
+            return self._swap()
+
+    def _swap(self):
+        frozen = self.active
+        self.wal.rotate()
+        self.active = MemTable()
+        self.immutables.insert(0, frozen)
+        logger.info("Swapped the active MemTable, {} MemTables pending flush", len(self.immutables))
+        return frozen
+
+    def flush(self):
+        """
+        Swaps the active MemTable and flushes every immutable MemTable, oldest first. A MemTable
+        that fails to flush stays readable and is retried by the next flush
+        """
+        with self._flush_lock:
+            if self.active.get_length() > 0:
+                self.swap()
+            self.flush_immutables()
+
+    def flush_immutables(self):
+        with self._flush_lock:
+            while self.immutables:
+                frozen = self.immutables[-1]
+                frozen.flush()
+                # The SSTable is registered, reads find the data there once the frozen MemTable is dropped
+                with self._lock:
+                    self.immutables = [mem_table for mem_table in self.immutables if mem_table is not frozen]
+                    self._flushed.notify_all()
+                self.wal.remove(frozen.wal_segments)
+                if self.on_flush is not None:
+                    self.on_flush()
@@ -0,0 +1,41 @@
+import heapq
+
+
+def _tag(source, position: int):
+    for item in source:
+        yield item.key, position, item
+
+
+def merge_newest(sources):
+    """
+    k-way merge of key ordered sources, yields the newest item of every key in key order. Holds one
+    item per source in memory
+
+    sources: Iterables of items with a key attribute, newest first
+    """
+    # The position of the source breaks ties between equal keys, the newest source comes first
+    streams = [_tag(source, position) for position, source in enumerate(sources)]
+    previous_key = None
+    for key, _, item in heapq.merge(*streams, key=lambda tagged: (tagged[0], tagged[1])):
+        if key == previous_key:
+            continue
+        previous_key = key
+        yield item
+
+
+def prefix_range(prefix: str):
+    """
+    Returns the start and end of the key range holding every key that starts with the prefix,
+    the end is None when no key sorts after the range
+    """
+    for position in range(len(prefix) - 1, -1, -1):
+        if ord(prefix[position]) < 0x10FFFF:
+            return prefix, prefix[:position] + chr(ord(prefix[position]) + 1)
+    return prefix, None
+
+
+def next_key(key: str) -> str:
+    """
+    The smallest key that sorts after the key, used as the start of the next page of a scan
+    """
+    return key + "\x00"
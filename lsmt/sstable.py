@@ -1,39 +1,185 @@
 from dataclasses import dataclass
 from loguru import logger
-import glob
-import json
-from utils.model import Data
 from config import settings
 from exception.exceptions import NoDataFoundException
+from lsmt.index_cache import index_cache, bloom_filter_cache
+from lsmt.manifest import manifest
+from lsmt.sstable_format import SparseIndex, decode_record_at, find_record, iter_range, iter_records
+from lsmt.mapped_file import mapped_files
+from prometheus_client import Counter, Gauge
+from contextlib import ExitStack, contextmanager
+import json
+import os
+
+# hit: the filter let the lookup through and the key was in the index
+# skip: the filter ruled the SSTable out, its index was never touched
+# false_positive: the filter let the lookup through but the key was not in the index
+bloom_filter_checks = Counter(
+    "bloom_filter_checks", "Bloom filter checks on the SSTable read path", labelnames=["result"]
+)
+
+# Bytes of SSTable data files written by MemTable flushes, by data streamed in by rebalancing and by
+# compaction, write amplification is every byte written over the bytes that entered the SSTables
+sstable_bytes_written = Counter(
+    "sstable_bytes_written", "Bytes of SSTable data files written", labelnames=["source"]
+)
+write_amplification = Gauge("write_amplification", "SSTable bytes written per byte flushed from the MemTables")
+_bytes_written = {"flush": 0, "ingest": 0, "compaction": 0}
+
+
+def record_bytes_written(source: str, num_bytes: int):
+    """
+    source: flush, ingest or compaction
+    """
+    sstable_bytes_written.labels(source=source).inc(num_bytes)
+    _bytes_written[source] += num_bytes
+    entered = _bytes_written["flush"] + _bytes_written["ingest"]
+    if entered:
+        write_amplification.set(sum(_bytes_written.values()) / entered)
+
+
+def write_index(index_file, index_data: dict, sparse_index: SparseIndex):
+    """
+    Persists and caches the index of a new SSTable as per sstable.indexMode. The sparse index
+    is already in the footer of the data file, only the dense mode writes an index file
+    """
+    if settings.sstable.indexMode == "dense":
+        with open(index_file, "w") as fp_index_file:
+            json.dump(index_data, fp_index_file)
+            fp_index_file.flush()
+            os.fsync(fp_index_file.fileno())
+        index_cache.put(index_file, index_data)
+    else:
+        index_cache.put(index_file, sparse_index)
+
+
+def load_dense_index(index_file) -> dict:
+    """
+    Returns every key of an SSTable with its offsets, from its index file in the dense mode or
+    by scanning its data file in the sparse mode
+    """
+    try:
+        with open(index_file, "r") as fp_index_file:
+            return json.load(fp_index_file)
+    except FileNotFoundError:
+        index_data = dict()
+        with open(str(index_file).split(".")[0] + ".data", "rb") as fp_data_file:
+            for record, start, end in iter_records(fp_data_file):
+                index_data[record.key] = {
+                    "start": start, "end": end, "timestamp": record.timestamp, "deleted": record.deleted
+                }
+        return index_data
 
 
 @dataclass
 class SSTable:
     data_dir = settings.dataDirectory
 
+    def load_indexes(self):
+        """
+        Warms the index and bloom filter caches with the SSTables already present on disk,
+        called at startup
+        """
+        manifest.load()
+        index_files = manifest.index_files()
+        for index_file in index_files[: bloom_filter_cache.max_entries]:
+            bloom_filter_cache.get(str(index_file).split(".")[0] + ".bloom")
+        for index_file in index_files[: index_cache.max_entries]:
+            index_cache.get(index_file)
+        logger.info("Loaded {} SSTable indexes in memory", len(index_cache))
+
     def get_data(self, key):
-        logger.info("Getting the data from SSTables for key: {}", key)
-        # Step 1: Get all the index files -- ending in *.index
-        for index_file in glob.glob(f"{self.data_dir}/*.index"):
-            logger.info("Reading file: {}", index_file)
-            with open(index_file, "r") as fp_index_file:
-                index_data = json.load(fp_index_file)
-                if key in index_data:
-                    logger.info("Found the {} in {}, starting at {} ending at {}", 
-                                key, index_file, index_data[key]["start"], index_data[key]["end"])
-                    data_file_name = str(index_file).split(".")[0] + ".data"
-                    return self.read_data_file(data_file_name, index_data[key]["start"], index_data[key]["end"])
+        logger.debug("Getting the data from SSTables for key: {}", key)
+        while True:
+            snapshot = manifest.snapshot()
+            try:
+                return self.search(key, snapshot.index_files())
+            except FileNotFoundError:
+                # Compaction retired an SSTable of the snapshot, its records are in the SSTables that replaced it
+                if manifest.version == snapshot.version:
+                    raise
+                logger.info("SSTables changed while reading {}, retrying on manifest version {}", key, manifest.version)
+
+    def search(self, key, index_files):
+        """
+        Looks the key up in the SSTables, index_files in read order
+        """
+        # Step 1: Walk the SSTables newest first, the first hit is the freshest value
+        for index_file in index_files:
+            # Step 2: Skip the SSTable if its bloom filter rules the key out
+            bloom_filter = bloom_filter_cache.get(str(index_file).split(".")[0] + ".bloom")
+            if bloom_filter is not None and not bloom_filter.might_contain(key):
+                bloom_filter_checks.labels(result="skip").inc()
+                continue
+            # Step 3: Look the key up in the resident index, only a cache miss touches the disk
+            index_data = index_cache.get(index_file)
+            data_file_name = str(index_file).split(".")[0] + ".data"
+            if isinstance(index_data, SparseIndex):
+                data = self.read_block(data_file_name, index_data, key)
+            elif key in index_data:
+                logger.debug("Found the {} in {}, starting at {} ending at {}", 
+                            key, index_file, index_data[key]["start"], index_data[key]["end"])
+                data = self.read_data_file(data_file_name, index_data[key]["start"], index_data[key]["end"])
+            else:
+                data = None
+            if data is None:
+                if bloom_filter is not None:
+                    bloom_filter_checks.labels(result="false_positive").inc()
+                continue
+            if bloom_filter is not None:
+                bloom_filter_checks.labels(result="hit").inc()
+            return data
         raise NoDataFoundException(f"Data with key: {key} does not exist")
     
 
-    def read_data_file(self, data_file, start_offset, end_offset):
-        with open(data_file, "rb") as fp_data_file:
-            fp_data_file.seek(start_offset)
-            data_bytes = fp_data_file.read(end_offset - start_offset)
-            logger.info("Read {}", data_bytes.decode())
-            data_split = data_bytes.decode().split(":")
-            return Data(key=data_split[0], value=data_split[1], timestamp=data_split[2], deleted=data_split[3])
+    @contextmanager
+    def open_range(self, start=None, end=None):
+        """
+        Yields one iterator of Data per SSTable of a manifest snapshot, in read order, over
+        start <= key < end. The data files stay mapped until the block exits even if compaction
+        retires them meanwhile, the iterators must be consumed inside the block
+        """
+        while True:
+            snapshot = manifest.snapshot()
+            with ExitStack() as stack:
+                try:
+                    sources = [self.open_sstable_range(stack, index_file, start, end) for index_file in snapshot.index_files()]
+                except FileNotFoundError:
+                    # Compaction retired an SSTable of the snapshot before it was mapped
+                    if manifest.version == snapshot.version:
+                        raise
+                    continue
+                yield sources
+                return
 
+    def open_sstable_range(self, stack: ExitStack, index_file, start, end):
+        index_data = index_cache.get(index_file)
+        data_file_name = str(index_file).split(".")[0] + ".data"
+        mapped, buffer = stack.enter_context(mapped_files.acquire(data_file_name))
+        if isinstance(index_data, SparseIndex):
+            return (record.to_data() for record in iter_range(buffer, index_data, start, end))
+        # Dense indexes are not ordered, the keys in the range are sorted first
+        keys = sorted(
+            key for key in index_data if (start is None or key >= start) and (end is None or key < end)
+        )
+        return (
+            decode_record_at(buffer, index_data[key]["start"], index_data[key]["end"], mapped.version).to_data()
+            for key in keys
+        )
 
-    
+    def read_data_file(self, data_file, start_offset, end_offset):
+        # The record is decoded straight from the memory map, its value is only copied to build the Data
+        with mapped_files.acquire(data_file) as (mapped, buffer):
+            return decode_record_at(buffer, start_offset, end_offset, mapped.version).to_data()
 
+    def read_block(self, data_file, sparse_index: SparseIndex, key):
+        """
+        Binary searches the sparse index for the block that can hold the key and scans it,
+        returns None if the key is not in the SSTable
+        """
+        block = sparse_index.find_block(key)
+        if block is None:
+            return None
+        with mapped_files.acquire(data_file) as (_, buffer):
+            record = find_record(buffer, block[0], block[1], key)
+            return record.to_data() if record is not None else None
@@ -0,0 +1,329 @@
+"""
+Binary layout of an SSTable data file, version 2
+
+    file header: magic (4 bytes), version (u8), flags (u8)
+    block:       length of the records (u32), crc32 of the records (u32, 0 when checksums are off), records
+    record:      key length (u32), value length (u32), timestamp (i64), deleted (bool), key, value
+    index block: one entry per data block, key length (u32), block offset (u64), block length (u32), first key
+    footer:      offset of the index block (u64), its length (u32), its crc32 (u32), magic (4 bytes)
+
+Blocks are roughly settings.sstable.blockSize bytes, records never span two blocks and are written in
+key order, so the sparse index in the footer locates the only block that can hold a key. Version 1 files
+have no index block and footer. Data files written before the binary format have no header, they hold
+colon joined records and are version 0
+"""
+from bisect import bisect_right
+from dataclasses import dataclass, field
+from config import settings
+from typing import NamedTuple
+from utils.model import Data
+import os
+import struct
+import zlib
+
+MAGIC = b"CCST"
+VERSION = 2
+LEGACY_VERSION = 0
+FOOTER_VERSION = 2
+FLAG_BLOCK_CHECKSUM = 1
+FILE_HEADER = struct.Struct(">4sBB")
+BLOCK_HEADER = struct.Struct(">II")
+RECORD_HEADER = struct.Struct(">IIq?")
+INDEX_ENTRY = struct.Struct(">IQI")
+FOOTER = struct.Struct(">QII4s")
+
+
+class Record(NamedTuple):
+    key: str
+    value: bytes
+    timestamp: int
+    deleted: bool
+
+    def to_data(self) -> Data:
+        return Data(key=self.key, value=bytes(self.value).decode(), timestamp=self.timestamp, deleted=self.deleted)
+
+
+def encode_record(key: str, value, timestamp: int, deleted: bool) -> bytes:
+    key_bytes = key.encode()
+    value_bytes = value.encode() if isinstance(value, str) else bytes(value)
+    return RECORD_HEADER.pack(len(key_bytes), len(value_bytes), int(timestamp), bool(deleted)) + key_bytes + value_bytes
+
+
+def decode_record(buffer, offset: int = 0):
+    """
+    Decodes the record starting at offset, returns the record and the offset of the next one
+    """
+    key_length, value_length, timestamp, deleted = RECORD_HEADER.unpack_from(buffer, offset)
+    key_start = offset + RECORD_HEADER.size
+    value_start = key_start + key_length
+    value_end = value_start + value_length
+    key = bytes(buffer[key_start:value_start]).decode()
+    return Record(key, buffer[value_start:value_end], timestamp, deleted), value_end
+
+
+def decode_legacy_record(data_bytes: bytes) -> Record:
+    parts = bytes(data_bytes).decode().split(":")
+    return Record(parts[0], ":".join(parts[1:-2]).encode(), int(parts[-2]), parts[-1] == "True")
+
+
+def parse_header(buffer):
+    """
+    Returns the version and flags of a data file from its first bytes
+    """
+    if len(buffer) < FILE_HEADER.size or bytes(buffer[: len(MAGIC)]) != MAGIC:
+        return LEGACY_VERSION, 0
+    _, version, flags = FILE_HEADER.unpack_from(buffer)
+    if version > VERSION:
+        raise ValueError(f"Unsupported SSTable format version {version}")
+    return version, flags
+
+
+def read_header(fp_data_file):
+    """
+    Returns the version and flags of an open data file
+    """
+    return parse_header(fp_data_file.read(FILE_HEADER.size))
+
+
+def decode_record_at(buffer, start_offset: int, end_offset: int, version: int) -> Record:
+    """
+    Decodes the record between the offsets of a buffer holding a whole data file, the value is
+    a slice of the buffer, no bytes are copied for memoryviews
+    """
+    if version == LEGACY_VERSION:
+        return decode_legacy_record(buffer[start_offset:end_offset])
+    record, _ = decode_record(buffer, start_offset)
+    return record
+
+
+def read_record(fp_data_file, start_offset: int, end_offset: int, version: int) -> Record:
+    fp_data_file.seek(start_offset)
+    data_bytes = fp_data_file.read(end_offset - start_offset)
+    return decode_record_at(data_bytes, 0, len(data_bytes), version)
+
+
+@dataclass
+class SparseIndex:
+    """
+    First key, offset and length of every data block of an SSTable, the key lookup is a binary
+    search over the first keys followed by a scan of a single block
+    """
+
+    first_keys: list = field(default_factory=list)
+    block_offsets: list = field(default_factory=list)
+    block_lengths: list = field(default_factory=list)
+
+    def add(self, first_key: str, block_offset: int, block_length: int):
+        self.first_keys.append(first_key)
+        self.block_offsets.append(block_offset)
+        self.block_lengths.append(block_length)
+
+    def find_block(self, key: str):
+        """
+        Returns the offset and length of the only block that can hold the key, None if the key
+        sorts before the first block
+        """
+        position = bisect_right(self.first_keys, key) - 1
+        if position < 0:
+            return None
+        return self.block_offsets[position], self.block_lengths[position]
+
+    def to_bytes(self) -> bytes:
+        entries = bytearray()
+        for first_key, block_offset, block_length in zip(self.first_keys, self.block_offsets, self.block_lengths):
+            key_bytes = first_key.encode()
+            entries += INDEX_ENTRY.pack(len(key_bytes), block_offset, block_length) + key_bytes
+        return bytes(entries)
+
+    @classmethod
+    def from_bytes(cls, buffer):
+        sparse_index = cls()
+        offset = 0
+        while offset < len(buffer):
+            key_length, block_offset, block_length = INDEX_ENTRY.unpack_from(buffer, offset)
+            key_start = offset + INDEX_ENTRY.size
+            sparse_index.add(bytes(buffer[key_start : key_start + key_length]).decode(), block_offset, block_length)
+            offset = key_start + key_length
+        return sparse_index
+
+
+def read_footer(buffer):
+    """
+    Returns the offset, length and crc32 of the index block of a whole data file, None for
+    files that predate the footer
+    """
+    version, _ = parse_header(buffer)
+    if version < FOOTER_VERSION:
+        return None
+    index_offset, index_length, index_checksum, magic = FOOTER.unpack_from(buffer, len(buffer) - FOOTER.size)
+    if magic != MAGIC:
+        raise ValueError("SSTable footer is corrupt")
+    return index_offset, index_length, index_checksum
+
+
+def load_sparse_index(buffer) -> SparseIndex:
+    """
+    Reads the sparse index of a whole data file, only the footer and the index block are touched
+    """
+    footer = read_footer(buffer)
+    if footer is None:
+        raise ValueError("SSTable predates the sparse index, it has a dense index file")
+    index_offset, index_length, index_checksum = footer
+    index_block = buffer[index_offset : index_offset + index_length]
+    if zlib.crc32(index_block) != index_checksum:
+        raise ValueError("SSTable index block is corrupt")
+    return SparseIndex.from_bytes(index_block)
+
+
+def find_record(buffer, block_offset: int, block_length: int, key: str):
+    """
+    Scans the block at block_offset of a whole data file for the key, records are key ordered
+    so the scan stops at the first greater key. Returns None if the key is not in the block
+    """
+    offset = block_offset + BLOCK_HEADER.size
+    end_offset = offset + block_length
+    while offset < end_offset:
+        record, next_offset = decode_record(buffer, offset)
+        if record.key == key:
+            return record
+        if record.key > key:
+            return None
+        offset = next_offset
+    return None
+
+
+def iter_range(buffer, sparse_index: SparseIndex, start: str = None, end: str = None):
+    """
+    Yields the records of a whole data file with start <= key < end, in key order. Only the blocks
+    that can hold the range are read, None leaves that side of the range open
+    """
+    first = 0 if start is None else max(bisect_right(sparse_index.first_keys, start) - 1, 0)
+    for position in range(first, len(sparse_index.first_keys)):
+        if end is not None and sparse_index.first_keys[position] >= end:
+            return
+        offset = sparse_index.block_offsets[position] + BLOCK_HEADER.size
+        end_offset = offset + sparse_index.block_lengths[position]
+        while offset < end_offset:
+            record, offset = decode_record(buffer, offset)
+            if start is not None and record.key < start:
+                continue
+            if end is not None and record.key >= end:
+                return
+            yield record
+
+
+def iter_blocks(fp_data_file):
+    """
+    Yields (offset of the first record, records) for every block of an open data file, verifying
+    the block checksums when the file has them
+    """
+    fp_data_file.seek(0)
+    version, flags = read_header(fp_data_file)
+    if version == LEGACY_VERSION:
+        raise ValueError(f"{fp_data_file.name} predates the block format, it can only be read through its index")
+    # Blocks end where the index block starts, or at the end of files without a footer
+    data_end = fp_data_file.seek(0, os.SEEK_END)
+    if version >= FOOTER_VERSION:
+        fp_data_file.seek(data_end - FOOTER.size)
+        data_end, _, _, _ = FOOTER.unpack(fp_data_file.read(FOOTER.size))
+    fp_data_file.seek(FILE_HEADER.size)
+    offset = FILE_HEADER.size
+    while offset < data_end:
+        block_header = fp_data_file.read(BLOCK_HEADER.size)
+        if len(block_header) < BLOCK_HEADER.size:
+            return
+        length, checksum = BLOCK_HEADER.unpack(block_header)
+        block = fp_data_file.read(length)
+        if flags & FLAG_BLOCK_CHECKSUM and zlib.crc32(block) != checksum:
+            raise ValueError(f"Block at offset {offset} of {fp_data_file.name} is corrupt")
+        yield offset + BLOCK_HEADER.size, block
+        offset += BLOCK_HEADER.size + length
+
+
+def iter_records(fp_data_file):
+    """
+    Yields (record, start offset, end offset) for every record of an open data file, in the order
+    they were written
+    """
+    for block_offset, block in iter_blocks(fp_data_file):
+        offset = 0
+        while offset < len(block):
+            record, next_offset = decode_record(block, offset)
+            yield record, block_offset + offset, block_offset + next_offset
+            offset = next_offset
+
+
+@dataclass
+class SSTableWriter:
+    """
+    Writes records to a new data file in blocks, used by MemTable flushes and compaction.
+    Records must be added in key order. add returns the start and end offset of the record so
+    the caller can build a dense index, the sparse index is written in the footer on close
+    """
+
+    data_file_name: str
+    block_size: int = settings.sstable.blockSize
+    block_checksum: bool = settings.sstable.blockChecksum
+    _file: object = field(default=None, init=False, repr=False)
+    _block: bytearray = field(default_factory=bytearray, init=False, repr=False)
+    _offset: int = field(default=0, init=False)
+    sparse_index: SparseIndex = field(default_factory=SparseIndex, init=False)
+    last_key: str = field(default=None, init=False)
+    num_records: int = field(default=0, init=False)
+
+    def __enter__(self):
+        flags = FLAG_BLOCK_CHECKSUM if self.block_checksum else 0
+        self._file = open(self.data_file_name, "wb")
+        self._file.write(FILE_HEADER.pack(MAGIC, VERSION, flags))
+        self._offset = FILE_HEADER.size
+        return self
+
+    def add(self, key: str, value, timestamp: int, deleted: bool):
+        record = encode_record(key, value, timestamp, deleted)
+        if not self._block:
+            self.sparse_index.add(key, self._offset, 0)
+        start_offset = self._offset + BLOCK_HEADER.size + len(self._block)
+        self._block += record
+        if len(self._block) >= self.block_size:
+            self._write_block()
+        self.last_key = key
+        self.num_records += 1
+        return start_offset, start_offset + len(record)
+
+    def _write_block(self):
+        if not self._block:
+            return
+        checksum = zlib.crc32(self._block) if self.block_checksum else 0
+        self._file.write(BLOCK_HEADER.pack(len(self._block), checksum) + bytes(self._block))
+        self.sparse_index.block_lengths[-1] = len(self._block)
+        self._offset += BLOCK_HEADER.size + len(self._block)
+        self._block = bytearray()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if exc_type is None:
+                self._write_block()
+                index_block = self.sparse_index.to_bytes()
+                self._file.write(index_block + FOOTER.pack(self._offset, len(index_block), zlib.crc32(index_block), MAGIC))
+                self._offset += len(index_block) + FOOTER.size
+                self._file.flush()
+                os.fsync(self._file.fileno())
+        finally:
+            self._file.close()
+
+    @property
+    def first_key(self):
+        return self.sparse_index.first_keys[0] if self.sparse_index.first_keys else None
+
+    @property
+    def size(self) -> int:
+        """
+        Bytes written so far, the size of the data file once the writer is closed
+        """
+        return self._offset + len(self._block)
+
+    def metadata(self, level: int = 0) -> dict:
+        """
+        Manifest metadata of the SSTable written
+        """
+        return {"level": level, "min_key": self.first_key, "max_key": self.last_key, "size": self.size}
@@ -0,0 +1,207 @@
+from dataclasses import dataclass, field
+from loguru import logger
+from config import settings
+from utils.model import Data
+from lsmt.sstable_format import encode_record as encode_data_record, decode_record
+import glob
+import os
+import struct
+import threading
+import time
+import zlib
+
+# length of the payload, crc32 of the payload, the payload is a record in the SSTable format
+RECORD_HEADER = struct.Struct(">II")
+
+
+def encode_record(data: Data) -> bytes:
+    payload = encode_data_record(data.key, data.value, data.timestamp, data.deleted)
+    return RECORD_HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+
+
+def decode_records(wal_bytes: bytes):
+    """
+    Yields the records of a WAL segment, stops at the first torn or corrupt record since
+    nothing after it was acknowledged
+    """
+    offset = 0
+    while offset + RECORD_HEADER.size <= len(wal_bytes):
+        length, checksum = RECORD_HEADER.unpack_from(wal_bytes, offset)
+        payload = wal_bytes[offset + RECORD_HEADER.size : offset + RECORD_HEADER.size + length]
+        if len(payload) < length or zlib.crc32(payload) != checksum:
+            logger.warning("Found a torn record at offset {}, ignoring the rest of the segment", offset)
+            return
+        record, _ = decode_record(payload)
+        yield record.to_data()
+        offset += RECORD_HEADER.size + length
+
+
+def split_records(buffer: bytes) -> tuple:
+    """
+    Splits records received over the network, in the WAL format, into the complete ones and the bytes
+    of the record still being received. Raises ValueError on a corrupt record
+    """
+    records, offset = [], 0
+    while offset + RECORD_HEADER.size <= len(buffer):
+        length, checksum = RECORD_HEADER.unpack_from(buffer, offset)
+        end = offset + RECORD_HEADER.size + length
+        if end > len(buffer):
+            break
+        payload = buffer[offset + RECORD_HEADER.size : end]
+        if zlib.crc32(payload) != checksum:
+            raise ValueError(f"Corrupt record at offset {offset}")
+        records.append(decode_record(payload)[0].to_data())
+        offset = end
+    return records, buffer[offset:]
+
+
+@dataclass
+class WriteAheadLog:
+    """
+    Append only log of every write, a write is appended before it is applied to the MemTable
+    and acknowledged. The log is split in segments, one or more per MemTable, a segment is
+    deleted once the MemTable holding its writes is flushed to an SSTable.
+
+    sync_mode controls when the log is fsynced
+    1. always: every write is fsynced before it is acknowledged
+    2. group: writers arriving within group_commit_window_ms share a single fsync
+    3. async: a background thread fsyncs every async_sync_interval_ms, writes are acknowledged
+       once they reach the OS
+    """
+
+    enabled: bool = settings.wal.enabled
+    wal_dir: str = f"{settings.dataDirectory}/wal"
+    sync_mode: str = settings.wal.syncMode
+    group_commit_window_ms: float = settings.wal.groupCommitWindowMs
+    async_sync_interval_ms: float = settings.wal.asyncSyncIntervalMs
+    segment_id: int = None
+    _file: object = field(default=None, repr=False)
+    _sequence: int = 0
+    _synced_sequence: int = 0
+    _syncing: bool = False
+    # Guards the segment file and the sequence number of the last appended record
+    _lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+    # Guards the sequence number of the last fsynced record
+    _synced: threading.Condition = field(default_factory=threading.Condition, repr=False)
+    # One fsync or segment rotation at a time
+    _sync_lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+    _sync_thread: threading.Thread = field(default=None, repr=False)
+
+    def segment_file(self, segment_id) -> str:
+        return f"{self.wal_dir}/{segment_id:010d}.wal"
+
+    def segment_ids(self) -> list:
+        return sorted(
+            int(os.path.basename(wal_file).split(".")[0]) for wal_file in glob.glob(f"{self.wal_dir}/*.wal")
+        )
+
+    def _open_segment(self):
+        os.makedirs(self.wal_dir, exist_ok=True)
+        # Segment ids only grow, even once older segments are removed
+        segment_ids = self.segment_ids() + ([self.segment_id] if self.segment_id is not None else [])
+        self.segment_id = max(segment_ids) + 1 if segment_ids else 0
+        self._file = open(self.segment_file(self.segment_id), "ab")
+        logger.info("Opened WAL segment {}", self.segment_file(self.segment_id))
+        if self.sync_mode == "async" and self._sync_thread is None:
+            self._sync_thread = threading.Thread(target=self._sync_periodically, name="wal-sync", daemon=True)
+            self._sync_thread.start()
+
+    def append(self, data: Data) -> int:
+        return self.append_batch([data])
+
+    def append_batch(self, batch: list) -> int:
+        """
+        Writes the records to the current segment and returns the sequence number to pass to
+        sync, callers are expected to hold off concurrent rotations
+        """
+        if not self.enabled:
+            return 0
+        records = b"".join(encode_record(data) for data in batch)
+        with self._lock:
+            if self._file is None:
+                self._open_segment()
+            self._file.write(records)
+            self._file.flush()
+            self._sequence += 1
+            return self._sequence
+
+    def sync(self, sequence: int):
+        """
+        Blocks until the record with the sequence number is durable, as per the sync mode
+        """
+        if not self.enabled or self.sync_mode == "async":
+            return
+        with self._synced:
+            while self._synced_sequence < sequence:
+                if not self._syncing:
+                    # Nobody is syncing, this writer leads the next group commit
+                    self._syncing = True
+                    break
+                self._synced.wait()
+            else:
+                return
+        try:
+            if self.sync_mode == "group":
+                # Give concurrent writers the window to join this fsync
+                time.sleep(self.group_commit_window_ms / 1000)
+            self._fsync()
+        finally:
+            with self._synced:
+                self._syncing = False
+                self._synced.notify_all()
+
+    def _fsync(self):
+        with self._sync_lock:
+            with self._lock:
+                if self._file is None:
+                    return
+                sequence = self._sequence
+                fd = self._file.fileno()
+            os.fsync(fd)
+            with self._synced:
+                self._synced_sequence = max(self._synced_sequence, sequence)
+                self._synced.notify_all()
+
+    def _sync_periodically(self):
+        while True:
+            time.sleep(self.async_sync_interval_ms / 1000)
+            try:
+                self._fsync()
+            except Exception as e:
+                logger.error("Error syncing the WAL: {}", str(e))
+
+    def rotate(self):
+        """
+        Seals the current segment, the next append opens a new one
+        """
+        if not self.enabled:
+            return
+        with self._sync_lock:
+            with self._lock:
+                if self._file is None:
+                    return
+                self._file.flush()
+                os.fsync(self._file.fileno())
+                self._file.close()
+                self._file = None
+                sequence = self._sequence
+            with self._synced:
+                self._synced_sequence = max(self._synced_sequence, sequence)
+                self._synced.notify_all()
+        logger.info("Sealed WAL segment {}", self.segment_file(self.segment_id))
+
+    def remove(self, segment_ids: list):
+        for segment_id in segment_ids:
+            if os.path.exists(self.segment_file(segment_id)):
+                os.remove(self.segment_file(segment_id))
+                logger.info("Removed WAL segment {}", self.segment_file(segment_id))
+
+    def replay(self):
+        """
+        Yields (segment id, records) for every segment on disk, oldest first
+        """
+        if not self.enabled:
+            return
+        for segment_id in self.segment_ids():
+            with open(self.segment_file(segment_id), "rb") as fp_wal_file:
+                yield segment_id, list(decode_records(fp_wal_file.read()))
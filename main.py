@@ -1,18 +1,41 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Query, Request
+from fastapi.concurrency import run_in_threadpool
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import StreamingResponse
+from contextlib import asynccontextmanager
 from server.server import Server
-from utils.model import Data, PartitionMapRequest
+from server.data_node_client import DataNodeClients
+from server.hot_key_cache import HotKeyCache
+from server.replication import merge_scan_pages, newest, quorum
+from utils.log_config import configure_logging, sample_request
+from utils.model import (
+    BatchAddRequest,
+    BatchGetRequest,
+    Data,
+    RebalanceStreamRequest,
+    RepairLeavesRequest,
+)
 from loguru import logger
 import uvicorn
 import random
 import socket
 from config import settings
-from exception.exceptions import NoDataFoundException, UnauthorizedRequestException
-import requests
+from exception.exceptions import (
+    NoDataFoundException,
+    QuorumException,
+    StaleRingException,
+    UnauthorizedRequestException,
+    WriteStallException,
+)
 import getopt, sys
 from setproctitle import setproctitle
 from prometheus_client import make_asgi_app
-from prometheus_client import Histogram, Counter
+from prometheus_client import Histogram
 import time
+import asyncio
+from collections import defaultdict
+import json
+from lsmt.scan import next_key, prefix_range
 
 
 setproctitle("CoreCache")
@@ -24,61 +47,174 @@ get_latency = Histogram(
 add_latency = Histogram(
     "add_latency", "End to end latency for ADD Operation", labelnames=["node"]
 )
+batch_latency = Histogram(
+    "batch_latency", "End to end latency for batch operations", labelnames=["node", "operation"]
+)
 del_latency = Histogram(
     "del_latency", "End to end latency for DEL Operation", labelnames=["node"]
 )
 
 server_instance = None
+data_node_clients = DataNodeClients()
+hot_key_cache = HotKeyCache()
 server_ip = settings.server.ip
 port_range = [settings.server.startPort, settings.server.endPort]
-app = FastAPI(debug=False)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    yield
+    await data_node_clients.close()
+
+
+app = FastAPI(debug=False, lifespan=lifespan)
+
+
+def is_local(data_node_host_port: str) -> bool:
+    return f"{server_instance._private_ip}:{server_instance._port}" == data_node_host_port
+
+
+def check_owner(key: str, ring_version: int):
+    """
+    Requests routed by a client with its copy of the ring are served only by the owner of the key,
+    anything else tells the client to fetch the ring again
+    """
+    if not server_instance.owns(key):
+        raise StaleRingException(
+            f"Not the owner of {key} in ring version {server_instance.get_ring()['version']}, "
+            f"request was routed with version {ring_version}"
+        )
+
+
+async def replicated_write(data: Data):
+    """
+    Sends the write to every replica of the key and returns once replication.writeQuorum of them
+    acknowledged it, the write still reaches the slower replicas. Joining nodes taking over the key get
+    the write as well, they do not count towards the quorum
+    """
+    replicas = server_instance.get_replica_nodes(data.key)
+    nodes = replicas + server_instance.get_pending_nodes(data.key)
+
+    async def write_replica(data_node_host_port):
+        if is_local(data_node_host_port):
+            # The WAL fsync blocks, keep it off the event loop
+            return await run_in_threadpool(server_instance.add_data, data)
+        return await forward_to_replica(
+            data_node_host_port, [data], "/add/", json=jsonable_encoder(data)
+        )
+
+    await quorum(
+        {node: write_replica(node) for node in nodes},
+        {data.key: replicas},
+        settings.replication.writeQuorum,
+    )
+
+
+async def forward_to_replica(data_node_host_port: str, batch: list, path: str, **kwargs):
+    """
+    Forwards a write to a replica, the writes of a replica that could not take them are kept as
+    hints and handed off once it is back
+    """
+    try:
+        return await data_node_clients.forward("POST", data_node_host_port, path, **kwargs)
+    except Exception:
+        await run_in_threadpool(server_instance.hinted_handoff.add, data_node_host_port, batch)
+        raise
+
+
+async def replicated_read(key: str, replicas: list) -> Data:
+    """
+    Reads the key from its replicas and returns the newest data once replication.readQuorum of them
+    answered. A delete is newer than the data it deleted, a replica that never got the key answers None
+    """
+
+    async def read_replica(data_node_host_port):
+        try:
+            if is_local(data_node_host_port):
+                return jsonable_encoder(
+                    await run_in_threadpool(server_instance.get_data, key, True)
+                )
+            return await data_node_clients.forward(
+                "GET", data_node_host_port, "/get/", params={"key": key, "include_deleted": True}
+            )
+        except NoDataFoundException:
+            return None
+
+    answers = await quorum(
+        {node: read_replica(node) for node in replicas},
+        {key: replicas},
+        settings.replication.readQuorum,
+    )
+    data = newest(answers.values())
+    if data is None or data["deleted"]:
+        raise NoDataFoundException(f"No data found for: {key}")
+    return Data(**data)
+
+
+@app.middleware("http")
+async def ring_version_header(request: Request, call_next):
+    # Lets clients notice a newer ring before they hit a stale route
+    response = await call_next(request)
+    if server_instance is not None:
+        response.headers["X-Ring-Version"] = str(server_instance.get_ring()["version"])
+    return response
+
+
+@app.middleware("http")
+async def sampled_request_log(request: Request, call_next):
+    if not sample_request():
+        return await call_next(request)
+    start_time = time.time()
+    response = await call_next(request)
+    latency_ms = (time.time() - start_time) * 1000
+    logger.bind(
+        method=request.method,
+        path=request.url.path,
+        status=response.status_code,
+        latency_ms=latency_ms,
+    ).info("{} {} {} in {:.2f}ms", request.method, request.url.path, response.status_code, latency_ms)
+    return response
+
+
+@app.get("/ring")
+async def ring():
+    return server_instance.get_ring()
 
 
 @app.post("/add/")
-def add(data: Data, token: str = None):
+async def add(data: Data, token: str = None, ring_version: int = None):
     try:
         start_time = time.time()
-        logger.info(f"Received request for add {data.key}")
-        if server_instance.check_if_leader():
-            data_node_host_port = server_instance.get_data_node(data.key)
-            if (
-                f"{server_instance._private_ip}:{server_instance._port}"
-                == data_node_host_port
-            ):
-
-                data_processed = server_instance.add_data(data)
-                nodes = server_instance.get_all_nodes()
-                ids = sorted([int(str(node).replace("n_", "")) for node in nodes])
-
-                req = requests.post(f"http://{data_node_host_port}/add?token=leader")
-                return
-            else:
-                req = requests.post(
-                    f"http://{data_node_host_port}/add?token=leader",
-                    json={
-                        "key": data.key,
-                        "value": data.value,
-                        "timestamp": data.timestamp,
-                        "deleted": data.deleted,
-                    },
-                )
-                if req.status_code != 200:
-                    raise HTTPException(f"{req.reason}")
-                return req.json()
-        elif token:
-            logger.info(f"Add data request from the leader for key: {data.key}")
-            return server_instance.add_data(data)
+        logger.debug("Received request for add {}", data.key)
+        # A replica write from a coordinator, served locally even on the leader, which may be a replica
+        if token:
+            logger.debug("Add data request from a coordinator for key: {}", data.key)
+            return await run_in_threadpool(server_instance.add_data, data)
+        elif server_instance.check_if_leader():
+            try:
+                return await replicated_write(data)
+            finally:
+                # Even a failed write may have reached some replicas
+                hot_key_cache.invalidate(data.key, data.timestamp)
+        elif ring_version is not None:
+            # Routed by a client, the owner coordinates the replication
+            check_owner(data.key, ring_version)
+            return await replicated_write(data)
         else:
             raise UnauthorizedRequestException(
-                f"ADD requests can only be sent to the leader"
+                "ADD requests can only be sent to the leader"
             )
-    except HTTPException as e:
+    except WriteStallException as e:
         raise HTTPException(
-            status_code=500, detail=f"Error adding the data due to {str(e)}"
+            status_code=429, detail=f"Too many writes, retry later: {str(e)}"
         )
+    except StaleRingException as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    except QuorumException as e:
+        raise HTTPException(status_code=503, detail=str(e))
     except Exception as ae:
         raise HTTPException(
-            status_code=500, detail=f"Error getting the data due to {str(ae)}"
+            status_code=500, detail=f"Error adding the data due to {str(ae)}"
         )
     finally:
         add_latency.labels(node=server_instance._private_ip).observe(
@@ -87,31 +223,38 @@ def add(data: Data, token: str = None):
 
 
 @app.get("/get/")
-def get(key: str, token: str = None):
+async def get(key: str, token: str = None, ring_version: int = None, include_deleted: bool = False):
     try:
         start_time = time.time()
-        logger.info(f"Received a request for retrieving data for key: {key}")
-        if server_instance.check_if_leader():
-            data_node_host_port = server_instance.get_data_node(key)
-            if (
-                f"{server_instance._private_ip}:{server_instance._port}"
-                == data_node_host_port
-            ):
-                return server_instance.get_data(key)
-            else:
-                req = requests.get(
-                    f"http://{data_node_host_port}/get?token=leader",
-                    params={"key": key},
-                )
-                if req.status_code != 200:
-                    raise HTTPException(f"{req.reason}")
-                return req.json()
-        elif token:
-            return server_instance.get_data(key)
+        logger.debug("Received a request for retrieving data for key: {}", key)
+        # A replica read keeps the deleted data, the coordinator needs it to tell a delete from a replica that missed the key
+        if token:
+            return await run_in_threadpool(server_instance.get_data, key, include_deleted)
+        elif server_instance.check_if_leader():
+            replicas = server_instance.get_replica_nodes(key)
+            # Only the keys the leader holds no replica of are cached, the others are read locally anyway.
+            # Writes routed by clients go straight to the owner and bypass the leader, such writes stay
+            # hidden until the entry expires after hotKeyCache.ttlSeconds
+            if any(is_local(node) for node in replicas):
+                return await replicated_read(key, replicas)
+            data = hot_key_cache.get(key)
+            if data is not None:
+                return data
+            generation = hot_key_cache.generation
+            data = await replicated_read(key, replicas)
+            hot_key_cache.fill(data, generation)
+            return data
+        elif ring_version is not None:
+            check_owner(key, ring_version)
+            return await replicated_read(key, server_instance.get_replica_nodes(key))
         else:
             raise UnauthorizedRequestException()
     except NoDataFoundException:
-        raise HTTPException(status_code=404, detail=f"No data found")
+        raise HTTPException(status_code=404, detail="No data found")
+    except StaleRingException as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    except QuorumException as e:
+        raise HTTPException(status_code=503, detail=str(e))
     except Exception as e:
         raise HTTPException(
             status_code=500, detail=f"Error getting the data due to {str(e)}"
@@ -123,29 +266,34 @@ def get(key: str, token: str = None):
 
 
 @app.post("/delete/")
-def delete(key: str, token: str = None):
+async def delete(key: str, token: str = None, ring_version: int = None):
     try:
         start_time = time.time()
-        logger.info(f"Received a request for deleting data for key: {key}")
-        if server_instance.check_if_leader():
-            data_node_host_port = server_instance.get_data_node(key)
-            if (
-                f"{server_instance._private_ip}:{server_instance._port}"
-                == data_node_host_port
-            ):
-                return server_instance.delete_data(key)
-            else:
-                req = requests.post(
-                    f"http://{data_node_host_port}/delete?token=leader",
-                    params={"key": key},
-                )
-                if req.status_code != 200:
-                    raise HTTPException(f"{req.reason}")
-                return req.json()
-        elif token:
-            return server_instance.delete_data(key)
+        logger.debug("Received a request for deleting data for key: {}", key)
+        # A delete is replicated as a write of the deleted key, replicas that never got the key record it as well
+        tombstone = Data(key=key, value="", deleted=True)
+        if token:
+            return await run_in_threadpool(server_instance.delete_data, key)
+        elif server_instance.check_if_leader():
+            try:
+                return await replicated_write(tombstone)
+            finally:
+                hot_key_cache.invalidate(key, tombstone.timestamp)
+        elif ring_version is not None:
+            check_owner(key, ring_version)
+            return await replicated_write(tombstone)
         else:
             raise UnauthorizedRequestException()
+    except NoDataFoundException:
+        raise HTTPException(status_code=404, detail="No data found")
+    except WriteStallException as e:
+        raise HTTPException(
+            status_code=429, detail=f"Too many writes, retry later: {str(e)}"
+        )
+    except StaleRingException as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    except QuorumException as e:
+        raise HTTPException(status_code=503, detail=str(e))
     except Exception as e:
         raise HTTPException(
             status_code=500, detail=f"Error deleting the data due to {str(e)}"
@@ -156,20 +304,293 @@ def delete(key: str, token: str = None):
         )
 
 
-@app.post("/update-partition-map/")
-def update_partition_map(request: PartitionMapRequest):
-    logger.info(
-        "Received request to update partition map for key: {} and node: {}",
-        request.key,
-        request.node_details,
-    )
+def group_by_replica(keys, pending: bool = False) -> tuple:
+    """
+    The replicas of every key, key -> host:ports, and the keys every data node holds a replica of,
+    host:port -> keys
+
+    pending: The keys joining nodes take over are grouped for them as well, for writes
+    """
+    replicas, groups = dict(), defaultdict(list)
+    for key in keys:
+        replicas[key] = server_instance.get_replica_nodes(key)
+        nodes = replicas[key] + server_instance.get_pending_nodes(key) if pending else replicas[key]
+        for node in nodes:
+            groups[node].append(key)
+    return replicas, groups
+
+
+@app.post("/batch/add")
+async def batch_add(request: BatchAddRequest, token: str = None):
+    """
+    The leader sends one sub batch per data node, concurrently, and answers once every key was
+    acknowledged by replication.writeQuorum of its replicas. A batch is not atomic across data nodes,
+    on failure the sub batches of other data nodes may have been applied, retrying the batch is safe
+    """
+    try:
+        start_time = time.time()
+        logger.debug("Received request for batch add of {} keys", len(request.items))
+        # A sub batch from the leader, served locally
+        if token:
+            await run_in_threadpool(server_instance.add_batch, request.items)
+            return {"added": len(request.items)}
+        elif server_instance.check_if_leader():
+            items = {data.key: data for data in request.items}
+            replicas, groups = group_by_replica(items, pending=True)
+
+            async def add_sub_batch(data_node_host_port, keys):
+                batch = [items[key] for key in keys]
+                if is_local(data_node_host_port):
+                    return await run_in_threadpool(server_instance.add_batch, batch)
+                return await forward_to_replica(
+                    data_node_host_port,
+                    batch,
+                    "/batch/add",
+                    json={"items": jsonable_encoder(batch)},
+                )
+
+            try:
+                await quorum(
+                    {node: add_sub_batch(node, keys) for node, keys in groups.items()},
+                    replicas,
+                    settings.replication.writeQuorum,
+                )
+            finally:
+                for data in items.values():
+                    hot_key_cache.invalidate(data.key, data.timestamp)
+            return {"added": len(items)}
+        else:
+            raise UnauthorizedRequestException(
+                "ADD requests can only be sent to the leader"
+            )
+    except WriteStallException as e:
+        raise HTTPException(
+            status_code=429, detail=f"Too many writes, retry later: {str(e)}"
+        )
+    except QuorumException as e:
+        raise HTTPException(status_code=503, detail=str(e))
+    except Exception as e:
+        raise HTTPException(
+            status_code=500, detail=f"Error adding the batch due to {str(e)}"
+        )
+    finally:
+        batch_latency.labels(node=server_instance._private_ip, operation="add").observe(
+            time.time() - start_time
+        )
+
+
+@app.post("/batch/get")
+async def batch_get(request: BatchGetRequest, token: str = None, include_deleted: bool = False):
+    """
+    Returns the data of every key, null for the keys that are missing or deleted. The newest data of
+    every key wins once replication.readQuorum of its replicas answered
+    """
+    try:
+        start_time = time.time()
+        logger.debug("Received request for batch get of {} keys", len(request.keys))
+        if token:
+            return await run_in_threadpool(server_instance.get_batch, request.keys, include_deleted)
+        elif server_instance.check_if_leader():
+            replicas, groups = group_by_replica(set(request.keys))
+
+            async def get_sub_batch(data_node_host_port, keys):
+                if is_local(data_node_host_port):
+                    return jsonable_encoder(
+                        await run_in_threadpool(server_instance.get_batch, keys, True)
+                    )
+                return await data_node_clients.forward(
+                    "POST",
+                    data_node_host_port,
+                    "/batch/get",
+                    params={"include_deleted": True},
+                    json={"keys": keys},
+                )
+
+            sub_batches = await quorum(
+                {node: get_sub_batch(node, keys) for node, keys in groups.items()},
+                replicas,
+                settings.replication.readQuorum,
+            )
+            batch = dict()
+            for key in replicas:
+                data = newest(sub_batches[node][key] for node in replicas[key] if node in sub_batches)
+                batch[key] = None if data is None or data["deleted"] else data
+            return {key: batch[key] for key in request.keys}
+        else:
+            raise UnauthorizedRequestException()
+    except QuorumException as e:
+        raise HTTPException(status_code=503, detail=str(e))
+    except Exception as e:
+        raise HTTPException(
+            status_code=500, detail=f"Error getting the batch due to {str(e)}"
+        )
+    finally:
+        batch_latency.labels(node=server_instance._private_ip, operation="get").observe(
+            time.time() - start_time
+        )
+
+
+async def scan_page(start: str, end: str, limit: int, token: str, include_deleted: bool = False) -> dict:
+    """
+    One page of a scan. Keys are spread over the data nodes by their hash, the leader asks every data
+    node for its first limit keys of the range, deleted keys included, and merges them. Replicas of a key
+    on several data nodes are reduced to its newest version, see merge_scan_pages
+    """
+    if token:
+        items = jsonable_encoder(
+            await run_in_threadpool(server_instance.scan_page, start, end, limit, include_deleted)
+        )
+    elif server_instance.check_if_leader():
+
+        async def scan_data_node(data_node_host_port):
+            if is_local(data_node_host_port):
+                return jsonable_encoder(
+                    await run_in_threadpool(server_instance.scan_page, start, end, limit, True)
+                )
+            page = await data_node_clients.forward(
+                "GET",
+                data_node_host_port,
+                "/scan",
+                params={
+                    key: value
+                    for key, value in {
+                        "start": start, "end": end, "limit": limit, "include_deleted": True
+                    }.items()
+                    if value is not None
+                },
+            )
+            return page["items"]
+
+        pages = await asyncio.gather(
+            *(scan_data_node(node) for node in server_instance.get_ring()["nodes"].values())
+        )
+        return merge_scan_pages(pages, limit)
+    else:
+        raise UnauthorizedRequestException()
+    return {
+        "items": items,
+        "next": next_key(items[-1]["key"]) if len(items) == limit else None,
+    }
+
+
+@app.get("/scan")
+async def scan(
+    start: str = None,
+    end: str = None,
+    prefix: str = None,
+    # A page holds at least one key, bad limits are rejected with a 422
+    limit: int = Query(settings.scan.pageSize, ge=1),
+    stream: bool = False,
+    token: str = None,
+    include_deleted: bool = False,
+):
+    """
+    Keys with start <= key < end, or starting with prefix, in key order. Returns a page of at most
+    limit keys and the start of the next page, or every key of the range as NDJSON when stream is set
+    """
+    try:
+        start_time = time.time()
+        logger.debug("Received a request for scanning from {} to {} with prefix {}", start, end, prefix)
+        if prefix is not None:
+            prefix_start, prefix_end = prefix_range(prefix)
+            start = prefix_start if start is None else max(start, prefix_start)
+            end = prefix_end if end is None or prefix_end is None else min(end, prefix_end)
+        limit = min(limit, settings.scan.maxLimit)
+        if not stream:
+            return await scan_page(start, end, limit, token, include_deleted)
+
+        # The first page is fetched before responding, errors still get a proper status code
+        first_page = await scan_page(start, end, settings.scan.pageSize, token, include_deleted)
+
+        async def scan_pages():
+            page = first_page
+            while True:
+                for item in page["items"]:
+                    yield json.dumps(item) + "\n"
+                if page["next"] is None:
+                    return
+                page = await scan_page(page["next"], end, settings.scan.pageSize, token, include_deleted)
+
+        return StreamingResponse(scan_pages(), media_type="application/x-ndjson")
+    except Exception as e:
+        raise HTTPException(
+            status_code=500, detail=f"Error scanning the data due to {str(e)}"
+        )
+    finally:
+        batch_latency.labels(node=server_instance._private_ip, operation="scan").observe(
+            time.time() - start_time
+        )
+
+
+@app.get("/repair/tree")
+async def repair_tree(peer: str, depth: int = settings.antiEntropy.treeDepth):
+    """
+    Merkle tree of the keys this node and peer are both replicas of, see AntiEntropy
+    """
+    try:
+        tree = await run_in_threadpool(server_instance.merkle_tree, peer, depth)
+        return tree.to_dict()
+    except Exception as e:
+        raise HTTPException(
+            status_code=500, detail=f"Error building the Merkle tree due to {str(e)}"
+        )
+
+
+@app.post("/repair/leaves")
+async def repair_leaves(
+    peer: str, request: RepairLeavesRequest, depth: int = settings.antiEntropy.treeDepth
+):
+    """
+    The data, deleted keys included, of the keys this node and peer are both replicas of that fall
+    in the leaves of the Merkle tree
+    """
     try:
-        server_instance.update_partiton_map(request)
-        return True
+        return await run_in_threadpool(server_instance.leaf_records, peer, request.leaves, depth)
     except Exception as e:
         raise HTTPException(
-            status_code=500, detail=f"Error updating partition map {str(e)}"
+            status_code=500, detail=f"Error reading the leaves due to {str(e)}"
+        )
+
+
+@app.post("/repair/apply")
+async def repair_apply(request: BatchAddRequest):
+    """
+    Applies the data that is newer than the version of this node, sent by hinted handoff and anti-entropy
+    """
+    try:
+        applied = await run_in_threadpool(server_instance.repair, request.items)
+        return {"applied": applied}
+    except WriteStallException as e:
+        raise HTTPException(
+            status_code=429, detail=f"Too many writes, retry later: {str(e)}"
         )
+    except Exception as e:
+        raise HTTPException(
+            status_code=500, detail=f"Error repairing the data due to {str(e)}"
+        )
+    finally:
+        # Repairs may have reached this node, a leader drops its cached copies of the keys
+        for data in request.items:
+            hot_key_cache.invalidate(data.key, data.timestamp)
+
+
+@app.post("/rebalance/stream")
+def rebalance_stream(request: RebalanceStreamRequest):
+    """
+    Streams the data of the keys request.node takes over from this node, see Rebalancer
+    """
+    return StreamingResponse(
+        server_instance.rebalancer.stream(request.node, request.before, request.after),
+        media_type="application/octet-stream",
+    )
+
+
+@app.get("/partition-map")
+async def partition_map():
+    """
+    The replicas of every range of the hash ring, as seen by this node
+    """
+    return server_instance.get_partition_map()
 
 
 # Code for exposing Prometheus metrics endpoint
@@ -178,6 +599,7 @@ app.mount("/metrics", metrics_app)
 
 
 if __name__ == "__main__":
+    configure_logging()
     try:
         all_args = sys.argv
         long_options = ["zooKeeperHost=", "zooKeeperPort="]
@@ -200,11 +622,13 @@ if __name__ == "__main__":
         server_instance = Server(
             zk_host=zk_host, zk_port=zk_port, private_ip=ip_address, port=port
         )
+        server_instance.on_view_changed = lambda view: data_node_clients.retain(view.id_host_map.values())
         server_instance.start()
         logger.info(
             f"This server will run on host: {server_ip}, port: {port}, zookeeper host:{zk_host}, zookeeper port: {zk_port}"
         )
-        uvicorn.run(app, host=server_ip, port=port)
+        # Requests are logged by sampled_request_log, uvicorn would log every single one
+        uvicorn.run(app, host=server_ip, port=port, access_log=False)
     except Exception as e:
         logger.error(str(e))
         sys.exit(2)
@@ -1,29 +1,122 @@
-from collections import defaultdict
-from utils.model import Data
+from dataclasses import dataclass
+from impl.consistent_hashing import ConsistentHashingImpl
+import bisect
 import json
+import os
 
+PARTITION_MAP_FILE = "PARTITION_MAP"
 
+
+def owner_position(hashes, key_hash: int) -> int:
+    """
+    Position of the owner of a key hash among the ring positions in ascending order, as
+    ConsistentHashingImpl.get_node_for_data picks it: the first member strictly past the hash of the
+    key, or else the last member
+    """
+    position = bisect.bisect_right(hashes, key_hash)
+    if key_hash == 0 or position == len(hashes) or (position and hashes[position - 1] == key_hash):
+        return len(hashes) - 1
+    return position
+
+
+@dataclass(frozen=True)
 class PartitionMap:
     """
-    This is an in-memory datastructure maintained by each node to track the list of coordinator
-    nodes for each key. ex
-        key1: [node1, node2]
-        key2: [node1, node3]
-    This datastructure will make CoreCache handle a node failure.
+    The replicas of every range of the hash ring, built once per cluster view, which answers the
+    replica and peer lookups of routing from it. A range holds the keys hashing past the token of the
+    previous range up to its own token, the last range also holds the keys past the last token, as
+    owner_position places them.
+    One entry per member of the ring, its size depends on the number of nodes, not on the number of keys
+        ranges: [{"token": 155, "replicas": ["10.0.0.1:8000", "10.0.0.2:8000"]},
+                 {"token": 556, "replicas": ["10.0.0.2:8000", "10.0.0.1:8000"]}]
+
+    version: Version of the cluster view it was built from
+    replication_factor: Replicas per range
+    tokens: Positions of the members on the ring in ascending order, the end of every range
+    replicas: host:port of the replicas of every range, its owner first
     """
 
-    def __init__(self) -> None:
-        self._partition_map = defaultdict(set)
+    version: int = 0
+    replication_factor: int = 1
+    tokens: tuple = ()
+    replicas: tuple = ()
+
+    @classmethod
+    def build(cls, view, replication_factor: int) -> "PartitionMap":
+        """
+        view: The ClusterView to walk the ring of, a range is replicated on its owner and the next
+              members clockwise, replication_factor of them at most
+        """
+        count = min(replication_factor, len(view.node_ids))
+        return cls(
+            version=view.version,
+            replication_factor=replication_factor,
+            tokens=view.hashes,
+            replicas=tuple(
+                tuple(view.id_host_map[view.node_ids[(position + offset) % len(view.node_ids)]] for offset in range(count))
+                for position in range(len(view.node_ids))
+            ),
+        )
+
+    def range_of(self, key: str) -> int:
+        # Hashes the way the ring does, the hash only depends on the key
+        return owner_position(self.tokens, ConsistentHashingImpl().hash(key))
+
+    def get(self, key: str) -> tuple:
+        """
+        host:port of the replicas of the key, its owner first, none while the ring is empty
+        """
+        return self.replicas[self.range_of(key)] if self.tokens else ()
+
+    def ranges_of(self, host_port: str) -> list:
+        """
+        Tokens of the ranges host_port is a replica of
+        """
+        return [token for token, replicas in zip(self.tokens, self.replicas) if host_port in replicas]
+
+    def peers_of(self, host_port: str) -> list:
+        """
+        host:port of the members sharing a range with host_port
+        """
+        return sorted({replica for replicas in self.replicas if host_port in replicas for replica in replicas} - {host_port})
 
-    def update(self, data: Data, node):
-        self._partition_map[data.key].add(node)
+    def to_dict(self) -> dict:
+        return {
+            "version": self.version,
+            "replication_factor": self.replication_factor,
+            "ranges": [
+                {"token": token, "replicas": list(replicas)} for token, replicas in zip(self.tokens, self.replicas)
+            ],
+        }
 
-    def get(self, key):
-        return self._partition_map[key]
+    @classmethod
+    def from_dict(cls, partition_map: dict) -> "PartitionMap":
+        return cls(
+            version=partition_map["version"],
+            replication_factor=partition_map["replication_factor"],
+            tokens=tuple(partition_range["token"] for partition_range in partition_map["ranges"]),
+            replicas=tuple(tuple(partition_range["replicas"]) for partition_range in partition_map["ranges"]),
+        )
 
-    def remove(self, key, node):
-        self._partition_map.get(key).remove(node)
+    def save(self, data_dir: str):
+        """
+        Snapshots the map as PARTITION_MAP in the data directory, written then renamed like the MANIFEST
+        """
+        partition_map_file = f"{data_dir}/{PARTITION_MAP_FILE}"
+        tmp_file = f"{partition_map_file}.tmp"
+        with open(tmp_file, "w") as fp_partition_map_file:
+            json.dump(self.to_dict(), fp_partition_map_file)
+            fp_partition_map_file.flush()
+            os.fsync(fp_partition_map_file.fileno())
+        os.replace(tmp_file, partition_map_file)
 
-    def __repr__(self) -> str:
-        data = json.dump(self._partition_map)
-        return data
+    @classmethod
+    def load(cls, data_dir: str) -> "PartitionMap":
+        """
+        The last snapshot saved in the data directory, an empty map if there is none
+        """
+        try:
+            with open(f"{data_dir}/{PARTITION_MAP_FILE}", "r") as fp_partition_map_file:
+                return cls.from_dict(json.load(fp_partition_map_file))
+        except FileNotFoundError:
+            return cls()
@@ -1,10 +1,11 @@
-from dataclasses import dataclass
-from lsmt.mem_table import MemTable
+from dataclasses import dataclass, field
+from lsmt.mem_table_manager import MemTableManager
 from loguru import logger
 from apscheduler.schedulers.background import BackgroundScheduler
 from apscheduler.job import Job
 from compaction.compaction import Compaction
 from config import settings
+from typing import Optional
 
 
 @dataclass
@@ -12,35 +13,47 @@ class Scheduler:
     """
     The sole purpose of this scheduler is to do the following:
     1. Flush Memtable to SSTable on disk
-    2. Kick off compaction, to combine multiple data and index files into one
+    2. Wake up the compaction worker, to combine multiple data and index files into fewer ones
+    3. Hand off the writes kept for replicas that were unreachable
+    4. Repair the replicas shared with other nodes through anti-entropy
     """
-    cache: MemTable = MemTable()
-    compaction: Compaction = Compaction()
+    cache: MemTableManager = field(default_factory=MemTableManager)
+    compaction: Compaction = field(default_factory=Compaction)
+    # server.hinted_handoff.HintedHandoff and server.anti_entropy.AntiEntropy, set by the Server
+    hinted_handoff: Optional[object] = None
+    anti_entropy: Optional[object] = None
     scheduler = BackgroundScheduler()
 
     def init(self):
         logger.info("Initializing the schedule")
+        self.compaction.start()
+        # MemTables over their byte budget are flushed from the write path, the interval job is the fallback for quiet ones
+        self.cache.on_flush = self.compaction.wakeup
+        self.cache.start()
         self.flush_job:Job = self.scheduler.add_job(self.trigger_mem_table_flush, 'interval', seconds=settings.memTable.schedule)
         self.compaction_job:Job = self.scheduler.add_job(self.trigger_compaction, 'interval', seconds=settings.compaction.schedule)
+        if self.hinted_handoff is not None and settings.hintedHandoff.enabled:
+            self.hinted_handoff_job:Job = self.scheduler.add_job(self.trigger_hinted_handoff, 'interval', seconds=settings.hintedHandoff.schedule)
+        # Without replication no two nodes share keys, there is nothing to repair
+        if self.anti_entropy is not None and settings.antiEntropy.enabled and settings.replication.factor > 1:
+            self.anti_entropy_job:Job = self.scheduler.add_job(self.trigger_anti_entropy, 'interval', seconds=settings.antiEntropy.schedule)
         self.scheduler.start()
     
     def trigger_mem_table_flush(self):
         logger.info("Time to trigger the memtable flush, checking the condition...")
         if self.cache.can_flush():
             self.cache.flush()
+            # A new SSTable may complete a compaction run, no need to wait for the next tick
+            self.compaction.wakeup()
 
     def trigger_compaction(self):
-        if self.compaction.can_compact():
-            logger.info("Time to trigger compaction, flush needs to stop to avoid race conditions")
-            self.flush_job.pause()
-            self.compaction.compact()
-            logger.info("Compacting complete, enabling the mem flush again")
-            self.flush_job.resume()
+        # Compaction runs on its own worker against a snapshot of the manifest, flushes keep going meanwhile
+        logger.info("Time to trigger compaction, waking up the compaction worker")
+        self.compaction.wakeup()
 
-    
-
-
-
-
-            
+    def trigger_hinted_handoff(self):
+        self.hinted_handoff.deliver()
 
+    def trigger_anti_entropy(self):
+        logger.info("Time to trigger anti-entropy, comparing the replicas shared with other nodes")
+        self.anti_entropy.run()
@@ -0,0 +1,97 @@
+from dataclasses import dataclass, field
+from fastapi.encoders import jsonable_encoder
+from loguru import logger
+from config import settings
+from prometheus_client import Counter
+from server.merkle_tree import MerkleTree
+from utils.model import Data, version_of
+import httpx
+import threading
+
+# pulled: keys this node took from a peer, pushed: keys this node sent to a peer
+anti_entropy_repaired_keys = Counter(
+    "anti_entropy_repaired_keys", "Keys repaired by anti-entropy", labelnames=["direction"]
+)
+anti_entropy_differing_leaves = Counter(
+    "anti_entropy_differing_leaves", "Merkle tree leaves that differed between two replicas"
+)
+
+
+@dataclass
+class AntiEntropy:
+    """
+    Periodic repair of the replicas this node shares keys with, run by a Scheduler job
+    1. For every peer, both nodes build a Merkle tree over the keys they both replicate, deleted
+       keys included, and the peer sends its tree over
+    2. The trees are compared from the root down, only the leaves that differ are repaired
+    3. Both nodes exchange the keys of those leaves and every key ends up with its newest version
+       on both sides, through /repair/apply
+    The trees are of a fixed size, the keys sent are the ones in differing leaves, so the traffic
+    grows with how much the replicas diverged rather than with the size of the data
+
+    server: The Server of this node
+    """
+
+    server: object
+    depth: int = settings.antiEntropy.treeDepth
+    batch_size: int = settings.antiEntropy.batchSize
+    http: httpx.Client = None
+    # One run at a time, a run can take longer than the schedule
+    _lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+
+    def __post_init__(self):
+        if self.http is None:
+            self.http = httpx.Client(
+                timeout=httpx.Timeout(
+                    settings.forwarding.readTimeoutMs / 1000, connect=settings.forwarding.connectTimeoutMs / 1000
+                )
+            )
+
+    def run(self):
+        if not self._lock.acquire(blocking=False):
+            logger.info("Anti-entropy is still running, skipping this run")
+            return
+        try:
+            for peer in self.server.get_peers():
+                try:
+                    self.repair(peer)
+                except httpx.HTTPError as e:
+                    logger.warning("Anti-entropy with {} failed: {}", peer, e)
+        finally:
+            self._lock.release()
+
+    def repair(self, peer: str) -> int:
+        """
+        Repairs the keys this node and peer both replicate, returns the number of keys repaired
+        """
+        this_node = self.server.host_port
+        local_tree = self.server.merkle_tree(peer, self.depth)
+        response = self.http.get(f"http://{peer}/repair/tree", params={"peer": this_node, "depth": self.depth})
+        response.raise_for_status()
+        leaves = local_tree.diff(MerkleTree.from_dict(response.json()))
+        if not leaves:
+            logger.debug("Replicas shared with {} are in sync", peer)
+            return 0
+        anti_entropy_differing_leaves.inc(len(leaves))
+        response = self.http.post(
+            f"http://{peer}/repair/leaves",
+            params={"peer": this_node, "depth": self.depth},
+            json={"leaves": leaves},
+        )
+        response.raise_for_status()
+        remote = {item["key"]: item for item in response.json()}
+        local = {data.key: data for data in self.server.leaf_records(peer, leaves, self.depth)}
+
+        pull = [Data(**item) for key, item in remote.items() if key not in local or version_of(item) > version_of(local[key])]
+        push = [data for key, data in local.items() if key not in remote or version_of(data) > version_of(remote[key])]
+        self.server.repair(pull)
+        for start in range(0, len(push), self.batch_size):
+            self.http.post(
+                f"http://{peer}/repair/apply", json={"items": jsonable_encoder(push[start : start + self.batch_size])}
+            ).raise_for_status()
+        anti_entropy_repaired_keys.labels(direction="pulled").inc(len(pull))
+        anti_entropy_repaired_keys.labels(direction="pushed").inc(len(push))
+        logger.info(
+            "Anti-entropy with {}: {} leaves differed, pulled {} keys and pushed {} keys", peer, len(leaves), len(pull), len(push)
+        )
+        return len(pull) + len(push)
@@ -0,0 +1,106 @@
+from dataclasses import dataclass, field
+from impl.consistent_hashing import ConsistentHashingImpl
+from partition.partition_map import PartitionMap, owner_position
+from typing import Optional
+
+
+@dataclass(frozen=True)
+class ClusterView:
+    """
+    The members of the cluster as last seen in ZooKeeper, rebuilt by the /election and /ring watches
+    on every membership change and swapped in as a whole, so the request path reads a consistent view
+    without calling ZooKeeper. A view is never mutated once built
+
+    version: Bumped on every membership change
+    id_host_map: host:port of every member keyed by its election id, ex. {"0000000001": "10.0.0.1:8000"}
+    ring: Consistent hash ring of the members in the ring, a joining member is only added once it
+          holds the data of the ranges it takes over, see Rebalancer
+    hashes: Positions of the members on the ring in ascending order, node_ids the member at each of them
+    target: The view once every joining member is in the ring, None when no member is joining
+    Replicas and peers are looked up in the PartitionMap of the view, built on first use per factor
+    """
+
+    version: int = 0
+    id_host_map: dict = field(default_factory=dict)
+    ring: ConsistentHashingImpl = field(default_factory=ConsistentHashingImpl)
+    hashes: tuple = ()
+    node_ids: tuple = ()
+    target: Optional["ClusterView"] = None
+    _partition_maps: dict = field(default_factory=dict, repr=False, compare=False)
+
+    @classmethod
+    def build(cls, version: int, id_host_map: dict, ring_ids=None) -> "ClusterView":
+        """
+        ring_ids: Election ids of the members in the ring, every member by default
+        """
+        ring_ids = set(id_host_map) if ring_ids is None else set(ring_ids) & set(id_host_map)
+        ring = ConsistentHashingImpl()
+        for node_id in sorted(ring_ids):
+            ring.add_node(node_id)
+        return cls(
+            version=version,
+            id_host_map=dict(id_host_map),
+            ring=ring,
+            hashes=tuple(ring.node_hash_map),
+            node_ids=tuple(ring.node_hash_map.values()),
+            target=cls.build(version, id_host_map) if ring_ids != set(id_host_map) else None,
+        )
+
+    @property
+    def ring_nodes(self) -> dict:
+        """
+        host:port of the members in the ring keyed by their election id
+        """
+        return {node_id: self.id_host_map[node_id] for node_id in self.node_ids}
+
+    @property
+    def leader_id(self) -> Optional[int]:
+        """
+        The member with the lowest election sequence leads
+        """
+        return min((int(node_id) for node_id in self.id_host_map), default=None)
+
+    def owner_position(self, key: str) -> int:
+        """
+        Position of the owner of the key on the ring, a binary search instead of the linear walk of
+        ConsistentHashingImpl.get_node_for_data, which also remembers every key it was asked for
+        """
+        return owner_position(self.hashes, self.ring.hash(key))
+
+    def get_data_node(self, key: str) -> str:
+        return self.id_host_map[self.node_ids[self.owner_position(key)]]
+
+    def partition_map(self, replication_factor: int) -> PartitionMap:
+        """
+        The replicas of every range of the ring, built once per view and factor, racing builds of the
+        same view are identical
+        """
+        partition_map = self._partition_maps.get(replication_factor)
+        if partition_map is None:
+            partition_map = PartitionMap.build(self, replication_factor)
+            self._partition_maps[replication_factor] = partition_map
+        return partition_map
+
+    def get_replica_nodes(self, key: str, replication_factor: int) -> list:
+        """
+        host:port of the owner of the key followed by the next members clockwise on the ring,
+        replication_factor of them at most
+        """
+        return list(self.partition_map(replication_factor).get(key))
+
+    def get_pending_nodes(self, key: str, replication_factor: int) -> list:
+        """
+        host:port of the joining members that become replicas of the key once they are in the ring,
+        they get its writes meanwhile so no write is missed between their transfer and the switch
+        """
+        if self.target is None:
+            return []
+        replicas = self.get_replica_nodes(key, replication_factor)
+        return [node for node in self.target.get_replica_nodes(key, replication_factor) if node not in replicas]
+
+    def get_peers(self, host_port: str, replication_factor: int) -> list:
+        """
+        host:port of the members sharing replicas with host_port, the members less than
+        replication_factor positions away from it on the ring
+        """
+        return self.partition_map(replication_factor).peers_of(host_port)
@@ -0,0 +1,81 @@
+from dataclasses import dataclass, field
+from loguru import logger
+from config import settings
+from exception.exceptions import NoDataFoundException, WriteStallException
+import asyncio
+import httpx
+
+
+@dataclass
+class DataNodeClients:
+    """
+    One pooled, keep alive HTTP client per data node, used by the leader to forward requests.
+    Connections are reused across requests instead of opening a new one per forwarded request.
+    The pools of the nodes that leave the cluster are closed, see retain
+    """
+
+    pool_size: int = settings.forwarding.poolSize
+    connect_timeout_ms: int = settings.forwarding.connectTimeoutMs
+    read_timeout_ms: int = settings.forwarding.readTimeoutMs
+    keep_alive_expiry_s: int = settings.forwarding.keepAliveExpirySeconds
+    _clients: dict = field(default_factory=dict)
+    # The event loop the pools are used on, they are closed on it
+    _loop: asyncio.AbstractEventLoop = field(default=None, repr=False)
+
+    def get(self, host_port: str) -> httpx.AsyncClient:
+        client = self._clients.get(host_port)
+        if client is None:
+            try:
+                self._loop = asyncio.get_running_loop()
+            except RuntimeError:
+                # Outside of an event loop, the pools are only closed by close
+                pass
+            logger.info("Opening a connection pool of {} to data node {}", self.pool_size, host_port)
+            client = self._clients[host_port] = httpx.AsyncClient(
+                base_url=f"http://{host_port}",
+                limits=httpx.Limits(
+                    max_connections=self.pool_size,
+                    max_keepalive_connections=self.pool_size,
+                    keepalive_expiry=self.keep_alive_expiry_s,
+                ),
+                timeout=httpx.Timeout(
+                    self.read_timeout_ms / 1000, connect=self.connect_timeout_ms / 1000
+                ),
+            )
+        return client
+
+    async def forward(self, method: str, host_port: str, path: str, **kwargs):
+        """
+        Sends the request to the data node with token=leader and returns its JSON response. The status
+        of the data node is mapped back to the exception that produced it
+        """
+        params = dict(kwargs.pop("params", None) or {}, token="leader")
+        response = await self.get(host_port).request(method, path, params=params, **kwargs)
+        if response.status_code == 404:
+            raise NoDataFoundException(response.text)
+        if response.status_code == 429:
+            raise WriteStallException(response.text)
+        response.raise_for_status()
+        return response.json()
+
+    def retain(self, members):
+        """
+        Closes the pools of the data nodes that are not among members, called from the ZooKeeper
+        watches on every membership change, the pools are closed on the event loop they belong to
+        """
+        for host_port in set(self._clients) - set(members):
+            client = self._clients.pop(host_port, None)
+            if client is None or self._loop is None or self._loop.is_closed():
+                continue
+            logger.info("Closing the connection pool to data node {}, it left the cluster", host_port)
+            asyncio.run_coroutine_threadsafe(client.aclose(), self._loop)
+
+    async def close(self, host_port: str = None):
+        """
+        Closes the pool of one data node, or every pool when host_port is None
+        """
+        host_ports = list(self._clients) if host_port is None else [host_port]
+        for node in host_ports:
+            client = self._clients.pop(node, None)
+            if client is not None:
+                await client.aclose()
@@ -0,0 +1,124 @@
+from dataclasses import dataclass, field
+from fastapi.encoders import jsonable_encoder
+from loguru import logger
+from config import settings
+from lsmt.wal import encode_record, decode_records
+from prometheus_client import Counter
+from typing import Callable
+import glob
+import httpx
+import os
+import threading
+
+# stored: a write a replica missed was kept for it, delivered: it reached the replica once it was back,
+# dropped: the replica had too many hints already, anti-entropy repairs it instead
+hints = Counter("hints", "Writes kept for replicas that could not be reached", labelnames=["result"])
+
+
+@dataclass
+class HintedHandoff:
+    """
+    Keeps the writes a replica missed while it was unreachable and hands them off once it is back
+    1. A failed write to a replica is appended to a hint file of that replica, in the WAL record format
+    2. A Scheduler job sends the hints of every replica that is a member of the cluster to its
+       /repair/apply, which keeps the newest version of every key, a hint never overwrites a newer write
+    3. Past max_hints_per_node hints for a replica new ones are dropped, anti-entropy repairs the replica
+    """
+
+    hints_dir: str = f"{settings.dataDirectory}/hints"
+    max_hints_per_node: int = settings.hintedHandoff.maxHintsPerNode
+    batch_size: int = settings.hintedHandoff.batchSize
+    # host:port of the current members of the cluster
+    members: Callable = set
+    http: httpx.Client = None
+    _counts: dict = field(default=None, repr=False)
+    _lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+    # One delivery at a time
+    _deliver_lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+
+    def __post_init__(self):
+        if self.http is None:
+            self.http = httpx.Client(
+                timeout=httpx.Timeout(
+                    settings.forwarding.readTimeoutMs / 1000, connect=settings.forwarding.connectTimeoutMs / 1000
+                )
+            )
+
+    def hint_file(self, host_port: str) -> str:
+        return f"{self.hints_dir}/{host_port.replace(':', '_')}.hints"
+
+    def targets(self) -> list:
+        return [
+            os.path.basename(hint_file)[: -len(".hints")].replace("_", ":")
+            for hint_file in glob.glob(f"{self.hints_dir}/*.hints")
+        ]
+
+    def _load_counts(self):
+        if self._counts is None:
+            self._counts = {target: len(self._read(target)) for target in self.targets()}
+
+    def _read(self, host_port: str) -> list:
+        try:
+            with open(self.hint_file(host_port), "rb") as fp_hint_file:
+                return list(decode_records(fp_hint_file.read()))
+        except FileNotFoundError:
+            return []
+
+    def add(self, host_port: str, batch: list):
+        """
+        Keeps the writes of the batch for the replica host_port
+        """
+        kept = self._append(host_port, batch)
+        if kept:
+            hints.labels(result="stored").inc(kept)
+            logger.debug("Kept {} hints for {}", kept, host_port)
+
+    def _append(self, host_port: str, batch: list) -> int:
+        with self._lock:
+            self._load_counts()
+            room = max(self.max_hints_per_node - self._counts.get(host_port, 0), 0)
+            if room < len(batch):
+                hints.labels(result="dropped").inc(len(batch) - room)
+                logger.warning("Too many hints for {}, dropping {} of them", host_port, len(batch) - room)
+                batch = batch[:room]
+            if batch:
+                os.makedirs(self.hints_dir, exist_ok=True)
+                with open(self.hint_file(host_port), "ab") as fp_hint_file:
+                    fp_hint_file.write(b"".join(encode_record(data) for data in batch))
+                self._counts[host_port] = self._counts.get(host_port, 0) + len(batch)
+            return len(batch)
+
+    def _take(self, host_port: str) -> list:
+        with self._lock:
+            self._load_counts()
+            batch = self._read(host_port)
+            if os.path.exists(self.hint_file(host_port)):
+                os.remove(self.hint_file(host_port))
+            self._counts.pop(host_port, None)
+            return batch
+
+    def deliver(self):
+        """
+        Sends the hints of every replica that is a member of the cluster, hints that could not be
+        delivered are kept for the next run
+        """
+        with self._deliver_lock:
+            members = self.members()
+            for host_port in self.targets():
+                if host_port not in members:
+                    continue
+                batch = self._take(host_port)
+                delivered = 0
+                try:
+                    while delivered < len(batch):
+                        chunk = batch[delivered : delivered + self.batch_size]
+                        self.http.post(
+                            f"http://{host_port}/repair/apply", json={"items": jsonable_encoder(chunk)}
+                        ).raise_for_status()
+                        delivered += len(chunk)
+                except httpx.HTTPError as e:
+                    logger.warning("Could not hand off hints to {}: {}", host_port, e)
+                    self._append(host_port, batch[delivered:])
+                if delivered:
+                    hints.labels(result="delivered").inc(delivered)
+                    logger.info("Handed off {} hints to {}", delivered, host_port)
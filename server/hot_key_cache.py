@@ -0,0 +1,116 @@
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from loguru import logger
+from config import settings
+from prometheus_client import Counter, Gauge
+from typing import Optional
+from utils.model import Data
+import threading
+import time
+
+hot_key_cache_lookups = Counter(
+    "hot_key_cache_lookups", "Lookups of the leader's hot key cache", labelnames=["result"]
+)
+hot_key_cache_evictions = Counter(
+    "hot_key_cache_evictions", "Entries evicted from the leader's hot key cache to stay within maxEntries"
+)
+hot_key_cache_hit_ratio = Gauge("hot_key_cache_hit_ratio", "Share of the leader's hot key cache lookups that hit")
+
+
+@dataclass
+class CacheEntry:
+    """
+    data: None for a key invalidated by a write, it is a miss until a read fills it
+    version: Data.timestamp of the last write of the key routed through the leader, 0 if none
+    generation: HotKeyCache.generation at the time of that write, 0 if none
+    """
+
+    data: Optional[Data]
+    version: int
+    generation: int
+    expires_at: float
+
+
+@dataclass
+class HotKeyCache:
+    """
+    Bounded LRU cache of the data the leader forwards GETs for, so hot keys stop hitting their
+    data node on every read
+    1. A GET for a remote key is served from the cache, a miss is forwarded and fills the cache
+    2. ADD, DELETE and repairs applied by the leader invalidate the key, using Data.timestamp as the
+       version of the write. A read that was in flight during the write may hold the old data, it only
+       fills the cache if it started after the invalidation or its data is newer than the write
+    3. Writes that bypass the leader, routed by clients to the owner of the key or sent straight to
+       the data nodes, are not seen by it, entries expire after ttl_seconds to bound how long such
+       writes stay hidden
+    Disabled by default, every call is a no-op then
+    """
+
+    enabled: bool = settings.hotKeyCache.enabled
+    max_entries: int = settings.hotKeyCache.maxEntries
+    ttl_seconds: float = settings.hotKeyCache.ttlSeconds
+    # Bumped on every invalidation, a read remembers it before it is forwarded
+    generation: int = 0
+    _entries: OrderedDict = field(default_factory=OrderedDict)
+    _lookups: int = 0
+    _hits: int = 0
+    _lock: threading.Lock = field(default_factory=threading.Lock, repr=False, compare=False)
+
+    def get(self, key: str) -> Optional[Data]:
+        if not self.enabled:
+            return None
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.expires_at <= time.monotonic():
+                del self._entries[key]
+                entry = None
+            hit = entry is not None and entry.data is not None
+            if hit:
+                self._entries.move_to_end(key)
+            self._lookups += 1
+            self._hits += hit
+            hot_key_cache_hit_ratio.set(self._hits / self._lookups)
+        hot_key_cache_lookups.labels(result="hit" if hit else "miss").inc()
+        return entry.data if hit else None
+
+    def fill(self, data: Data, generation: int):
+        """
+        Caches the data returned by a data node, generation as read before the request was forwarded
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            entry = self._entries.get(data.key)
+            version, written_generation = (entry.version, entry.generation) if entry is not None else (0, 0)
+            if written_generation > generation and version >= data.timestamp:
+                logger.debug("Not caching {}, it was written while it was being read", data.key)
+                return
+            self._put(data.key, CacheEntry(data, version, written_generation, time.monotonic() + self.ttl_seconds))
+
+    def invalidate(self, key: str, version: int):
+        """
+        Called for every write of the key the leader sees, version is the Data.timestamp of the write
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            self.generation += 1
+            entry = self._entries.get(key)
+            if entry is not None:
+                version = max(version, entry.version)
+            self._put(key, CacheEntry(None, version, self.generation, time.monotonic() + self.ttl_seconds))
+
+    def _put(self, key: str, entry: CacheEntry):
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            evicted, _ = self._entries.popitem(last=False)
+            hot_key_cache_evictions.inc()
+            logger.debug("Evicted {} from the hot key cache", evicted)
+
+    def __contains__(self, key: str) -> bool:
+        entry = self._entries.get(key)
+        return entry is not None and entry.data is not None
+
+    def __len__(self) -> int:
+        return len(self._entries)
@@ -0,0 +1,75 @@
+from dataclasses import dataclass, field
+import hashlib
+
+
+def leaf_of(key: str, depth: int) -> int:
+    """
+    Leaf of the key in a tree of the given depth, keys are spread over the leaves by their hash so
+    every node puts a key in the same leaf
+    """
+    return int.from_bytes(hashlib.md5(key.encode("utf-8")).digest()[:8], "big") % (1 << depth)
+
+
+@dataclass
+class MerkleTree:
+    """
+    Hash tree over the data of a node, two nodes holding the same data have the same root. Every
+    leaf hashes the keys falling in it, every inner node the digests of its two children. Comparing
+    two trees from the root down finds the leaves that differ without exchanging the data itself
+
+    depth: The tree has 2^depth leaves
+    levels: Digests per level, levels[0] holds the root and levels[depth] the leaves
+    """
+
+    depth: int
+    levels: list = field(default_factory=list)
+
+    @classmethod
+    def build(cls, records, depth: int) -> "MerkleTree":
+        """
+        records: Data in key order, deleted data included
+        """
+        leaves = [hashlib.md5() for _ in range(1 << depth)]
+        for data in records:
+            leaves[leaf_of(data.key, depth)].update(
+                f"{data.key}\0{data.timestamp}\0{data.deleted}\0".encode("utf-8")
+                + hashlib.md5(data.value.encode("utf-8")).digest()
+            )
+        levels = [[leaf.hexdigest() for leaf in leaves]]
+        while len(levels[0]) > 1:
+            children = levels[0]
+            levels.insert(
+                0,
+                [
+                    hashlib.md5((children[index] + children[index + 1]).encode("utf-8")).hexdigest()
+                    for index in range(0, len(children), 2)
+                ],
+            )
+        return cls(depth=depth, levels=levels)
+
+    @property
+    def root(self) -> str:
+        return self.levels[0][0]
+
+    def diff(self, other: "MerkleTree") -> list:
+        """
+        Leaves whose digests differ from the other tree, only the subtrees whose roots differ are walked
+        """
+        if self.depth != other.depth:
+            raise ValueError(f"Cannot compare a tree of depth {self.depth} with one of depth {other.depth}")
+        differing = [0] if self.root != other.root else []
+        for level in range(1, self.depth + 1):
+            differing = [
+                child
+                for index in differing
+                for child in (2 * index, 2 * index + 1)
+                if self.levels[level][child] != other.levels[level][child]
+            ]
+        return differing
+
+    def to_dict(self) -> dict:
+        return {"depth": self.depth, "levels": self.levels}
+
+    @classmethod
+    def from_dict(cls, tree: dict) -> "MerkleTree":
+        return cls(depth=tree["depth"], levels=tree["levels"])
@@ -0,0 +1,172 @@
+from dataclasses import dataclass, field
+from loguru import logger
+from config import settings
+from lsmt.wal import encode_record, split_records
+from prometheus_client import Counter
+from server.cluster_view import ClusterView
+import httpx
+import threading
+import time
+
+# sent: bytes this node streamed to a node taking over its ranges, received: bytes streamed to this node
+rebalance_bytes = Counter("rebalance_bytes", "Bytes of data streamed by rebalancing", labelnames=["direction"])
+rebalance_ingested_keys = Counter("rebalance_ingested_keys", "Keys written to SSTables from rebalancing streams")
+
+
+@dataclass
+class Throttle:
+    """
+    Holds the caller back so no more than bytes_per_second go through on average, 0 for no limit
+    """
+
+    bytes_per_second: float
+    _start: float = None
+    _sent: int = 0
+
+    def wait(self, num_bytes: int):
+        if not self.bytes_per_second:
+            return
+        now = time.monotonic()
+        if self._start is None:
+            self._start = now
+        self._sent += num_bytes
+        delay = self._sent / self.bytes_per_second - (now - self._start)
+        if delay > 0:
+            time.sleep(delay)
+
+
+@dataclass
+class Rebalancer:
+    """
+    Moves the data of the key ranges that change hands when members join or leave the cluster
+    1. A joining member stays out of the ring, coordinators keep routing its ranges to the current
+       replicas and send it the writes of the ranges it takes over, see ClusterView.get_pending_nodes
+    2. It asks every member of the ring for the keys it takes over, each key is sent by one member only,
+       the first of its current replicas. The members stream them from a scan of their MemTables and
+       SSTables, throttled to max_bytes_per_second
+    3. The streamed data is written straight to SSTables of about sstable_bytes, see Server.ingest
+    4. Once every transfer completed it joins the ring under /ring and routing switches to it,
+       a failed transfer is retried after retry_seconds
+    5. When members leave, the members that replicate their ranges now pull them from the remaining
+       replicas, routing already switched since the members that left cannot serve them anymore
+    Data of the ranges a member no longer replicates is left in place
+
+    server: The Server of this node
+    """
+
+    server: object
+    max_bytes_per_second: int = settings.rebalance.maxBytesPerSecond
+    sstable_bytes: int = settings.rebalance.sstableBytes
+    chunk_bytes: int = settings.rebalance.chunkBytes
+    retry_seconds: float = settings.rebalance.retrySeconds
+    http: httpx.Client = None
+    _joining: bool = False
+    _join_lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+    # One transfer at a time
+    _transfer_lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+
+    def __post_init__(self):
+        if self.http is None:
+            # A member may scan through a lot of data before it finds keys to send, no read timeout
+            self.http = httpx.Client(
+                timeout=httpx.Timeout(None, connect=settings.forwarding.connectTimeoutMs / 1000)
+            )
+
+    def on_view_changed(self, previous: ClusterView, view: ClusterView):
+        """
+        Called by the Server with the previous and the new view on every membership change
+        """
+        this_node = self.server.host_port
+        if this_node not in view.id_host_map.values():
+            return
+        if this_node not in view.ring_nodes.values():
+            with self._join_lock:
+                if self._joining:
+                    return
+                self._joining = True
+            threading.Thread(target=self.join, name="rebalance-join", daemon=True).start()
+        elif (
+            settings.replication.factor > 1
+            and this_node in previous.ring_nodes.values()
+            and set(previous.ring_nodes.values()) - set(view.ring_nodes.values())
+        ):
+            threading.Thread(target=self.take_over, args=(previous, view), name="rebalance-leave", daemon=True).start()
+
+    def join(self):
+        try:
+            while True:
+                view = self.server.view
+                this_node = self.server.host_port
+                if this_node not in view.id_host_map.values() or this_node in view.ring_nodes.values():
+                    return
+                try:
+                    self.take_over(view, view.target, raise_errors=True)
+                    self.server.join_ring()
+                    logger.info("Joined the ring of cluster view version {}", view.version)
+                    return
+                except Exception as e:
+                    logger.warning("Could not join the ring, retrying in {}s: {}", self.retry_seconds, e)
+                    time.sleep(self.retry_seconds)
+        finally:
+            self._joining = False
+
+    def take_over(self, before: ClusterView, after: ClusterView, raise_errors: bool = False) -> int:
+        """
+        Pulls the keys this node replicates in the after view but not in the before view, returns the
+        number of keys written
+        """
+        this_node = self.server.host_port
+        alive = set(after.ring_nodes.values())
+        sources = sorted(node for node in set(before.ring_nodes.values()) if node in alive and node != this_node)
+        ingested = 0
+        with self._transfer_lock:
+            for source in sources:
+                try:
+                    ingested += self.pull(source, before, after)
+                except (httpx.HTTPError, ValueError) as e:
+                    if raise_errors:
+                        raise
+                    logger.warning("Could not pull the ranges taken over from {}: {}", source, e)
+        logger.info("Took over {} keys from {} members", ingested, len(sources))
+        return ingested
+
+    def pull(self, source: str, before: ClusterView, after: ClusterView) -> int:
+        request = {"node": self.server.host_port, "before": before.ring_nodes, "after": after.ring_nodes}
+        buffer, batch, batch_bytes, ingested = b"", [], 0, 0
+        with self.http.stream("POST", f"http://{source}/rebalance/stream", json=request) as response:
+            response.raise_for_status()
+            for chunk in response.iter_bytes():
+                rebalance_bytes.labels(direction="received").inc(len(chunk))
+                records, buffer = split_records(buffer + chunk)
+                batch.extend(records)
+                batch_bytes += len(chunk)
+                if batch_bytes >= self.sstable_bytes:
+                    ingested += self.server.ingest(batch)
+                    batch, batch_bytes = [], 0
+        if buffer:
+            raise ValueError(f"The stream from {source} ended in the middle of a record")
+        if batch:
+            ingested += self.server.ingest(batch)
+        rebalance_ingested_keys.inc(ingested)
+        return ingested
+
+    def stream(self, node: str, before: dict, after: dict):
+        """
+        Yields the records of the keys node takes over when the ring goes from the before to the after
+        members, in the WAL format and in chunks of about chunk_bytes, throttled to max_bytes_per_second
+
+        before, after: host:port of the members in the ring keyed by their election id
+        """
+        throttle = Throttle(self.max_bytes_per_second)
+        chunk = bytearray()
+        for data in self.server.transfer_records(node, ClusterView.build(0, before), ClusterView.build(0, after)):
+            chunk += encode_record(data)
+            if len(chunk) >= self.chunk_bytes:
+                throttle.wait(len(chunk))
+                rebalance_bytes.labels(direction="sent").inc(len(chunk))
+                yield bytes(chunk)
+                chunk = bytearray()
+        if chunk:
+            throttle.wait(len(chunk))
+            rebalance_bytes.labels(direction="sent").inc(len(chunk))
+            yield bytes(chunk)
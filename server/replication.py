@@ -0,0 +1,95 @@
+from loguru import logger
+from exception.exceptions import QuorumException, WriteStallException
+from lsmt.scan import next_key
+from utils.model import version_of
+from itertools import groupby
+from typing import Optional
+import asyncio
+import heapq
+
+
+def log_late_failure(task: asyncio.Task):
+    if not task.cancelled() and task.exception() is not None:
+        logger.warning("Replica request completed after the quorum and failed: {}", task.exception())
+
+
+async def quorum(calls: dict, replicas: dict, required: int) -> dict:
+    """
+    Sends the requests of every replica node concurrently and returns as soon as every key has the
+    answers of required of its replicas, the slower replicas are not waited for
+
+    calls: Awaitable per replica node, ex. {"10.0.0.1:8000": forward(...)}
+    replicas: Replica nodes per key, a node may serve the request of several keys, ex. a sub batch
+    Returns the results of the nodes that answered in time, keyed by node. Requests still running
+    complete in the background, a write keeps going to every replica. Raises WriteStallException if
+    the quorum failed because of a stalled replica, QuorumException otherwise, before sending anything
+    when a key has fewer than required replicas
+    """
+    short_keys = [key for key, nodes in replicas.items() if len(nodes) < required]
+    if short_keys:
+        for call in calls.values():
+            if asyncio.iscoroutine(call):
+                call.close()
+        raise QuorumException(f"Fewer than {required} replicas for {short_keys[:10]}")
+    keys_per_node = dict()
+    for key, nodes in replicas.items():
+        for node in nodes:
+            keys_per_node.setdefault(node, []).append(key)
+    needed = {key: required for key in replicas}
+    unanswered = {key: len(nodes) for key, nodes in replicas.items()}
+    tasks = {asyncio.ensure_future(call): node for node, call in calls.items()}
+    pending, results, failures = set(tasks), dict(), []
+    try:
+        while pending and any(needed.values()):
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                node = tasks[task]
+                if task.exception() is not None:
+                    failures.append(task.exception())
+                    logger.warning("Replica {} failed: {}", node, task.exception())
+                else:
+                    results[node] = task.result()
+                for key in keys_per_node.get(node, []):
+                    unanswered[key] -= 1
+                    if task.exception() is None and needed[key]:
+                        needed[key] -= 1
+            failed_keys = [key for key in needed if needed[key] > unanswered[key]]
+            if failed_keys:
+                if any(isinstance(failure, WriteStallException) for failure in failures):
+                    raise WriteStallException(f"Replicas of {failed_keys[:10]} are stalled: {failures}")
+                raise QuorumException(
+                    f"Fewer than {required} replicas answered for {failed_keys[:10]}: {failures}"
+                )
+        return results
+    finally:
+        for task in pending:
+            task.add_done_callback(log_late_failure)
+
+
+def newest(versions) -> Optional[dict]:
+    """
+    The newest of the versions of a key returned by its replicas, None for the replicas that have no
+    version. Deleted versions are returned as well, a delete shadows the older versions. Ordered like
+    repairs order them, see version_of
+    """
+    return max((version for version in versions if version is not None), key=version_of, default=None)
+
+
+def merge_scan_pages(pages: list, limit: int) -> dict:
+    """
+    Merges one scan page per data node into a page of at most limit keys and the start of the next one.
+    Replicas of a key on several nodes are reduced to its newest version and deleted keys are dropped,
+    the pages hold the deleted keys for that. Past the last key of a full page, a node may have more
+    keys than it returned, the page stops there
+    """
+    bound = min((page[-1]["key"] for page in pages if len(page) >= limit), default=None)
+    items = []
+    for key, versions in groupby(heapq.merge(*pages, key=lambda item: item["key"]), key=lambda item: item["key"]):
+        if bound is not None and key > bound:
+            break
+        data = newest(versions)
+        if not data["deleted"]:
+            items.append(data)
+        if len(items) == limit:
+            return {"items": items, "next": next_key(key)}
+    return {"items": items, "next": next_key(bound) if bound is not None else None}
@@ -1,13 +1,25 @@
-from utils.model import Data, PartitionMapRequest, PartitionMapOperation
+from utils.model import Data, version_of
 from kazoo.client import KazooClient
+from kazoo.recipe.watchers import ChildrenWatch
+from kazoo.exceptions import NodeExistsError
 from impl.consistent_hashing import ConsistentHashingImpl
-from lsmt.mem_table import MemTable
+from lsmt.mem_table_manager import MemTableManager
 from loguru import logger
 from lsmt.sstable import SSTable
 from scheduler.scheduler import Scheduler
 from exception.exceptions import NoDataFoundException
-from prometheus_client import Counter
+from prometheus_client import Gauge
 from partition.partition_map import PartitionMap
+from lsmt.scan import merge_newest
+from itertools import islice
+from contextlib import closing
+from server.cluster_view import ClusterView
+from server.anti_entropy import AntiEntropy
+from server.hinted_handoff import HintedHandoff
+from server.merkle_tree import MerkleTree, leaf_of
+from server.rebalancer import Rebalancer
+from config import settings
+import threading
 
 
 class Server:
@@ -16,89 +28,290 @@ class Server:
         self.zk_connection.start()
         self._private_ip = private_ip
         self._port = port
-        self._id_host_map = dict()
-        self._consistent_hash = ConsistentHashingImpl()
-        self._cache = MemTable()
+        self._view = ClusterView()
+        self._view_lock = threading.Lock()
+        # Election ids of the members in the ring, from /ring
+        self._ring_ids = set()
+        self.identifier = None
+        self._cache = MemTableManager()
         self._ss_table = SSTable()
+        # Replicas per range of the ring, rebuilt with the cluster view
         self._partition_map = PartitionMap()
-        self._key_count = Counter("key_counter", "Number of keys", labelnames=["node"])
-        self._scheduler = Scheduler(cache=self._cache)
+        # Goes down on deletes, a Counter cannot. Read from the MemTables on every scrape, see MemTableManager.key_count
+        self._key_count = Gauge("key_counter", "Number of keys", labelnames=["node"])
+        self._key_count.labels(node=self._private_ip).set_function(lambda: self._cache.key_count)
+        self.hinted_handoff = HintedHandoff(members=lambda: set(self._view.id_host_map.values()))
+        self._anti_entropy = AntiEntropy(server=self)
+        self.rebalancer = Rebalancer(server=self)
+        # Called with the new view after every membership change, main closes the pools of the members that left here
+        self.on_view_changed = None
+        self._scheduler = Scheduler(
+            cache=self._cache, hinted_handoff=self.hinted_handoff, anti_entropy=self._anti_entropy
+        )
         self._scheduler.init()
 
+    @property
+    def host_port(self) -> str:
+        return f"{self._private_ip}:{self._port}"
+
+    @property
+    def view(self) -> ClusterView:
+        return self._view
+
+    @property
+    def _id_host_map(self) -> dict:
+        return self._view.id_host_map
+
+    @property
+    def _consistent_hash(self) -> ConsistentHashingImpl:
+        return self._view.ring
+
     def get_data_node(self, key: str):
         """
         Function that leverages the consistent hash lib to determine which node should host the data
         """
-        node_id = self._consistent_hash.get_node_for_data(key)
-        node_host_port = self._id_host_map[node_id]
-        logger.info(f"Data Node is {node_host_port}")
+        node_host_port = self._view.get_data_node(key)
+        logger.debug("Data Node is {}", node_host_port)
         return node_host_port
 
+    def get_replica_nodes(self, key: str) -> list:
+        """
+        host:port of the replicas of the key, its owner first, as per replication.factor
+        """
+        return self._view.get_replica_nodes(key, settings.replication.factor)
+
+    def get_pending_nodes(self, key: str) -> list:
+        """
+        host:port of the joining nodes that get the writes of the key until they are in the ring
+        """
+        return self._view.get_pending_nodes(key, settings.replication.factor)
+
+    def owns(self, key: str) -> bool:
+        return self.get_data_node(key) == f"{self._private_ip}:{self._port}"
+
+    def get_ring(self) -> dict:
+        """
+        The hash ring as published to clients, they rebuild it with ClusterView.build. Joining members
+        are left out until they are in the ring
+        """
+        view = self._view
+        return {"version": view.version, "nodes": view.ring_nodes}
+
     ####################################### Data Node Functions ########################################
 
     def add_data(self, data: Data):
-        self._key_count.labels(node=self._private_ip).inc(1)
         self._cache.add(data)
-        self._partition_map.update(data, f"{self._private_ip}:{self._port}")
+
+    def add_batch(self, batch: list):
+        self._cache.add_batch(batch)
+
+    def get_batch(self, keys: list, include_deleted: bool = False) -> dict:
+        """
+        Returns the data of every key, None for the keys that are missing or deleted
+        """
+        batch = dict()
+        for key in keys:
+            try:
+                batch[key] = self.get_data(key, include_deleted)
+            except NoDataFoundException:
+                batch[key] = None
+        return batch
 
     def delete_data(self, key: str):
         data = self.get_data(key)
         self.add_data(Data(key=data.key, value=data.value, deleted=True))
-        self._partition_map.get(key).remove(f"{self._private_ip}:{self._port}")
-        self._key_count.labels(node=self._private_ip).inc(-1)
 
-    def get_data(self, key) -> Data:
+    def get_data(self, key, include_deleted: bool = False) -> Data:
+        """
+        include_deleted: Returns the deleted data as well, the coordinator of a replicated read needs
+        it to tell a delete from a replica that missed the key
+        """
         data = None
         try:
-            logger.info("Checking for {} in cache", key)
+            logger.debug("Checking for {} in cache", key)
             data = self._cache.get_data(key)
         except NoDataFoundException:
-            logger.info("Key {} not found in cache, checking in SSTable", key)
+            logger.debug("Key {} not found in cache, checking in SSTable", key)
             data = self._ss_table.get_data(key)
-        if data.deleted:
+        if data.deleted and not include_deleted:
             raise NoDataFoundException(f"Key {key} is missing")
         return data
 
+    def scan(self, start: str = None, end: str = None, include_deleted: bool = False):
+        """
+        Yields the data with start <= key < end in key order, merged over the MemTables and SSTables.
+        The newest version of every key wins and deleted keys are skipped unless include_deleted is set
+        """
+        # The MemTables first, the SSTables they flush into meanwhile are picked up by the snapshot
+        mem_tables = self._cache.scan(start, end)
+        with self._ss_table.open_range(start, end) as sstables:
+            for data in merge_newest(mem_tables + sstables):
+                if include_deleted or not data.deleted:
+                    yield data
+
+    def scan_page(self, start: str = None, end: str = None, limit: int = None, include_deleted: bool = False) -> list:
+        # Closing the scan releases the data files it mapped
+        with closing(self.scan(start, end, include_deleted)) as scan:
+            return list(islice(scan, limit))
+
+    ######################### Replica Repair ###########################################################
+
+    def is_newer(self, data: Data) -> bool:
+        """
+        Whether data is newer than the version of its key on this node, if any
+        """
+        try:
+            current = self.get_data(data.key, include_deleted=True)
+        except NoDataFoundException:
+            return True
+        return version_of(data) > version_of(current)
+
+    def repair(self, batch: list) -> int:
+        """
+        Applies the data of the batch that is newer than the version this node has, used by hinted
+        handoff and anti-entropy, which may carry writes older than the ones this node got since.
+        Returns the number of keys applied
+        """
+        newer = [data for data in batch if self.is_newer(data)]
+        if newer:
+            self.add_batch(newer)
+        return len(newer)
+
+    def get_peers(self) -> list:
+        return self._view.get_peers(self.host_port, settings.replication.factor)
+
+    def shared_records(self, peer: str):
+        """
+        Yields the data of the keys this node and peer are both replicas of, deleted keys included
+        """
+        with closing(self.scan(include_deleted=True)) as scan:
+            for data in scan:
+                replicas = self.get_replica_nodes(data.key)
+                if peer in replicas and self.host_port in replicas:
+                    yield data
+
+    def merkle_tree(self, peer: str, depth: int) -> MerkleTree:
+        with closing(self.shared_records(peer)) as records:
+            return MerkleTree.build(records, depth)
+
+    def leaf_records(self, peer: str, leaves: list, depth: int) -> list:
+        leaves = set(leaves)
+        with closing(self.shared_records(peer)) as records:
+            return [data for data in records if leaf_of(data.key, depth) in leaves]
+
+    ######################### Rebalancing ##############################################################
+
+    def ingest(self, batch: list) -> int:
+        """
+        Writes data streamed in by rebalancing straight to an SSTable, only the data newer than the
+        version this node has. Returns the number of keys written
+        """
+        return len(self._cache.ingest(batch, self.is_newer))
+
+    def transfer_records(self, node: str, before: ClusterView, after: ClusterView):
+        """
+        Yields the data, deleted keys included, that node replicates in the after view but not in the
+        before one and that this node is the first member of the before replicas still in the after view
+        """
+        factor = settings.replication.factor
+        alive = set(after.ring_nodes.values())
+        with closing(self.scan(include_deleted=True)) as scan:
+            for data in scan:
+                if node not in after.get_replica_nodes(data.key, factor):
+                    continue
+                replicas = before.get_replica_nodes(data.key, factor)
+                if node in replicas:
+                    continue
+                if next((replica for replica in replicas if replica in alive), None) == self.host_port:
+                    yield data
+
+    def join_ring(self):
+        """
+        Adds this node to the hash ring, called once it holds the data of the ranges it takes over
+        """
+        try:
+            self.zk_connection.create(
+                f"/ring/n_{self.identifier:010d}", ephemeral=True, value=self.host_port.encode()
+            )
+        except NodeExistsError:
+            logger.info("Already in the ring")
+
     ######################### Coordination and Discovery ###########################################
 
-    def watch_for_child_nodes(self, event):
-        logger.info(f"Looks like children changed, event received is {event.state}")
-        if event.state == "CONNECTED" and self.check_if_leader():
-            logger.info("A new follower has been added")
-            children = self.zk_connection.get_children("/election")
-            logger.info(f"Entries found for child: {children}")
+    def on_ring_changed(self, children):
+        """
+        ChildrenWatch callback on /ring, the members that hold the data of their ranges
+        """
+        logger.info(f"Members of the ring changed, children are {children}")
+        with self._view_lock:
+            previous = self._view
+            self._ring_ids = {str(child).replace("n_", "") for child in children}
+            self._view = ClusterView.build(previous.version + 1, previous.id_host_map, self._ring_ids)
+        self.view_changed(previous)
+
+    def on_members_changed(self, children):
+        """
+        ChildrenWatch callback on /election, called by kazoo with the current children on every
+        membership change. Rebuilds the cluster view, the request path only ever reads it
+        """
+        logger.info(f"Members of the cluster changed, children are {children}")
+        with self._view_lock:
+            previous = self._view
+            id_host_map = dict()
             for child in children:
-                data, _ = self.zk_connection.get(f"/election/{child}")
                 id = str(child).replace("n_", "")
-                logger.info(f"Data associated with the child {data} and id is {id}")
+                host_port = self._view.id_host_map.get(id)
+                if host_port is None:
+                    data, _ = self.zk_connection.get(f"/election/{child}")
+                    if data is None:
+                        continue
+                    host_port = data.decode()
+                    logger.info(f"Data associated with the child {host_port} and id is {id}")
+                id_host_map[id] = host_port
+            self._view = ClusterView.build(self._view.version + 1, id_host_map, self._ring_ids)
+        self.view_changed(previous)
 
-                if id not in self._id_host_map:
-                    self._consistent_hash.add_node(str(id))
-                    self._id_host_map[id] = data.decode()
-
-    def check_if_leader(self):
-        children = self.zk_connection.get_children("/election")
-        ids = sorted([int(str(child).replace("n_", "")) for child in children])
+    def view_changed(self, previous: ClusterView):
+        view = self._view
         logger.info(
-            "Sorted ids %s and leader is %s, id is %s" % (ids, ids[0], self.identifier)
+            "Cluster view version {} has {} members, {} of them in the ring, leader is {}",
+            view.version,
+            len(view.id_host_map),
+            len(view.node_ids),
+            view.leader_id,
         )
-        if ids[0] == self.identifier:
-            return True
-        return False
+        self._partition_map = view.partition_map(settings.replication.factor)
+        try:
+            self._partition_map.save(settings.dataDirectory)
+        except OSError as e:
+            logger.warning("Could not snapshot the partition map: {}", e)
+        self.rebalancer.on_view_changed(previous, view)
+        if self.on_view_changed is not None:
+            self.on_view_changed(view)
+
+    def check_if_leader(self):
+        return self.identifier is not None and self._view.leader_id == self.identifier
 
     def get_all_nodes(self):
-        return self.zk_connection.get_children("/election")
+        return [f"n_{id}" for id in sorted(self._view.id_host_map)]
 
-    def update_partiton_map(self, request: PartitionMapRequest):
-        if request.operation == PartitionMapOperation.new:
-            self._partition_map.update(request.key, request.node_details)
-        else:
-            self._partition_map.remove(request.key, request.node_details)
+    def get_partition_map(self) -> dict:
+        return self._partition_map.to_dict()
 
     ############################ The beginning #######################################################
 
     def start(self):
         logger.info("======== Starting server, may lord have mercy ===========")
+        self._ss_table.load_indexes()
+        self._cache.recover()
+        last_partition_map = PartitionMap.load(settings.dataDirectory)
+        if last_partition_map.tokens:
+            logger.info(
+                "This node was a replica of {} of {} ranges in the partition map of cluster view version {}",
+                len(last_partition_map.ranges_of(self.host_port)),
+                len(last_partition_map.tokens),
+                last_partition_map.version,
+            )
         # Step 1: Create root node
         if self.zk_connection.ensure_path("/election"):
             # Step 2: Create a ephermal and sequence node
@@ -114,6 +327,7 @@ class Server:
             logger.info("Created ephermal node %s" % child)
             if child:
                 self.identifier = int(str(child).replace("/election/n_", ""))
-                self.zk_connection.get_children(
-                    "/election", watch=self.watch_for_child_nodes
-                )
+                # Keep the cluster view up to date, kazoo calls them right away and on every change
+                self.zk_connection.ensure_path("/ring")
+                ChildrenWatch(self.zk_connection, "/ring", self.on_ring_changed)
+                ChildrenWatch(self.zk_connection, "/election", self.on_members_changed)
@@ -0,0 +1,30 @@
+import httpx
+import json
+from unittest.mock import MagicMock
+from server.anti_entropy import AntiEntropy
+from server.merkle_tree import MerkleTree, leaf_of
+from utils.model import Data
+
+
+def test_repair_exchanges_the_newest_versions():
+    local = [Data(key="key1", value="a", timestamp=1), Data(key="key2", value="new", timestamp=5), Data(key="key3", value="c", timestamp=1)]
+    remote = [Data(key="key1", value="a", timestamp=1), Data(key="key2", value="old", timestamp=2), Data(key="key4", value="d", timestamp=1)]
+    server = MagicMock()
+    server.host_port = "10.0.0.1:8000"
+    server.merkle_tree.return_value = MerkleTree.build(local, 4)
+    server.leaf_records.side_effect = lambda peer, leaves, depth: [data for data in local if leaf_of(data.key, depth) in leaves]
+    applied = []
+
+    def handler(request):
+        if request.url.path == "/repair/tree":
+            return httpx.Response(200, json=MerkleTree.build(remote, 4).to_dict())
+        if request.url.path == "/repair/leaves":
+            leaves = json.loads(request.content)["leaves"]
+            return httpx.Response(200, json=[data.model_dump() for data in remote if leaf_of(data.key, 4) in leaves])
+        applied.extend(item["key"] for item in json.loads(request.content)["items"])
+        return httpx.Response(200, json={"applied": len(applied)})
+
+    anti_entropy = AntiEntropy(server=server, depth=4, http=httpx.Client(transport=httpx.MockTransport(handler)))
+    assert anti_entropy.repair("10.0.0.2:8000") == 3
+    assert [data.key for data in server.repair.call_args[0][0]] == ["key4"]
+    assert sorted(applied) == ["key2", "key3"]
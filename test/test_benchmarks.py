@@ -0,0 +1,31 @@
+from kazoo.recipe.watchers import ChildrenWatch
+from benchmarks.compare import compare
+from benchmarks.local_node import FakeZooKeeper
+from benchmarks.report import percentile, summarize
+
+
+def test_summarize():
+    result = summarize("read", [0.001 * latency for latency in range(100, 0, -1)], 2.0)
+    assert (result["ops"], result["ops_per_sec"]) == (100, 50.0)
+    assert (result["p50_ms"], result["p95_ms"], result["p99_ms"], result["max_ms"]) == (50, 95, 99, 100)
+    assert percentile([], 99) == 0.0
+
+
+def test_compare_flags_regressions():
+    baseline = {"results": [{"workload": "read", "ops_per_sec": 100, "p99_ms": 10}, {"workload": "write", "ops_per_sec": 100, "p99_ms": 10}]}
+    current = {"results": [{"workload": "read", "ops_per_sec": 95, "p99_ms": 10.5}, {"workload": "write", "ops_per_sec": 80, "p99_ms": 10}]}
+    rows = compare(baseline, current, threshold=10)
+    assert [(row["workload"], row["regression"]) for row in rows] == [("read", False), ("write", True)]
+
+
+def test_fake_zookeeper_children_watch():
+    zk = FakeZooKeeper()
+    zk.ensure_path("/election")
+    seen = []
+    ChildrenWatch(zk, "/election", seen.append)
+    first = zk.create("/election/n_", value=b"127.0.0.1:8000", ephemeral=True, sequence=True)
+    zk.create("/election/n_", value=b"127.0.0.1:8001", ephemeral=True, sequence=True)
+    assert first == "/election/n_0000000000"
+    assert zk.get(first)[0] == b"127.0.0.1:8000"
+    zk.delete(first)
+    assert seen == [[], ["n_0000000000"], ["n_0000000000", "n_0000000001"], ["n_0000000001"]]
@@ -0,0 +1,37 @@
+import pytest
+from lsmt.bloom_filter import BloomFilter
+
+
+@pytest.fixture
+def bloom_filter():
+    bloom_filter = BloomFilter.for_capacity(1000, false_positive_rate=0.01)
+    for i in range(1000):
+        bloom_filter.add(f"key{i}")
+    yield bloom_filter
+
+
+def test_might_contain(bloom_filter):
+    assert all(bloom_filter.might_contain(f"key{i}") for i in range(1000))
+    false_positives = sum(bloom_filter.might_contain(f"missing{i}") for i in range(10000))
+    assert false_positives < 300
+
+
+def test_serialization(bloom_filter):
+    restored = BloomFilter.from_bytes(bloom_filter.to_bytes())
+    assert restored == bloom_filter
+
+
+def test_load_missing_file(tmp_path):
+    assert BloomFilter.load(f"{tmp_path}/missing.bloom") is None
+
+
+def test_load_corrupt_file(tmp_path, bloom_filter):
+    bloom_file = f"{tmp_path}/corrupt.bloom"
+    bloom_filter.save(bloom_file)
+    assert BloomFilter.load(bloom_file) == bloom_filter
+    data = bloom_filter.to_bytes()
+    # An empty file, a truncated header and a truncated bit array are searched like a missing filter
+    for corrupt in (b"", data[:3], data[:-1]):
+        with open(bloom_file, "wb") as fp_bloom_file:
+            fp_bloom_file.write(corrupt)
+        assert BloomFilter.load(bloom_file) is None
@@ -1,54 +1,138 @@
 import pytest
-from unittest.mock import patch, MagicMock
-from compaction.compaction import Compaction
-from collections import defaultdict
+import time
+from unittest.mock import patch
+from compaction.compaction import Compaction, SizeTieredStrategy, LeveledStrategy
+from lsmt.manifest import Manifest
+from lsmt.sstable import SSTable
+from lsmt.sstable_format import SSTableWriter, iter_records
+from exception.exceptions import NoDataFoundException
+
 
 # Fixing the scope this will make sure that the compaction object is created only once
 @pytest.fixture(scope='session')
 def compaction():
     yield Compaction(max_data_files=2, data_dir='/tmp')
 
-@patch('glob.glob')
-def test_can_compact(mock_glob, compaction):
-    mock_glob.return_value = ['file1.index', 'file2.index']
+
+@pytest.fixture
+def sstables(tmp_path):
+    """
+    Three SSTables, oldest first, registered in a manifest of their own
+    """
+    test_manifest = Manifest(data_dir=str(tmp_path))
+    generations = [
+        [("key1", "a", False), ("key2", "a", False), ("key3", "a", False)],
+        [("key1", "b", False), ("key2", "", True), ("key4", "b", False)],
+        [("key1", "c", False), ("key5", "c", True)],
+    ]
+    for records in generations:
+        file_id = test_manifest.next_file_id()
+        with SSTableWriter(f"{tmp_path}/{file_id}.data") as writer:
+            for key, value, deleted in records:
+                writer.add(key, value, 12345, deleted)
+        test_manifest.add(file_id)
+    with patch('compaction.compaction.manifest', test_manifest), patch('lsmt.sstable.manifest', test_manifest):
+        yield test_manifest
+
+
+def sstable(file_id, size, level=0, min_key=None, max_key=None):
+    return {"file_id": file_id, "level": level, "min_key": min_key, "max_key": max_key, "size": size}
+
+
+@patch('compaction.compaction.manifest')
+def test_can_compact(mock_manifest, compaction):
+    mock_manifest.snapshot.return_value.sstables = [sstable('0000000002', 100), sstable('0000000001', 100)]
     assert compaction.can_compact() == True
+    mock_manifest.snapshot.return_value.sstables = [sstable('0000000002', 100)]
+    assert compaction.can_compact() == False
+
+
+def test_size_tiered_picks_adjacent_similar_sstables():
+    strategy = SizeTieredStrategy(min_files=2, max_files=4, bucket_ratio=2, min_tier_bytes=10)
+    sstables = [sstable("5", 1), sstable("4", 100), sstable("3", 150), sstable("2", 120), sstable("1", 1000)]
+    task = strategy.pick(sstables)
+    assert task.file_ids == ["4", "3", "2"]
+    assert task.drop_tombstones == False
+    # A run reaching the oldest SSTable can drop tombstones
+    task = strategy.pick(sstables[:1] + [sstable("1", 5)])
+    assert task.file_ids == ["5", "1"] and task.drop_tombstones == True
+    assert strategy.pick([sstable("2", 10), sstable("1", 1000)]) is None
+
+
+def test_leveled_picks_overlapping_sstables():
+    strategy = LeveledStrategy(min_files=2, max_files=4, level_base_bytes=100, level_multiplier=10)
+    sstables = [
+        sstable("6", 10, 0, "d", "f"), sstable("5", 10, 0, "b", "c"),
+        sstable("4", 50, 1, "a", "b"), sstable("3", 50, 1, "c", "e"), sstable("2", 50, 1, "x", "z"),
+        sstable("1", 500, 2, "a", "z"),
+    ]
+    task = strategy.pick(sstables)
+    assert task.file_ids == ["6", "5", "4", "3"]
+    assert (task.output_level, task.drop_tombstones) == (1, False)
+    # Level 1 is over its 100 bytes, its oldest SSTable moves down to the last level
+    task = strategy.pick(sstables[2:])
+    assert task.file_ids == ["2", "1"]
+    assert (task.output_level, task.drop_tombstones) == (2, True)
+    assert strategy.pick(sstables[3:]) is None
+
+
+def test_merge_newest_wins(sstables):
+    compaction = Compaction(data_dir=sstables.data_dir)
+    merged = list(compaction.merge(sstables.index_files(), drop_tombstones=False))
+    assert [(record.key, bytes(record.value), record.deleted) for record in merged] == [
+        ("key1", b"c", False), ("key2", b"", True), ("key3", b"a", False),
+        ("key4", b"b", False), ("key5", b"c", True),
+    ]
+    merged = list(compaction.merge(sstables.index_files(), drop_tombstones=True))
+    assert [record.key for record in merged] == ["key1", "key3", "key4"]
+
+
+def test_compact(sstables, tmp_path):
+    compaction = Compaction(data_dir=sstables.data_dir)
+    compaction.compact()
+    [file_id] = sstables.file_ids()
+    assert file_id.endswith("c")
+    with open(f"{tmp_path}/{file_id}.data", "rb") as fp_data_file:
+        assert [record.key for record, _, _ in iter_records(fp_data_file)] == ["key1", "key3", "key4"]
+    assert (tmp_path / "0000000000.data.backup").exists()
+    assert sstables.sstables()[0]["min_key"] == "key1"
+
+    sstable = SSTable()
+    assert sstable.get_data("key1").value == "c"
+    with pytest.raises(NoDataFoundException):
+        sstable.get_data("key2")
+
+
+def test_leveled_compaction_splits_output(sstables, tmp_path):
+    compaction = Compaction(data_dir=sstables.data_dir, strategy=LeveledStrategy(max_file_bytes=1))
+    file_ids = compaction.compact()
+    assert len(file_ids) == 3
+    assert [sstable["level"] for sstable in sstables.sstables()] == [1, 1, 1]
+    assert [sstable["min_key"] for sstable in sstables.sstables()] == ["key1", "key3", "key4"]
+    assert SSTable().get_data("key4").value == "b"
+
+
+def test_worker_compacts_while_flushing(sstables, tmp_path):
+    compaction = Compaction(data_dir=sstables.data_dir)
+    compaction.start()
+    compaction.wakeup()
+    # A flush registered while the worker runs stays ahead of the compacted SSTable
+    file_id = sstables.next_file_id()
+    with SSTableWriter(f"{tmp_path}/{file_id}.data") as writer:
+        writer.add("key1", "d", 12345, False)
+    sstables.add(file_id)
+    compaction.wakeup()
+    for _ in range(100):
+        if len(sstables.file_ids()) == 1:
+            break
+        time.sleep(0.05)
+    assert len(sstables.file_ids()) == 1
+    assert SSTable().get_data("key1").value == "d"
 
-@patch('json.load')
-@patch('builtins.open')
-def test_prepare_data(mock_open, mock_json_load, compaction):
-    index_files = ['file1.index', 'file2.index']
-    key_offset_map = dict()
-    file_key_map = defaultdict(set)
-    mock_json_load.return_value = {"name": {"key": "name", "value": "somename", "timestamp": 123456, "deleted": False}}
-    compaction.prepare_data(index_files=index_files, file_key_map=file_key_map, 
-                            key_offset_map=key_offset_map)
-    assert len(key_offset_map) != 0
-
-@patch('os.rename')
-@patch('json.dump')
-@patch('builtins.open')
-def test_create_compacted_files(mock_open, mock_json_dump, mock_os_rename, compaction):
-    mock_compacted_data_file = MagicMock()
-    mock_open.return_value.__enter__.return_value = mock_compacted_data_file
-    file_key_map = {"sample_data_1.data":["key1", "key2"], "sample_data_2.data":["key3"]}
-    key_offset_map = {"key1": {"start": 1, "end": 10, "timestamp": 12345, "deleted": "False"},
-                      "key2": {"start": 11, "end": 20, "timestamp": 12355, "deleted": "False"},
-                      "key3": {"start": 21, "end": 30, "timestamp": 12365, "deleted": "False"},
-                      "key4": {"start": 31, "end": 40, "timestamp": 12375, "deleted": "False"}
-                      }
-    mock_compacted_data_file.seek.return_value = 1
-    mock_compacted_data_file.read.return_value = "something".encode()
-    writes  = MagicMock()
-    mock_compacted_data_file.write = writes
-    compaction.data_dir = "/tmp"
-    compaction.create_compacted_files(file_key_map=file_key_map, key_offset_map=key_offset_map, 
-                                      index_files=["sample_data_1.index", "sample_data_2.index"])
-    writes.assert_called_with("something".encode())
-    writes.assert_called()
-    assert writes.call_count == 3
-    mock_os_rename.assert_called()
-    assert mock_os_rename.call_count == 4
-
-
-    
 
+def test_get_data_retries_on_retired_sstable(sstables):
+    stale_snapshot = sstables.snapshot()
+    Compaction(data_dir=sstables.data_dir).compact()
+    # The read planned on the SSTables compaction just retired
+    with patch.object(sstables, 'snapshot', side_effect=[stale_snapshot, sstables.snapshot()]):
+        assert SSTable().get_data("key1").value == "c"
@@ -0,0 +1,55 @@
+import httpx
+import json
+import pytest
+from client.core_cache_client import CoreCacheClient
+from server.cluster_view import ClusterView
+from exception.exceptions import NoDataFoundException
+
+NODES = {"1": "node1:8000", "2": "node2:8000"}
+
+
+def cluster(ring_version, owners, calls):
+    """
+    Mock transport for a cluster whose nodes serve the keys owned by them as per owners
+    """
+    store = {}
+
+    def handler(request: httpx.Request):
+        host_port = f"{request.url.host}:{request.url.port}"
+        calls.append((host_port, request.url.path))
+        headers = {"X-Ring-Version": str(ring_version)}
+        if request.url.path == "/ring":
+            return httpx.Response(200, json={"version": ring_version, "nodes": owners}, headers=headers)
+        key = request.url.params.get("key") or json.loads(request.content)["key"]
+        if ClusterView.build(ring_version, owners).get_data_node(key) != host_port:
+            return httpx.Response(409, json={"detail": "stale ring"}, headers=headers)
+        if request.url.path == "/add/":
+            store[key] = json.loads(request.content)
+            return httpx.Response(200, json=None, headers=headers)
+        if key not in store:
+            return httpx.Response(404, json={"detail": "No data found"}, headers=headers)
+        return httpx.Response(200, json=store[key], headers=headers)
+
+    return httpx.Client(transport=httpx.MockTransport(handler))
+
+
+def test_routes_to_owner():
+    calls = []
+    client = CoreCacheClient(seed_nodes=["node1:8000"], http=cluster(1, NODES, calls))
+    client.add("name", "somename")
+    assert client.get("name").value == "somename"
+    owner = ClusterView.build(1, NODES).get_data_node("name")
+    assert calls == [("node1:8000", "/ring"), (owner, "/add/"), (owner, "/get/")]
+    with pytest.raises(NoDataFoundException):
+        client.get("other")
+
+
+def test_refreshes_stale_ring():
+    calls = []
+    client = CoreCacheClient(seed_nodes=["node1:8000"], http=cluster(2, {"2": "node2:8000"}, calls))
+    # The cached ring still has node1, which left the cluster
+    client._view, client._stale = ClusterView.build(1, NODES), False
+    key = next(key for key in map(str, range(100)) if client._view.get_data_node(key) == "node1:8000")
+    client.add(key, "somename")
+    assert client._view.version == 2
+    assert calls[-1] == ("node2:8000", "/add/")
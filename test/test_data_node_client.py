@@ -0,0 +1,52 @@
+import asyncio
+import httpx
+import pytest
+from server.data_node_client import DataNodeClients
+from exception.exceptions import NoDataFoundException, WriteStallException
+
+
+def mock_clients(handler) -> DataNodeClients:
+    clients = DataNodeClients()
+    clients._clients["node1:8000"] = httpx.AsyncClient(
+        base_url="http://node1:8000", transport=httpx.MockTransport(handler)
+    )
+    return clients
+
+
+def test_forward_as_leader():
+    def handler(request: httpx.Request):
+        assert request.url.params["token"] == "leader"
+        return httpx.Response(200, json={"key": request.url.params["key"], "value": "somename"})
+
+    clients = mock_clients(handler)
+    response = asyncio.run(clients.forward("GET", "node1:8000", "/get/", params={"key": "name"}))
+    assert response == {"key": "name", "value": "somename"}
+
+
+@pytest.mark.parametrize("status_code, exception", [(404, NoDataFoundException), (429, WriteStallException)])
+def test_forward_maps_status(status_code, exception):
+    clients = mock_clients(lambda request: httpx.Response(status_code, json={"detail": "nope"}))
+    with pytest.raises(exception):
+        asyncio.run(clients.forward("POST", "node1:8000", "/add/", json={}))
+
+
+def test_pool_per_data_node():
+    clients = DataNodeClients(pool_size=4)
+    assert clients.get("node1:8000") is clients.get("node1:8000")
+    assert clients.get("node1:8000") is not clients.get("node2:8000")
+    asyncio.run(clients.close())
+    assert clients._clients == {}
+
+
+def test_retain_closes_departed_nodes():
+    async def run():
+        clients = DataNodeClients(pool_size=4)
+        node1, node2 = clients.get("node1:8000"), clients.get("node2:8000")
+        # Called from a ZooKeeper watch thread, the pool is closed on the event loop
+        await asyncio.get_running_loop().run_in_executor(None, clients.retain, ["node1:8000"])
+        await asyncio.sleep(0.01)
+        assert list(clients._clients) == ["node1:8000"]
+        assert node2.is_closed and not node1.is_closed
+        await clients.close()
+
+    asyncio.run(run())
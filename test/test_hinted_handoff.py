@@ -0,0 +1,58 @@
+import httpx
+from server.hinted_handoff import HintedHandoff
+from utils.model import Data
+
+
+def hinted_handoff(tmp_path, handler, members=("10.0.0.2:8000",), **kwargs):
+    return HintedHandoff(
+        hints_dir=str(tmp_path / "hints"),
+        members=lambda: set(members),
+        http=httpx.Client(transport=httpx.MockTransport(handler)),
+        **kwargs,
+    )
+
+
+def test_deliver_hints_to_members(tmp_path):
+    received = []
+
+    def handler(request):
+        received.append((request.url.host, request.url.path, httpx.Response(200, content=request.content).json()))
+        return httpx.Response(200, json={"applied": 1})
+
+    handoff = hinted_handoff(tmp_path, handler, batch_size=2)
+    handoff.add("10.0.0.2:8000", [Data(key=f"key{index}", value="a", timestamp=1) for index in range(3)])
+    handoff.add("10.0.0.3:8000", [Data(key="key9", value="a", timestamp=1)])
+    assert sorted(handoff.targets()) == ["10.0.0.2:8000", "10.0.0.3:8000"]
+    handoff.deliver()
+    assert [(host, path, len(body["items"])) for host, path, body in received] == [
+        ("10.0.0.2", "/repair/apply", 2),
+        ("10.0.0.2", "/repair/apply", 1),
+    ]
+    # 10.0.0.3 is not a member, its hints are kept until it is back
+    assert handoff.targets() == ["10.0.0.3:8000"]
+
+
+def test_failed_delivery_keeps_the_hints(tmp_path):
+    calls = []
+
+    def handler(request):
+        calls.append(request)
+        if len(calls) > 1:
+            raise httpx.ConnectError("Connection refused", request=request)
+        return httpx.Response(200, json={"applied": 1})
+
+    handoff = hinted_handoff(tmp_path, handler, batch_size=1)
+    handoff.add("10.0.0.2:8000", [Data(key="key1", value="a"), Data(key="key2", value="b")])
+    handoff.deliver()
+    assert [data.key for data in handoff._read("10.0.0.2:8000")] == ["key2"]
+
+
+def test_hints_past_the_limit_are_dropped(tmp_path):
+    handoff = hinted_handoff(tmp_path, lambda request: httpx.Response(200), max_hints_per_node=2)
+    handoff.add("10.0.0.2:8000", [Data(key="key1", value="a")])
+    handoff.add("10.0.0.2:8000", [Data(key="key2", value="a"), Data(key="key3", value="a")])
+    assert [data.key for data in handoff._read("10.0.0.2:8000")] == ["key1", "key2"]
+    # The count survives a restart
+    restarted = hinted_handoff(tmp_path, lambda request: httpx.Response(200), max_hints_per_node=2)
+    restarted.add("10.0.0.2:8000", [Data(key="key4", value="a")])
+    assert len(restarted._read("10.0.0.2:8000")) == 2
@@ -0,0 +1,53 @@
+import pytest
+from unittest.mock import patch
+from server.hot_key_cache import HotKeyCache
+from utils.model import Data
+
+
+@pytest.fixture
+def hot_key_cache():
+    yield HotKeyCache(enabled=True, max_entries=2, ttl_seconds=60)
+
+
+def test_fill_and_evict_least_recently_used(hot_key_cache):
+    assert hot_key_cache.get("key1") is None
+    hot_key_cache.fill(Data(key="key1", value="a", timestamp=1), hot_key_cache.generation)
+    hot_key_cache.fill(Data(key="key2", value="b", timestamp=1), hot_key_cache.generation)
+    assert hot_key_cache.get("key1").value == "a"
+    hot_key_cache.fill(Data(key="key3", value="c", timestamp=1), hot_key_cache.generation)
+    assert "key1" in hot_key_cache and "key2" not in hot_key_cache
+    assert len(hot_key_cache) == 2
+
+
+def test_invalidate_rejects_reads_in_flight(hot_key_cache):
+    hot_key_cache.fill(Data(key="key1", value="a", timestamp=10), hot_key_cache.generation)
+    read_in_flight = hot_key_cache.generation
+    hot_key_cache.invalidate("key1", 10)
+    assert hot_key_cache.get("key1") is None
+    # Read before the write was applied, its data is not newer than the write
+    hot_key_cache.fill(Data(key="key1", value="a", timestamp=10), read_in_flight)
+    assert hot_key_cache.get("key1") is None
+    # Read started after the write
+    hot_key_cache.fill(Data(key="key1", value="b", timestamp=10), hot_key_cache.generation)
+    # A late read in flight during the write must not replace it
+    hot_key_cache.fill(Data(key="key1", value="a", timestamp=10), read_in_flight)
+    assert hot_key_cache.get("key1").value == "b"
+    # Data newer than the write is never stale
+    hot_key_cache.fill(Data(key="key1", value="c", timestamp=11), read_in_flight)
+    assert hot_key_cache.get("key1").value == "c"
+
+
+@patch("server.hot_key_cache.time.monotonic")
+def test_entries_expire(mock_monotonic, hot_key_cache):
+    mock_monotonic.return_value = 100
+    hot_key_cache.fill(Data(key="key1", value="a", timestamp=1), hot_key_cache.generation)
+    mock_monotonic.return_value = 161
+    assert hot_key_cache.get("key1") is None
+    assert len(hot_key_cache) == 0
+
+
+def test_disabled():
+    hot_key_cache = HotKeyCache(enabled=False)
+    hot_key_cache.fill(Data(key="key1", value="a"), hot_key_cache.generation)
+    hot_key_cache.invalidate("key1", 1)
+    assert hot_key_cache.get("key1") is None and len(hot_key_cache) == 0
@@ -0,0 +1,34 @@
+import pytest
+from unittest.mock import patch
+from lsmt.index_cache import IndexCache
+
+
+@pytest.fixture
+def index_cache():
+    yield IndexCache(max_entries=2)
+
+
+@patch('json.load')
+@patch('builtins.open')
+def test_get_loads_once(mock_open, mock_json_load, index_cache):
+    mock_json_load.return_value = {"name": {"start": 0, "end": 10}}
+    assert index_cache.get("file1.index") == {"name": {"start": 0, "end": 10}}
+    assert index_cache.get("file1.index") == {"name": {"start": 0, "end": 10}}
+    assert mock_json_load.call_count == 1
+
+
+def test_put_evicts_least_recently_used(index_cache):
+    index_cache.put("file1.index", {})
+    index_cache.put("file2.index", {})
+    index_cache.get("file1.index")
+    index_cache.put("file3.index", {})
+    assert "file1.index" in index_cache
+    assert "file2.index" not in index_cache
+    assert len(index_cache) == 2
+
+
+def test_invalidate(index_cache):
+    index_cache.put("file1.index", {})
+    index_cache.invalidate("file1.index")
+    index_cache.invalidate("file2.index")
+    assert "file1.index" not in index_cache
@@ -0,0 +1,36 @@
+from unittest.mock import patch
+import logging
+import sys
+from loguru import logger
+from utils.log_config import configure_logging, sample_request
+
+
+def test_levels_per_subsystem():
+    settings_logging = {
+        "level": "WARNING",
+        "levels": {"lsmt": "DEBUG"},
+        "libraryLevels": {"impl.consistent_hashing": "ERROR"},
+        "enqueue": False,
+        "serialize": False,
+    }
+    messages = []
+    with patch("utils.log_config.settings") as mock_settings:
+        mock_settings.logging.configure_mock(**settings_logging)
+        configure_logging(sink=lambda message: messages.append(message.record["message"]))
+    try:
+        logger.patch(lambda record: record.update(name="lsmt.mem_table")).debug("per key")
+        logger.patch(lambda record: record.update(name="server.server")).info("per request")
+        logger.patch(lambda record: record.update(name="server.server")).warning("slow request")
+        assert messages == ["per key", "slow request"]
+        assert logging.getLogger("impl.consistent_hashing").level == logging.ERROR
+    finally:
+        logger.remove()
+        logger.add(sys.stderr)
+
+
+def test_sample_request():
+    with patch("utils.log_config.settings") as mock_settings:
+        mock_settings.logging.requestSampleRate = 0
+        assert not any(sample_request() for _ in range(100))
+        mock_settings.logging.requestSampleRate = 1
+        assert all(sample_request() for _ in range(100))
@@ -0,0 +1,63 @@
+import pytest
+from lsmt.manifest import Manifest
+from exception.exceptions import StaleSnapshotException
+
+
+@pytest.fixture
+def manifest(tmp_path):
+    yield Manifest(data_dir=str(tmp_path))
+
+
+def test_add_newest_first(manifest):
+    first, second = manifest.next_file_id(), manifest.next_file_id()
+    manifest.add(first)
+    manifest.add(second)
+    assert manifest.file_ids() == [second, first]
+
+
+def test_replace_keeps_newer_files_ahead(manifest):
+    for _ in range(3):
+        manifest.add(manifest.next_file_id())
+    newest, middle, oldest = manifest.file_ids()
+    compacted = manifest.next_file_id(compacted=True)
+    manifest.replace([middle, oldest], [compacted])
+    assert manifest.file_ids() == [newest, compacted]
+
+
+def test_read_order_by_level(manifest):
+    for _ in range(3):
+        manifest.add(manifest.next_file_id(), {"level": 0, "min_key": "a", "max_key": "z", "size": 10})
+    newest, middle, oldest = manifest.file_ids()
+    compacted = manifest.next_file_id(compacted=True)
+    manifest.replace([oldest], [compacted], {compacted: {"level": 1, "min_key": "a", "max_key": "m", "size": 5}})
+    manifest.add(manifest.next_file_id())
+    latest = manifest.file_ids()[0]
+    assert manifest.file_ids() == [latest, newest, middle, compacted]
+    assert manifest.sstables()[-1] == {"file_id": compacted, "level": 1, "min_key": "a", "max_key": "m", "size": 5}
+
+
+def test_load_persisted(manifest, tmp_path):
+    manifest.add(manifest.next_file_id())
+    manifest.add(manifest.next_file_id())
+    restored = Manifest(data_dir=str(tmp_path))
+    assert restored.file_ids() == manifest.file_ids()
+    assert restored.next_file_id() == manifest.next_file_id()
+
+
+def test_load_without_manifest(tmp_path):
+    for file_id in ["1726400000", "1726400100c", "1726400200"]:
+        (tmp_path / f"{file_id}.index").write_text("{}")
+    manifest = Manifest(data_dir=str(tmp_path))
+    assert manifest.file_ids() == ["1726400200", "1726400100c", "1726400000"]
+    assert manifest.next_file_id() == "1726400201"
+
+
+def test_replace_stale_snapshot(manifest):
+    manifest.add(manifest.next_file_id())
+    snapshot = manifest.snapshot()
+    [file_id] = snapshot.file_ids()
+    manifest.replace([file_id], [])
+    assert manifest.version > snapshot.version
+    with pytest.raises(StaleSnapshotException):
+        manifest.replace([file_id], [manifest.next_file_id(compacted=True)])
+    assert manifest.file_ids() == []
@@ -0,0 +1,28 @@
+import pytest
+from lsmt.mapped_file import MappedFileRegistry
+
+
+@pytest.fixture
+def data_file(tmp_path):
+    data_file = tmp_path / "0000000001.data"
+    data_file.write_bytes(b"name:noname:12345:False")
+    yield str(data_file)
+
+
+def test_mapped_once(data_file):
+    registry = MappedFileRegistry()
+    with registry.acquire(data_file) as (first, buffer):
+        assert bytes(buffer[0:4]) == b"name"
+    with registry.acquire(data_file) as (second, _):
+        assert first is second
+
+
+def test_retire_waits_for_readers(data_file):
+    registry = MappedFileRegistry()
+    with registry.acquire(data_file) as (mapped, buffer):
+        registry.retire(data_file)
+        # The in flight read still sees the mapped file
+        assert bytes(buffer[5:11]) == b"noname"
+        assert not mapped._map.closed
+    assert mapped._map.closed
+    assert data_file not in registry
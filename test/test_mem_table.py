@@ -1,7 +1,9 @@
 import pytest
-from unittest.mock import patch, MagicMock
+from unittest.mock import patch
 from lsmt.mem_table import MemTable
+from lsmt.sstable_format import BLOCK_HEADER, encode_record
 from utils.model import Data
+import zlib
 
 
 @pytest.fixture(scope='session')
@@ -9,17 +11,76 @@ def memtable():
     yield MemTable()
 
 
+@patch('os.replace')
+@patch('os.fsync')
+@patch('lsmt.mem_table.manifest')
 @patch('builtins.open')
-def test_flush(mock_open, memtable):
-    mock_write = MagicMock()
-    # this simulates the file object being return my open function
-    mock_file = mock_open.return_value.__enter__.return_value
+def test_flush(mock_open, mock_manifest, mock_fsync, mock_replace, memtable):
+    mock_manifest.next_file_id.return_value = "0000000001"
     user_data = Data(key="name", value="somename")
     memtable.add(user_data)
 
-    mock_file.write = mock_write
     memtable.flush()
     
-    data = f"name:{user_data.value}:{user_data.timestamp}:{user_data.deleted}".encode()
-    mock_write.assert_any_call(data)
+    # The data file is held open by the SSTableWriter, not used as a context manager
+    record = encode_record("name", user_data.value, user_data.timestamp, user_data.deleted)
+    mock_open.return_value.write.assert_any_call(BLOCK_HEADER.pack(len(record), zlib.crc32(record)) + record)
+    mock_manifest.add.assert_called_once()
+    file_id, metadata = mock_manifest.add.call_args.args
+    assert file_id == "0000000001"
+    assert (metadata["level"], metadata["min_key"], metadata["max_key"]) == (0, "name", "name")
+    # The sparse index is in the footer of the data file, no index file is written. The data file and the
+    # bloom filter are fsynced, the filter is renamed into place
+    assert mock_fsync.call_count == 2
+    tmp_file, bloom_file = mock_replace.call_args.args
+    assert bloom_file.endswith("0000000001.bloom") and tmp_file == f"{bloom_file}.tmp"
 
+
+def test_get_items_sorted():
+    memtable = MemTable()
+    for key in ["pear", "apple", "fig", "apple"]:
+        memtable.add(Data(key=key, value=key))
+    assert [key for key, _ in memtable.get_items()] == ["apple", "fig", "pear"]
+    assert [key for key, _ in memtable.get_items(start="b", end="g")] == ["fig"]
+    assert memtable.get_length() == 3
+
+
+def test_get_range_reads_lazily():
+    memtable = MemTable()
+    for key in ["a", "c", "e", "g"]:
+        memtable.add(Data(key=key, value="old"))
+    scan = memtable.get_range(start="b", end="g", chunk_size=1)
+    assert next(scan).key == "c"
+    # Writes land while the range is read, the ones ahead of the scan are seen
+    memtable.add(Data(key="b", value="new"))
+    memtable.add(Data(key="d", value="new"))
+    memtable.add(Data(key="e", value="new"))
+    assert [(data.key, data.value) for data in scan] == [("d", "new"), ("e", "new")]
+    assert [data.key for data in memtable.get_range()] == ["a", "b", "c", "d", "e", "g"]
+
+
+def test_instances_do_not_share_data():
+    first, second = MemTable(), MemTable()
+    first.add(Data(key="name", value="somename"))
+    assert second.get_length() == 0
+
+
+def test_size_bytes_tracks_overwrites():
+    memtable = MemTable()
+    memtable.add(Data(key="name", value="somename"))
+    size = memtable.size_bytes
+    assert size == MemTable.record_size(Data(key="name", value="somename"))
+    memtable.add(Data(key="name", value="some"))
+    assert memtable.size_bytes == size - 4
+    memtable.clear_cache()
+    assert memtable.size_bytes == 0
+
+
+@patch('lsmt.mem_table.write_sstable')
+def test_flush_keeps_serving_reads(mock_write_sstable):
+    memtable = MemTable()
+    memtable.add(Data(key="name", value="somename"))
+    memtable.flush()
+    mock_write_sstable.assert_called_once()
+    # Still readable until the MemTableManager drops it
+    assert memtable.get_data("name").value == "somename"
@@ -0,0 +1,146 @@
+import pytest
+import threading
+from unittest.mock import patch
+from lsmt.mem_table import MemTable
+from lsmt.mem_table_manager import MemTableManager
+from lsmt.wal import WriteAheadLog
+from exception.exceptions import NoDataFoundException, WriteStallException
+from utils.model import Data
+
+
+@pytest.fixture
+def mem_tables(tmp_path):
+    yield MemTableManager(wal=WriteAheadLog(wal_dir=str(tmp_path)))
+
+
+def test_frozen_mem_table_readable_until_flushed(mem_tables):
+    mem_tables.add(Data(key="name", value="somename"))
+    frozen = mem_tables.swap()
+    assert mem_tables.active is not frozen
+    assert mem_tables.get_data("name").value == "somename"
+
+
+def test_writes_during_flush_are_kept(mem_tables):
+    mem_tables.add(Data(key="name", value="somename"))
+
+    def flush(frozen):
+        # A write that lands while the frozen MemTable is being written out
+        mem_tables.add(Data(key="other", value="othername"))
+        assert frozen.get_length() == 1
+
+    with patch.object(MemTable, "flush", autospec=True, side_effect=flush) as mock_flush:
+        mem_tables.flush()
+    mock_flush.assert_called_once()
+    assert mem_tables.immutables == []
+    assert mem_tables.get_data("other").value == "othername"
+    with pytest.raises(NoDataFoundException):
+        mem_tables.get_data("name")
+
+
+def test_failed_flush_is_retried(mem_tables):
+    mem_tables.add(Data(key="name", value="somename"))
+    with patch.object(MemTable, "flush", side_effect=OSError("disk full")):
+        with pytest.raises(OSError):
+            mem_tables.flush()
+    assert len(mem_tables.immutables) == 1
+    assert mem_tables.get_data("name").value == "somename"
+    with patch.object(MemTable, "flush") as mock_flush:
+        mem_tables.flush()
+    mock_flush.assert_called_once()
+    assert mem_tables.immutables == []
+
+
+def test_recover_replays_unflushed_writes(mem_tables, tmp_path):
+    mem_tables.add(Data(key="name", value="somename"))
+    mem_tables.add(Data(key="name", value="othername", deleted=True))
+    restarted = MemTableManager(wal=WriteAheadLog(wal_dir=str(tmp_path)))
+    restarted.recover()
+    assert restarted.get_data("name").deleted
+    assert restarted.active.wal_segments == [0]
+
+
+def test_flush_removes_wal_segments(mem_tables, tmp_path):
+    mem_tables.add(Data(key="name", value="somename"))
+    with patch.object(MemTable, "flush"):
+        mem_tables.flush()
+    mem_tables.add(Data(key="other", value="othername"))
+    assert mem_tables.wal.segment_ids() == [1]
+
+
+def test_write_over_budget_flushes_in_background(tmp_path):
+    flushed = threading.Event()
+    mem_tables = MemTableManager(wal=WriteAheadLog(wal_dir=str(tmp_path)), on_flush=flushed.set)
+    mem_tables.start()
+    with patch.object(MemTable, "over_budget", return_value=True), patch.object(MemTable, "flush") as mock_flush:
+        mem_tables.add(Data(key="name", value="somename"))
+        assert mem_tables.active.get_length() == 0
+        assert flushed.wait(5)
+    mock_flush.assert_called_once()
+    assert mem_tables.immutables == []
+
+
+def test_write_stalls_when_flushes_fall_behind(tmp_path):
+    mem_tables = MemTableManager(wal=WriteAheadLog(wal_dir=str(tmp_path)), max_immutables=1, stall_timeout_ms=10)
+    mem_tables.add(Data(key="name", value="somename"))
+    mem_tables.swap()
+    # No flush worker is running, the pending MemTable never goes away
+    with pytest.raises(WriteStallException):
+        mem_tables.add(Data(key="other", value="othername"))
+    with patch.object(MemTable, "flush"):
+        mem_tables.flush()
+    mem_tables.add(Data(key="other", value="othername"))
+    assert mem_tables.get_data("other").value == "othername"
+
+
+def test_add_batch_one_wal_write(mem_tables, tmp_path):
+    batch = [Data(key="name", value="somename"), Data(key="other", value="othername"), Data(key="name", value="newname")]
+    with patch.object(WriteAheadLog, "sync") as mock_sync:
+        mem_tables.add_batch(batch)
+    mock_sync.assert_called_once()
+    assert mem_tables.get_data("name").value == "newname"
+    restarted = MemTableManager(wal=WriteAheadLog(wal_dir=str(tmp_path)))
+    restarted.recover()
+    assert restarted.get_data("other").value == "othername"
+
+
+def test_key_count_follows_live_keys(mem_tables):
+    # An overwrite of key1, key2 inserted twice, key3 inserted then deleted and a delete of a missing key
+    mem_tables.add(Data(key="key1", value="a"))
+    mem_tables.add_batch([
+        Data(key="key1", value="b"), Data(key="key2", value="a"), Data(key="key2", value="b"),
+        Data(key="key3", value="a"), Data(key="key3", value="", deleted=True), Data(key="key4", value="", deleted=True),
+    ])
+    assert mem_tables.key_count == 2
+    # Counted across swaps, the active MemTable starts over
+    mem_tables.swap()
+    mem_tables.add(Data(key="key5", value="a"))
+    assert mem_tables.key_count == 3
+
+
+def test_ingest_keeps_newer_data(mem_tables):
+    batch = [Data(key="pear", value="new"), Data(key="apple", value="new"), Data(key="fig", value="old")]
+    with patch("lsmt.mem_table_manager.write_sstable") as mock_write_sstable:
+        ingested = mem_tables.ingest(batch, lambda data: data.value == "new")
+    items, num_keys, source = mock_write_sstable.call_args.args
+    assert [key for key, _ in items] == ["apple", "pear"] and (num_keys, source) == (2, "ingest")
+    assert {data.key for data in ingested} == {"apple", "pear"}
+    # Nothing newer, no SSTable
+    with patch("lsmt.mem_table_manager.write_sstable") as mock_write_sstable:
+        assert mem_tables.ingest(batch, lambda data: False) == []
+    mock_write_sstable.assert_not_called()
+
+
+def test_ingest_not_shadowed_by_mem_table(mem_tables):
+    mem_tables.add(Data(key="apple", value="old", timestamp=100))
+    batch = [Data(key="apple", value="new", timestamp=200), Data(key="pear", value="new", timestamp=200)]
+    with patch("lsmt.mem_table_manager.write_sstable") as mock_write_sstable:
+        ingested = mem_tables.ingest(batch, lambda data: True)
+    items, num_keys, _ = mock_write_sstable.call_args.args
+    assert [key for key, _ in items] == ["pear"] and num_keys == 1
+    assert {data.key for data in ingested} == {"apple", "pear"}
+    assert mem_tables.get_data("apple").value == "new"
+    # The flush writes the ingested version out
+    with patch.object(MemTable, "flush", autospec=True) as mock_flush:
+        mem_tables.flush()
+    frozen = mock_flush.call_args.args[0]
+    assert frozen.get_data("apple").value == "new"
@@ -0,0 +1,28 @@
+import pytest
+from server.merkle_tree import MerkleTree, leaf_of
+from utils.model import Data
+
+
+def records(*items):
+    return sorted((Data(key=key, value=value, timestamp=timestamp) for key, value, timestamp in items), key=lambda data: data.key)
+
+
+def test_same_data_same_root():
+    left = MerkleTree.build(records(("key1", "a", 1), ("key2", "b", 1)), 4)
+    right = MerkleTree.build(records(("key1", "a", 1), ("key2", "b", 1)), 4)
+    assert len(left.levels) == 5 and len(left.levels[-1]) == 16
+    assert left.root == right.root
+    assert left.diff(right) == []
+
+
+def test_diff_finds_the_leaves_that_differ():
+    left = MerkleTree.build(records(("key1", "a", 1), ("key2", "b", 1), ("key3", "c", 1)), 6)
+    # key2 is older on the right, key3 is missing
+    right = MerkleTree.build(records(("key1", "a", 1), ("key2", "x", 0)), 6)
+    assert sorted(left.diff(right)) == sorted({leaf_of("key2", 6), leaf_of("key3", 6)})
+    assert MerkleTree.from_dict(right.to_dict()).diff(left) == right.diff(left)
+
+
+def test_diff_rejects_another_depth():
+    with pytest.raises(ValueError):
+        MerkleTree.build([], 2).diff(MerkleTree.build([], 3))
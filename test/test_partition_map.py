@@ -0,0 +1,38 @@
+from partition.partition_map import PartitionMap
+from server.cluster_view import ClusterView
+
+VIEW = ClusterView.build(3, {str(node): f"localhost:800{node}" for node in range(4)})
+
+
+def test_replicas_per_range_match_the_ring():
+    partition_map = PartitionMap.build(VIEW, 2)
+    assert len(partition_map.tokens) == len(partition_map.replicas) == 4
+    successor = {node_id: VIEW.node_ids[(position + 1) % 4] for position, node_id in enumerate(VIEW.node_ids)}
+    for key in map(str, range(200)):
+        owner = VIEW.ring.get_node_for_data(key)
+        assert partition_map.get(key) == (VIEW.id_host_map[owner], VIEW.id_host_map[successor[owner]])
+    # Every node replicates its own range and the one before it
+    assert all(len(partition_map.ranges_of(f"localhost:800{node}")) == 2 for node in range(4))
+
+
+def test_snapshot(tmp_path):
+    partition_map = PartitionMap.build(VIEW, 3)
+    assert PartitionMap.from_dict(partition_map.to_dict()) == partition_map
+    partition_map.save(str(tmp_path))
+    assert PartitionMap.load(str(tmp_path)) == partition_map
+    assert PartitionMap.load(str(tmp_path / "missing")) == PartitionMap()
+
+
+def test_empty_ring():
+    assert PartitionMap.build(ClusterView(), 2).get("key") == ()
+
+
+def test_routing_reads_the_map_of_the_view():
+    view = ClusterView.build(4, VIEW.id_host_map)
+    assert view.partition_map(2) is view.partition_map(2)
+    assert view.get_replica_nodes("key", 2) == list(view.partition_map(2).get("key"))
+    # Every node shares a range with the nodes before and after it on the ring
+    position = view.node_ids.index("0")
+    neighbours = {view.id_host_map[view.node_ids[(position + offset) % 4]] for offset in (-1, 1)}
+    assert view.get_peers("localhost:8000", 2) == sorted(neighbours)
+    assert view.get_peers("localhost:9000", 2) == []
@@ -0,0 +1,57 @@
+import httpx
+import pytest
+from unittest.mock import MagicMock, patch
+from server.cluster_view import ClusterView
+from server.rebalancer import Rebalancer, Throttle
+from utils.model import Data
+
+BEFORE = {"1": "node1:8000", "2": "node2:8000"}
+AFTER = {"1": "node1:8000", "2": "node2:8000", "3": "node3:8000"}
+
+
+def rebalancer(handler, records=(), **kwargs):
+    server = MagicMock()
+    server.host_port = "node3:8000"
+    server.transfer_records.return_value = list(records)
+    server.ingest.side_effect = len
+    return Rebalancer(server=server, http=httpx.Client(transport=httpx.MockTransport(handler)), **kwargs)
+
+
+def test_pull_writes_the_streamed_records_in_batches():
+    records = [Data(key=f"key{index}", value="v" * 100, timestamp=1) for index in range(50)]
+    sender = rebalancer(None, records, chunk_bytes=1000, max_bytes_per_second=0)
+    requests = []
+
+    def handler(request):
+        requests.append(request)
+        return httpx.Response(200, content=sender.stream("node3:8000", BEFORE, AFTER))
+
+    receiver = rebalancer(handler, sstable_bytes=2000)
+    assert receiver.take_over(ClusterView.build(1, AFTER, {"1", "2"}), ClusterView.build(1, AFTER)) == 50 * 2
+    # Both members of the ring are asked for the keys node3 takes over
+    assert sorted(request.url.host for request in requests) == ["node1", "node2"]
+    # About sstable_bytes per SSTable
+    batches = [call.args[0] for call in receiver.server.ingest.call_args_list]
+    assert len(batches) > 2 and all(len(batch) < 50 for batch in batches)
+    assert [data.key for data in batches[0] + batches[1]] == [data.key for data in records[: len(batches[0] + batches[1])]]
+
+
+def test_truncated_stream_fails_the_join():
+    sender = rebalancer(None, [Data(key="key", value="value")])
+    content = b"".join(sender.stream("node3:8000", BEFORE, AFTER))
+    receiver = rebalancer(lambda request: httpx.Response(200, content=content[:-1]))
+    with pytest.raises(ValueError):
+        receiver.take_over(ClusterView.build(1, BEFORE), ClusterView.build(1, AFTER), raise_errors=True)
+    receiver.server.ingest.assert_not_called()
+
+
+@patch("server.rebalancer.time.sleep")
+@patch("server.rebalancer.time.monotonic")
+def test_throttle(mock_monotonic, mock_sleep):
+    throttle = Throttle(bytes_per_second=1000)
+    mock_monotonic.return_value = 10
+    throttle.wait(500)
+    mock_sleep.assert_called_once_with(0.5)
+    mock_monotonic.return_value = 11
+    throttle.wait(500)
+    assert mock_sleep.call_count == 1
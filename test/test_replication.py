@@ -0,0 +1,82 @@
+import asyncio
+import pytest
+from exception.exceptions import QuorumException, WriteStallException
+from server.replication import merge_scan_pages, newest, quorum
+from utils.model import Data, version_of
+
+
+async def answer(result, delay=0.0):
+    await asyncio.sleep(delay)
+    if isinstance(result, Exception):
+        raise result
+    return result
+
+
+def test_quorum_returns_without_the_slowest_replica():
+    async def run():
+        slow = answer("c", delay=0.5)
+        results = await quorum(
+            {"a": answer("a"), "b": answer("b", delay=0.01), "c": slow}, {"key": ["a", "b", "c"]}, 2
+        )
+        assert results == {"a": "a", "b": "b"}
+
+    asyncio.run(run())
+
+
+def test_quorum_counts_replicas_per_key():
+    async def run():
+        # key1 is on a and b, key2 on b and c, c failing leaves key2 with one replica
+        calls = {"a": answer("a"), "b": answer("b"), "c": answer(ConnectionError("down"))}
+        replicas = {"key1": ["a", "b"], "key2": ["b", "c"]}
+        assert set(await quorum(dict(calls), replicas, 1)) <= {"a", "b"}
+        calls = {"a": answer("a"), "b": answer("b"), "c": answer(ConnectionError("down"))}
+        with pytest.raises(QuorumException):
+            await quorum(calls, replicas, 2)
+        with pytest.raises(WriteStallException):
+            await quorum({"a": answer(WriteStallException("stalled"))}, {"key": ["a"]}, 1)
+
+    asyncio.run(run())
+
+
+def test_quorum_needs_enough_replicas():
+    async def run():
+        # The quorum is not lowered to the replicas there are, a key without replicas fails too
+        call = answer("a")
+        with pytest.raises(QuorumException):
+            await quorum({"a": call}, {"key1": ["a"]}, 2)
+        assert call.cr_frame is None
+        with pytest.raises(QuorumException):
+            await quorum({}, {"key1": []}, 1)
+
+    asyncio.run(run())
+
+
+def test_newest():
+    assert newest([None, item("key1", timestamp=1), item("key1", timestamp=2, deleted=True)])["deleted"] is True
+    # Writes within the same second are told apart
+    assert newest([item("key1", timestamp=1_000_000_002), item("key1", timestamp=1_000_000_001)])["timestamp"] == 1_000_000_002
+    assert newest([None, None]) is None
+
+
+def test_version_of():
+    data = Data(key="key1", value="a", timestamp=2)
+    assert version_of(data) == version_of(data.model_dump())
+    assert version_of(Data(key="key1", value="", timestamp=2, deleted=True)) > version_of(data)
+    assert version_of(Data(key="key1", value="a", timestamp=3)) > version_of(data)
+    # Only a tie to the nanosecond falls back to the value
+    assert version_of(Data(key="key1", value="a", timestamp=3)) > version_of(Data(key="key1", value="b", timestamp=2))
+
+
+def item(key, timestamp=1, deleted=False):
+    return {"key": key, "value": "", "timestamp": timestamp, "deleted": deleted}
+
+
+def test_merge_scan_pages():
+    # Every key is on two of the three nodes, node c holds a newer delete of b
+    pages = [[item("a"), item("b")], [item("a"), item("c")], [item("b", 2, True), item("c")]]
+    page = merge_scan_pages(pages, 2)
+    # A full page may hide keys past its last key, the page stops at the smallest of them
+    assert [data["key"] for data in page["items"]] == ["a"]
+    assert page["next"] == "b\x00"
+    page = merge_scan_pages([[item("a"), item("c")], [item("b", 2, True)]], 3)
+    assert [data["key"] for data in page["items"]] == ["a", "c"] and page["next"] is None
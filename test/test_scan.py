@@ -0,0 +1,17 @@
+from lsmt.scan import merge_newest, prefix_range, next_key
+from utils.model import Data
+
+
+def test_merge_newest():
+    newest = [Data(key="b", value="new"), Data(key="d", value="new", deleted=True)]
+    oldest = [Data(key="a", value="old"), Data(key="b", value="old"), Data(key="d", value="old")]
+    merged = list(merge_newest([newest, oldest]))
+    assert [(data.key, data.value) for data in merged] == [("a", "old"), ("b", "new"), ("d", "new")]
+    assert merged[-1].deleted
+
+
+def test_prefix_range():
+    assert prefix_range("user:") == ("user:", "user;")
+    assert prefix_range("a\U0010ffff") == ("a\U0010ffff", "b")
+    assert prefix_range("") == ("", None)
+    assert "user:" < next_key("user:") < "user:0"
@@ -1,30 +1,39 @@
 import pytest
 from unittest.mock import patch, MagicMock
+from prometheus_client import REGISTRY
 from impl.consistent_hashing import ConsistentHashingImpl
-from lsmt.mem_table import MemTable
+from lsmt.mem_table_manager import MemTableManager
+from lsmt.manifest import Manifest
 from lsmt.sstable import SSTable
+from lsmt.wal import WriteAheadLog
 from scheduler.scheduler import Scheduler
 from exception.exceptions import NoDataFoundException
 from server.server import Server
+from server.cluster_view import ClusterView
 from utils.model import Data
 
 
-# Fixture scoped to the entire test session
-@pytest.fixture(scope="session")
-def server():
-    with patch("server.server.KazooClient") as MockKazooClient:
+# Fixture scoped to the module, the Server registers metrics that can only be created once
+@pytest.fixture(scope="module")
+def server(tmp_path_factory):
+    data_dir = tmp_path_factory.mktemp("data")
+    # The PARTITION_MAP snapshots of view changes go to the temporary directory
+    with patch("server.server.KazooClient"), patch("server.server.settings.dataDirectory", str(data_dir)):
         # Return a single instance of the Server object
-        yield Server(
+        server = Server(
             zk_host="localhost",
             zk_port=2181,
             port=8000,
             private_ip="127.0.0.1",
         )
+        # Writes never reach the WAL of the data directory, a later start would replay them
+        server._cache.wal = WriteAheadLog(wal_dir=str(data_dir / "wal"))
+        yield server
 
 
 def test_server_initialization(server):
     assert isinstance(server._consistent_hash, ConsistentHashingImpl)
-    assert isinstance(server._cache, MemTable)
+    assert isinstance(server._cache, MemTableManager)
     assert isinstance(server._ss_table, SSTable)
     assert isinstance(server._scheduler, Scheduler)
 
@@ -52,60 +61,152 @@ def test_get_data(mock_sstable_get, mock_cache_get, server):
         server.get_data("key")
 
 
-@patch("kazoo.client.KazooClient")
-@patch("impl.consistent_hashing.ConsistentHashingImpl.add_node")
-@patch("server.server.Server.check_if_leader")
-def test_watch_for_child_nodes(
-    mock_check_if_leader, mock_add_node, mock_kazoo_client, server
-):
-    mock_zk = mock_kazoo_client.return_value
-    mock_zk.get_children.return_value = ["n_1"]
-    mock_zk.get.return_value = (b"localhost:8000", None)
-    mock_check_if_leader.return_value = True
-
-    server._id_host_map = {}
-    event = MagicMock(state="CONNECTED")
+def test_on_members_changed(server):
+    mock_zk = MagicMock()
+    mock_zk.get.side_effect = lambda path: ({"/election/n_1": b"localhost:8000", "/election/n_2": b"localhost:8001"}[path], None)
     server.zk_connection = mock_zk
-    server.watch_for_child_nodes(event)
-    mock_add_node.assert_called_once_with("1")
-    assert server._id_host_map["1"] == "localhost:8000"
+    server.identifier = 1
 
-
-@patch("kazoo.client.KazooClient")
-def test_check_if_leader(mock_kazoo_client, server):
-    mock_zk = mock_kazoo_client.return_value
-    mock_zk.get_children.return_value = ["n_1", "n_2"]
+    server.on_ring_changed(["n_1", "n_2"])
+    server.on_members_changed(["n_2", "n_1"])
+    version = server._view.version
+    assert server._id_host_map == {"1": "localhost:8000", "2": "localhost:8001"}
+    assert server.get_data_node("key") in ["localhost:8000", "localhost:8001"]
+
+    # Known members are not read again, a member leaving rebuilds the ring without it
+    mock_zk.get.reset_mock()
+    server.on_view_changed = MagicMock()
+    try:
+        server.on_members_changed(["n_2"])
+    finally:
+        on_view_changed, server.on_view_changed = server.on_view_changed, None
+    mock_zk.get.assert_not_called()
+    assert server._view.version == version + 1
+    assert server.get_data_node("key") == "localhost:8001"
+    on_view_changed.assert_called_once_with(server._view)
+
+
+def test_joining_member_is_routed_to_once_in_the_ring(server):
+    server.zk_connection = MagicMock()
+    server.zk_connection.get.side_effect = lambda path: ({"/election/n_1": b"localhost:8000", "/election/n_2": b"localhost:8001"}[path], None)
+    server._view = ClusterView()
+    server.on_ring_changed(["n_1"])
+    server.on_members_changed(["n_1", "n_2"])
+
+    # Until it joins the ring, the new member only gets the writes of the keys it takes over
+    assert server.get_ring()["nodes"] == {"1": "localhost:8000"}
+    keys = [str(key) for key in range(100)]
+    assert {server.get_data_node(key) for key in keys} == {"localhost:8000"}
+    pending = [key for key in keys if server.get_pending_nodes(key) == ["localhost:8001"]]
+    server.on_ring_changed(["n_1", "n_2"])
+    assert pending and all(server.get_data_node(key) == "localhost:8001" for key in pending)
+    assert all(server.get_pending_nodes(key) == [] for key in keys)
+
+
+def test_check_if_leader(server):
+    server.zk_connection = MagicMock()
+    server._view = ClusterView.build(1, {"1": "localhost:8000", "2": "localhost:8001"})
 
     server.identifier = 1
     assert server.check_if_leader() is True
 
     server.identifier = 2
     assert server.check_if_leader() is False
+    # The request path never calls ZooKeeper
+    server.zk_connection.get_children.assert_not_called()
 
 
-@patch("kazoo.client.KazooClient")
-def test_get_all_nodes(mock_kazoo_client, server):
-    mock_zk = mock_kazoo_client.return_value
-    server.zk_connection = mock_zk
-    mock_zk.get_children.return_value = ["n_1", "n_2"]
+def test_get_all_nodes(server):
+    server._view = ClusterView.build(1, {"2": "localhost:8001", "1": "localhost:8000"})
 
     nodes = server.get_all_nodes()
     assert nodes == ["n_1", "n_2"]
 
 
+@patch("server.server.ChildrenWatch")
 @patch("kazoo.client.KazooClient")
-def test_start_server(mock_kazoo_client, server):
+def test_start_server(mock_kazoo_client, mock_children_watch, server, tmp_path):
     mock_zk = mock_kazoo_client.return_value
     mock_zk.ensure_path.return_value = True
     mock_zk.create.return_value = "/election/n_1"
-    mock_zk.get_children.return_value = []
     server.zk_connection = mock_zk
 
-    server.start()
+    # Starts on an empty data directory, whatever earlier tests or runs left behind is not replayed
+    server._cache.wal = WriteAheadLog(wal_dir=str(tmp_path / "wal"))
+    with patch("lsmt.sstable.manifest", Manifest(data_dir=str(tmp_path))):
+        server.start()
     mock_zk.create.assert_called_once_with(
         "/election/n_", ephemeral=True, sequence=True, value=b"127.0.0.1:8000"
     )
     assert server.identifier == 1
-    mock_zk.get_children.assert_called_once_with(
-        "/election", watch=server.watch_for_child_nodes
-    )
+    mock_children_watch.assert_any_call(mock_zk, "/ring", server.on_ring_changed)
+    mock_children_watch.assert_any_call(mock_zk, "/election", server.on_members_changed)
+
+
+@patch("lsmt.mem_table_manager.MemTableManager.add_batch")
+def test_add_batch(mock_add_batch, server):
+    batch = [Data(key="key", value="value"), Data(key="other", value="value")]
+    server.add_batch(batch)
+    mock_add_batch.assert_called_once_with(batch)
+
+
+@patch("server.server.Server.get_data")
+def test_get_batch(mock_get_data, server):
+    data = Data(key="key", value="value")
+
+    def get_data(key, include_deleted=False):
+        if key != "key":
+            raise NoDataFoundException(key)
+        return data
+
+    mock_get_data.side_effect = get_data
+    assert server.get_batch(["key", "missing"]) == {"key": data, "missing": None}
+
+
+@patch("lsmt.sstable.SSTable.open_range")
+@patch("lsmt.mem_table_manager.MemTableManager.scan")
+def test_scan(mock_mem_table_scan, mock_open_range, server):
+    mock_mem_table_scan.return_value = [[Data(key="b", value="new", deleted=True), Data(key="c", value="new")]]
+    mock_open_range.return_value.__enter__.return_value = [
+        iter([Data(key="a", value="old"), Data(key="b", value="old")])
+    ]
+    assert [(data.key, data.value) for data in server.scan("a", "z")] == [("a", "old"), ("c", "new")]
+    mock_open_range.assert_called_once_with("a", "z")
+    mock_open_range.return_value.__enter__.return_value = [iter([Data(key="a", value="old")])]
+    assert [data.key for data in server.scan_page("a", "z", 1)] == ["a"]
+
+
+def test_get_replica_nodes(server):
+    server._view = ClusterView.build(1, {str(node): f"localhost:800{node}" for node in range(4)})
+    with patch("server.server.settings.replication.factor", 3):
+        replicas = server.get_replica_nodes("key")
+    assert len(set(replicas)) == 3
+    assert replicas[0] == server.get_data_node("key")
+    # The owner is followed by the next members clockwise on the ring
+    positions = [server._view.node_ids.index(host_port[-1]) for host_port in replicas]
+    assert [(position - positions[0]) % 4 for position in positions] == [0, 1, 2]
+    with patch("server.server.settings.replication.factor", 9):
+        assert len(server.get_replica_nodes("key")) == 4
+
+
+def test_transfer_records(server):
+    before = ClusterView.build(1, {"1": "localhost:8001", "2": "127.0.0.1:8000"})
+    after = ClusterView.build(2, {"1": "localhost:8001", "2": "127.0.0.1:8000", "3": "localhost:8002"})
+    records = [Data(key=str(key), value="value") for key in range(100)]
+    with patch.object(Server, "scan", return_value=(data for data in records)):
+        transferred = [data.key for data in server.transfer_records("localhost:8002", before, after)]
+    # Only the keys the joining node takes over from this node, not the ones of localhost:8001
+    expected = [
+        data.key
+        for data in records
+        if after.get_data_node(data.key) == "localhost:8002" and before.get_data_node(data.key) == "127.0.0.1:8000"
+    ]
+    assert transferred == expected and expected
+
+
+def test_key_count(server):
+    key_count = REGISTRY.get_sample_value("key_counter", {"node": "127.0.0.1"})
+    server.add_data(Data(key="counted", value="value"))
+    assert REGISTRY.get_sample_value("key_counter", {"node": "127.0.0.1"}) == key_count + 1
+    server.add_data(Data(key="counted", value="", deleted=True))
+    assert REGISTRY.get_sample_value("key_counter", {"node": "127.0.0.1"}) == key_count
@@ -1,7 +1,9 @@
 import pytest
-import json
 from unittest.mock import patch, MagicMock
 from lsmt.sstable import SSTable
+from lsmt.sstable_format import SSTableWriter
+from lsmt.mapped_file import mapped_files
+from lsmt.manifest import Manifest
 from utils.model import Data
 
 @pytest.fixture(scope='session')
@@ -10,29 +12,58 @@ def sstable():
 
 @patch.object(SSTable, 'read_data_file')
 @patch('json.load')
-@patch('glob.glob')
+@patch('lsmt.sstable.manifest')
 @patch('builtins.open')
-def test_get_data(mock_open, mock_glob, mock_json, mock_read_data_file, sstable):
+def test_get_data(mock_open, mock_manifest, mock_json, mock_read_data_file, sstable):
     mock_file = MagicMock()
-    mock_glob.return_value = ["dummy_index_file.index"]
+    mock_manifest.snapshot.return_value.index_files.return_value = ["dummy_index_file.index"]
     mock_open.return_value = mock_file
     mock_json.return_value = {"name": {"key":"name", "start": 1, "end": 10}}
 
     result = sstable.get_data("name")
     assert isinstance(result, MagicMock)
 
-@patch('builtins.open')
-def test_read_data_file(mock_open, sstable):
-    mock_file = MagicMock()
-    mock_open.return_value.__enter__.return_value = mock_file
-    mock_file.seek.return_value = None
-    mock_file.read.return_value = "name:noname:12345:False".encode()
+def test_read_data_file(sstable, tmp_path):
+    # Data files written before the binary format hold colon joined records
+    data_file = tmp_path / "1726400000.data"
+    data_file.write_bytes("name:noname:12345:False".encode())
+
+    assert sstable.read_data_file(str(data_file), 0, 23) == Data(key="name", value="noname", timestamp=12345, deleted=False)
 
-    assert sstable.read_data_file('mock_file.data', 1, 10) == Data(key="name", value="noname", timestamp=12345, deleted=False)
 
+def test_read_data_file_mapped(sstable, tmp_path):
+    data_file = f"{tmp_path}/0000000001.data"
+    with SSTableWriter(data_file) as writer:
+        writer.add("other", "othername", 12344, False)
+        start, end = writer.add("name", "some:name", 12345, True)
 
+    assert sstable.read_data_file(data_file, start, end) == Data(key="name", value="some:name", timestamp=12345, deleted=True)
+    assert data_file in mapped_files
+    mapped_files.retire(data_file)
+    assert data_file not in mapped_files
 
 
+def test_read_block(sstable, tmp_path):
+    data_file = f"{tmp_path}/0000000001.data"
+    with SSTableWriter(data_file, block_size=32) as writer:
+        for key in ["apple", "fig", "name", "pear"]:
+            writer.add(key, f"{key}value", 12345, False)
 
+    assert sstable.read_block(data_file, writer.sparse_index, "name") == Data(key="name", value="namevalue", timestamp=12345, deleted=False)
+    assert sstable.read_block(data_file, writer.sparse_index, "banana") is None
+    assert sstable.read_block(data_file, writer.sparse_index, "aaa") is None
 
 
+def test_open_range(sstable, tmp_path):
+    test_manifest = Manifest(data_dir=str(tmp_path))
+    for records in [[("a", "old"), ("b", "old"), ("c", "old")], [("b", "new"), ("d", "new")]]:
+        file_id = test_manifest.next_file_id()
+        with SSTableWriter(f"{tmp_path}/{file_id}.data") as writer:
+            for key, value in records:
+                writer.add(key, value, 12345, False)
+        test_manifest.add(file_id)
+    with patch('lsmt.sstable.manifest', test_manifest):
+        with sstable.open_range("b", "d") as sources:
+            assert [[(data.key, data.value) for data in source] for source in sources] == [
+                [("b", "new")], [("b", "old"), ("c", "old")]
+            ]
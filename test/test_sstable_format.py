@@ -0,0 +1,75 @@
+import pytest
+from lsmt.sstable_format import (
+    SSTableWriter, read_header, read_record, iter_records, iter_range, load_sparse_index, find_record, BLOCK_HEADER, VERSION
+)
+
+
+@pytest.fixture
+def data_file(tmp_path):
+    data_file_name = f"{tmp_path}/0000000001.data"
+    offsets = dict()
+    with SSTableWriter(data_file_name, block_size=64) as writer:
+        for i in range(20):
+            offsets[f"key{i:02d}"] = writer.add(f"key{i:02d}", f"value:{i}", 12345 + i, i % 5 == 0)
+    yield data_file_name, offsets
+
+
+def test_read_record(data_file):
+    data_file_name, offsets = data_file
+    with open(data_file_name, "rb") as fp_data_file:
+        version, _ = read_header(fp_data_file)
+        assert version == VERSION
+        record = read_record(fp_data_file, *offsets["key07"], version)
+    assert record.to_data().value == "value:7"
+    assert record.timestamp == 12352
+    assert not record.deleted
+
+
+def test_iter_records(data_file):
+    data_file_name, offsets = data_file
+    with open(data_file_name, "rb") as fp_data_file:
+        records = list(iter_records(fp_data_file))
+    assert [record.key for record, _, _ in records] == sorted(offsets)
+    assert all(offsets[record.key] == (start, end) for record, start, end in records)
+    assert records[5][0].deleted
+
+
+def test_corrupt_block_detected(data_file):
+    data_file_name, offsets = data_file
+    with open(data_file_name, "r+b") as fp_data_file:
+        fp_data_file.seek(offsets["key00"][1] - 1)
+        fp_data_file.write(b"X")
+    with open(data_file_name, "rb") as fp_data_file:
+        with pytest.raises(ValueError):
+            list(iter_records(fp_data_file))
+
+
+def test_sparse_index_in_footer(data_file):
+    data_file_name, offsets = data_file
+    with open(data_file_name, "rb") as fp_data_file:
+        sparse_index = load_sparse_index(fp_data_file.read())
+    # 20 records of ~30 bytes, a block is closed once it reaches 64 bytes
+    assert len(sparse_index.first_keys) == 7
+    assert sparse_index.first_keys == sorted(sparse_index.first_keys)
+    assert sparse_index.find_block("a") is None
+    block_offset, block_length = sparse_index.find_block("key07")
+    assert block_offset < offsets["key07"][0] < block_offset + block_length + BLOCK_HEADER.size
+
+
+def test_find_record(data_file):
+    data_file_name, _ = data_file
+    with open(data_file_name, "rb") as fp_data_file:
+        buffer = fp_data_file.read()
+    sparse_index = load_sparse_index(buffer)
+    assert find_record(buffer, *sparse_index.find_block("key07"), "key07").to_data().value == "value:7"
+    assert find_record(buffer, *sparse_index.find_block("key07a"), "key07a") is None
+
+
+def test_iter_range(data_file):
+    data_file_name, _ = data_file
+    with open(data_file_name, "rb") as fp_data_file:
+        buffer = fp_data_file.read()
+    sparse_index = load_sparse_index(buffer)
+    assert [record.key for record in iter_range(buffer, sparse_index, "key07a", "key11")] == ["key08", "key09", "key10"]
+    assert [record.key for record in iter_range(buffer, sparse_index, end="key02")] == ["key00", "key01"]
+    assert len(list(iter_range(buffer, sparse_index, "key15"))) == 5
@@ -0,0 +1,60 @@
+import pytest
+import threading
+from unittest.mock import patch
+from lsmt.wal import WriteAheadLog, encode_record
+from utils.model import Data
+
+
+@pytest.fixture
+def wal(tmp_path):
+    yield WriteAheadLog(wal_dir=str(tmp_path), sync_mode="group", group_commit_window_ms=20)
+
+
+def test_replay(wal):
+    wal.append(Data(key="name", value="some:name"))
+    wal.append_batch([Data(key="other", value="othername"), Data(key="name", value="", deleted=True)])
+    wal.rotate()
+    wal.append(Data(key="last", value="lastname"))
+    segments = list(wal.replay())
+    assert [segment_id for segment_id, _ in segments] == [0, 1]
+    assert [data.key for data in segments[0][1]] == ["name", "other", "name"]
+    assert segments[0][1][0].value == "some:name"
+    assert segments[0][1][2].deleted
+
+
+def test_replay_ignores_torn_record(wal, tmp_path):
+    wal.append(Data(key="name", value="somename"))
+    wal.rotate()
+    with open(wal.segment_file(0), "ab") as fp_wal_file:
+        fp_wal_file.write(encode_record(Data(key="torn", value="tornvalue"))[:-3])
+    [(_, records)] = list(wal.replay())
+    assert [data.key for data in records] == ["name"]
+
+
+@patch("os.fsync")
+def test_group_commit_shares_fsync(mock_fsync, wal):
+    def write(i):
+        wal.sync(wal.append(Data(key=f"key{i}", value="value")))
+
+    writers = [threading.Thread(target=write, args=(i,)) for i in range(8)]
+    for writer in writers:
+        writer.start()
+    for writer in writers:
+        writer.join()
+    assert 1 <= mock_fsync.call_count < 8
+
+
+@patch("os.fsync")
+def test_always_syncs_every_write(mock_fsync, tmp_path):
+    wal = WriteAheadLog(wal_dir=str(tmp_path), sync_mode="always")
+    for i in range(3):
+        wal.sync(wal.append(Data(key=f"key{i}", value="value")))
+    assert mock_fsync.call_count == 3
+
+
+def test_remove(wal):
+    wal.append(Data(key="name", value="somename"))
+    wal.rotate()
+    wal.append(Data(key="other", value="othername"))
+    wal.remove([0])
+    assert wal.segment_ids() == [1]
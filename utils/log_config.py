@@ -0,0 +1,33 @@
+from loguru import logger
+from config import settings
+import logging
+import random
+import sys
+
+
+def configure_logging(sink=sys.stderr):
+    """
+    Replaces the default loguru sink with one configured as per the logging settings
+    1. Every subsystem (lsmt, compaction, server...) logs at its own level, the rest at logging.level
+    2. With enqueue, records are written by a background thread and callers never wait on the sink
+    3. Libraries logging through the standard library, like the consistent hash ring, get their own levels
+    """
+    levels = {"": settings.logging.level, **dict(settings.logging.levels)}
+    logger.remove()
+    logger.add(
+        sink,
+        # The sink lets everything through that some subsystem wants, the filter applies the level per subsystem
+        level=min(logger.level(level).no for level in levels.values()),
+        filter=levels,
+        enqueue=settings.logging.enqueue,
+        serialize=settings.logging.serialize,
+    )
+    for name, level in dict(settings.logging.libraryLevels).items():
+        logging.getLogger(name).setLevel(level)
+
+
+def sample_request() -> bool:
+    """
+    True for the share of requests, as per logging.requestSampleRate, that are logged
+    """
+    return random.random() < settings.logging.requestSampleRate
@@ -1,26 +1,44 @@
-from enum import Enum
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
+from typing import Dict, List
 import time
 
 
-class PartitionMapOperation(Enum):
-    new = "new"
-    delete = "delete"
-
-
 class Data(BaseModel):
     key: str
     value: str
-    timestamp: int = int(round(time.time()))
+    # Nanoseconds since the epoch, evaluated per instance, a plain default would stamp every write with
+    # the import time. Writes of a key within the same second still get ordered
+    timestamp: int = Field(default_factory=time.time_ns)
     deleted: bool = False
 
 
-class PartitionMapRequest(BaseModel):
-    key: str
-    node: str
-    port: str
-    operation: PartitionMapOperation
+def version_of(data) -> tuple:
+    """
+    Orders the versions of a key, the one comparator of replica reads, repairs, hinted handoff,
+    anti-entropy and rebalancing. The newest timestamp wins, a delete wins a tie with a write.
+    Two versions stamped in the same nanosecond fall back to the value, which means nothing but
+    picks the same version on every node so replicas converge. Accepts Data or its JSON form
+    """
+    if isinstance(data, dict):
+        return data["timestamp"], data["deleted"], data["value"]
+    return data.timestamp, data.deleted, data.value
+
+
+class BatchAddRequest(BaseModel):
+    items: List[Data]
 
-    @property
-    def node_details(self) -> str:
-        return f"{self.node}:{self.port}"
+
+class BatchGetRequest(BaseModel):
+    keys: List[str]
+
+
+class RepairLeavesRequest(BaseModel):
+    leaves: List[int]
+
+
+class RebalanceStreamRequest(BaseModel):
+    # host:port of the node taking over the ranges
+    node: str
+    # host:port of the members in the ring before and after it changes, keyed by their election id
+    before: Dict[str, str]
+    after: Dict[str, str]